@@ -1,13 +1,28 @@
+"""
+ASGI config for AirConController project.
+
+HTTP请求(包括main_machine/room_state_events的SSE推送)交给Django处理，
+WebSocket连接按main_machine.routing路由。需安装channels 2，例如:
+daphne AirConController.asgi:application
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AirConController.settings')
+django.setup()
+
 from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
-# import monitor.urls
 
-"""
+import main_machine.routing
+
 application = ProtocolTypeRouter({
+    'http': AsgiHandler,
     'websocket': AuthMiddlewareStack(
         URLRouter(
-            monitor.urls.websocket_urlpatterns,
+            main_machine.routing.websocket_urlpatterns,
         )
     ),
 })
-"""
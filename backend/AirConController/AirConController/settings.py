@@ -77,7 +77,7 @@ TEMPLATES = [
 WSGI_APPLICATION = 'AirConController.wsgi.application'
 
 # Channels
-# ASGI_APPLICATION = 'AirConController.asgi.application'
+ASGI_APPLICATION = 'AirConController.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
@@ -86,8 +86,42 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'OPTIONS': {
+            # 写入线程等待锁的秒数
+            'timeout': 20,
+        },
     }
 }
+# SQLite使用WAL日志模式，读线程池中的查询不阻塞写入线程的提交。
+# WAL模式记录在数据库文件中，并在数据库旁生成-wal/-shm文件；关闭时查询与提交相互阻塞
+SQLITE_WAL = True
+
+# Rooms
+# 房间号的JSON数组，仅在数据库中尚无房间定义时加载
+ROOM_CONFIG_FILE = os.path.join(BASE_DIR, 'rooms.json')
+# 楼宇: 楼宇号到{'rooms': 房间号的list, 'capacity': 服务队列容量}的dict，rooms仅在数据库中尚无该楼宇的房间定义时加载，
+# 默认楼宇'default'缺省rooms时按ROOM_CONFIG_FILE加载; 为None时只有默认楼宇。房间号在所有楼宇中唯一
+# 例如 {'default': {}, 'north': {'rooms': ['n101', 'n102'], 'capacity': 2}}
+BUILDINGS = None
+
+# Tick engine
+# 'object': 逐对象更新; 'vectorized': 以NumPy数组批量更新(需安装numpy);
+# 'analytic': 读取时计算温度和费用，仅在到达目标温度或等待超时时触发调度
+TICK_ENGINE = 'object'
+
+# Multi-worker deployment
+# 为None时单进程运行; 设置为目录时，多个工作进程通过该目录下的文件锁选出各分片的调度进程，
+# 调度进程持有分片的状态并执行定时任务，各进程读取共享的状态快照并将修改状态的请求转发给房间所在分片(仅支持Linux/macOS)
+CLUSTER_DIR = None
+# 调度分片: 分片名到{'prefixes': 房间号前缀的tuple, 'capacity': 服务队列容量}的dict，
+# 不匹配任何前缀的房间属于第一个分片; 为None时所有房间属于一个分片。工作进程数需不少于分片数
+# 例如 {'floor3': {'prefixes': ('3',), 'capacity': 3}, 'floor4': {'prefixes': ('4',), 'capacity': 2}}
+SCHEDULER_SHARDS = None
+
+# State journal
+# 为None时不保存状态; 设置为目录时，调度线程将各楼宇的房间和队列状态记录到该目录下的快照和日志，重启时恢复。
+# 多进程部署时各分片的调度进程使用其中以分片名命名的子目录
+STATE_DIR = None
 
 
 # Password validation
@@ -9,4 +9,8 @@ urlpatterns = [
     re_path(r'^logger/', include('logger.urls')),
     re_path(r'^main_machine/', include('main_machine.urls')),
     re_path(r'^slave/', include('slave.urls')),
+    # 指定楼宇的接口，不带楼宇号的接口属于默认楼宇
+    re_path(r'^buildings/(?P<building_id>\w+)/logger/', include('logger.urls')),
+    re_path(r'^buildings/(?P<building_id>\w+)/main_machine/', include('main_machine.urls')),
+    re_path(r'^buildings/(?P<building_id>\w+)/slave/', include('slave.urls')),
 ]
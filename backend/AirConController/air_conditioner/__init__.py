@@ -2,3 +2,4 @@
 中央空调控制系统
 """
 
+default_app_config = 'air_conditioner.apps.AirConditionerConfig'
@@ -1,5 +1,22 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """设置了SQLITE_WAL时SQLite使用WAL日志模式，读事务不阻塞写入"""
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
 
 
 class AirConditionerConfig(AppConfig):
     name = 'air_conditioner'
+
+    def ready(self):
+        if getattr(settings, 'SQLITE_WAL', False):
+            connection_created.connect(enable_sqlite_wal)
+        from utils import DBFacade
+        from .rollup import update_rollups
+        DBFacade.add_listener(update_rollups)
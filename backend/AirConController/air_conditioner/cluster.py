@@ -0,0 +1,337 @@
+"""
+多进程部署
+
+房间按settings.SCHEDULER_SHARDS划分为若干调度分片，每个分片由一个工作进程通过CLUSTER_DIR/shards/<分片名>/leader.lock
+选出的调度进程负责：持有该分片的房间和服务队列、执行定时任务，每发布一个新的状态快照便原子地替换该分片的共享状态文件，
+并在该分片的Unix域套接字上接收其他进程转发的请求。调度进程退出后锁自动释放，尚未负责分片的进程定期重试，
+当选后重新加载该分片的房间，并由Controller按状态日志恢复该分片的状态。
+
+持有CLUSTER_DIR/leader.lock的进程同时负责协调：合并各分片的快照，以统一的版本号发布全楼的快照到CLUSTER_DIR/status。
+所有进程定期检查全楼的共享状态文件，将其中的快照作为本进程读取和订阅的快照
+"""
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from utils import logger, CLUSTER_POLL_INTERVAL
+from .entity import MasterMachine, StatusPublisher, StatusSnapshot
+from .service import AirConditionerServiceQueue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SharedStatus:
+    """
+    共享状态文件
+
+    写入方先写临时文件再替换，读取方不会读到写了一半的文件；读取方按文件的inode和修改时间缓存上一次读取的结果
+
+    Attributes:
+        __path: 文件路径
+        __key: 上一次读取时文件的(inode, 修改时间, 大小)
+        __value: 上一次读取的(主控机是否已启动, 状态快照)
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__key = None
+        self.__value = (False, None)
+
+    def write(self, started: bool, snapshot: Optional[StatusSnapshot]):
+        """写入失败时只记录日志，不影响调度进程的定时任务"""
+        temp = self.__path + '.' + str(os.getpid())
+        try:
+            with open(temp, 'wb') as file:
+                pickle.dump((started, snapshot), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, self.__path)
+        except OSError as error:
+            logger.error('写入共享状态失败: ' + str(error))
+
+    def read(self):
+        """
+        Returns:
+            (主控机是否已启动, 状态快照, 文件是否在上一次读取后变化)
+        """
+        try:
+            stat = os.stat(self.__path)
+        except FileNotFoundError:
+            return self.__value + (False,)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self.__key:
+            return self.__value + (False,)
+        try:
+            with open(self.__path, 'rb') as file:
+                self.__value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError) as error:
+            logger.error('读取共享状态失败: ' + str(error))
+            return self.__value + (False,)
+        self.__key = key
+        return self.__value + (True,)
+
+
+class ShardMap:
+    """
+    房间到调度分片的划分
+
+    房间属于房间号前缀最长匹配的分片，不匹配任何前缀的房间属于第一个分片
+
+    Attributes:
+        names: 分片名的list
+        __prefixes: (房间号前缀, 分片名)的list，按前缀长度降序排列
+        __capacities: 分片名到服务队列容量
+    """
+
+    def __init__(self, shards: Optional[Dict[str, Dict]]):
+        """
+        Args:
+            shards: 分片名到{'prefixes': 房间号前缀的tuple, 'capacity': 服务队列容量}的dict，为None时只有一个分片
+        """
+        shards = shards or {'default': {}}
+        self.names = list(shards)
+        self.__prefixes = sorted(((prefix, name) for name, shard in shards.items()
+                                  for prefix in shard.get('prefixes', ())), key=lambda item: -len(item[0]))
+        self.__capacities = {name: shard.get('capacity') for name, shard in shards.items()}
+
+    def shard_of(self, room_id: str) -> str:
+        for prefix, name in self.__prefixes:
+            if room_id.startswith(prefix):
+                return name
+        return self.names[0]
+
+    def capacity(self, name: str) -> Optional[int]:
+        return self.__capacities[name]
+
+
+class Cluster:
+    """
+    多进程部署中本进程的角色
+
+    Attributes:
+        shards: 房间到调度分片的划分
+        shard: 本进程负责调度的分片名，不负责任何分片时为None
+        __directory: 存放锁文件、共享状态文件和套接字的目录
+        __execute: 在本进程处理请求的函数
+        __elected: 本进程当选为分片的调度进程后、开始接收转发请求前调用的函数，参数为分片名
+        __authkey: 转发连接的认证密钥
+        __locks: 本进程持有的锁文件，在进程存续期间保持打开，进程退出时锁自动释放
+        __shard_status: 本进程负责的分片的共享状态文件
+        __shard_started: 本进程负责的分片是否已启动
+        __shard_snapshot: 本进程负责的分片最近发布的快照
+        __building: 全楼的共享状态文件
+        __started: 全楼是否已启动
+        __snapshot: 最近读取的全楼快照
+        __local: 各线程到各分片调度进程的连接
+        __scatter: 并发转发请求的线程池
+    """
+
+    def __init__(self, directory: str, shards: ShardMap, execute: Callable, elected: Callable[[str], None]):
+        """
+        Args:
+            directory: 存放锁文件、共享状态文件和套接字的目录
+            shards: 房间到调度分片的划分
+            execute: 在本进程处理请求的函数
+            elected: 本进程当选为分片的调度进程后、开始接收转发请求前调用的函数，参数为分片名
+        """
+        if fcntl is None:
+            logger.error('当前平台不支持多进程部署')
+            raise RuntimeError('当前平台不支持多进程部署')
+        self.shards = shards
+        self.shard = None
+        self.__directory = directory
+        self.__execute = execute
+        self.__elected = elected
+        self.__authkey = settings.SECRET_KEY.encode()
+        self.__locks = []
+        self.__building = SharedStatus(os.path.join(directory, 'status'))
+        self.__started = False
+        self.__snapshot = None
+        self.__local = threading.local()
+        self.__scatter = ThreadPoolExecutor(len(shards.names), thread_name_prefix='ClusterScatter')
+
+    def start(self):
+        """竞选分片调度进程，并开始跟随全楼的共享状态"""
+        self.__elect()
+        # 本进程的状态读取只使用全楼的快照，读到第一个全楼快照前报告主控机未启动
+        MasterMachine.instance().follow()
+        threading.Thread(target=self.__follow, name='ClusterFollower', daemon=True).start()
+
+    def __elect(self) -> bool:
+        """
+        尝试成为某个没有调度进程的分片的调度进程，当选后只保留该分片的房间并开始接收转发请求
+
+        Returns:
+            是否当选
+        """
+        for name in self.shards.names:
+            if self.__try_lock(self.__shard_path(name, 'leader.lock')):
+                break
+        else:
+            return False
+        master_machine = MasterMachine.instance()
+        # 接管已退出的调度进程的分片时重新加载，包括运行期间新增的房间
+        master_machine.rooms.load()
+        master_machine.rooms.retain(lambda room_id: self.shards.shard_of(room_id) == name)
+        if self.shards.capacity(name) is not None:
+            AirConditionerServiceQueue.instance().capacity = self.shards.capacity(name)
+        self.__shard_status = SharedStatus(self.__shard_path(name, 'status'))
+        self.__shard_started = False
+        self.__shard_snapshot = None
+        self.__shard_status.write(False, None)
+        master_machine.add_publish_listener(self.__share)
+        self.__elected(name)
+        self.shard = name
+        self.__serve()
+        logger.info('进程' + str(os.getpid()) + '当选为分片' + name + '的调度进程')
+        return True
+
+    def __shard_path(self, name: str, filename: str) -> str:
+        path = os.path.join(self.__directory, 'shards', name)
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, filename)
+
+    def __try_lock(self, path: str) -> bool:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.__locks.append(lock_file)
+        return True
+
+    @property
+    def started(self) -> bool:
+        """全楼是否已启动，在读到第一个全楼快照前为False"""
+        return self.__started and self.__snapshot is not None
+
+    def set_started(self, started: bool):
+        """分片调度进程中记录本分片启停并共享"""
+        self.__shard_started = started
+        self.__shard_status.write(started, self.__shard_snapshot)
+
+    def __share(self, snapshot: StatusSnapshot):
+        """分片调度进程的快照发布监听器，共享新发布的快照"""
+        self.__shard_snapshot = snapshot
+        self.__shard_status.write(self.__shard_started, snapshot)
+
+    def __follow(self):
+        master_machine = MasterMachine.instance()
+        coordinate = None
+        while True:
+            if self.shard is None:
+                self.__elect()
+            if coordinate is None and self.__try_lock(os.path.join(self.__directory, 'leader.lock')):
+                coordinate = self.__coordinator()
+                logger.info('进程' + str(os.getpid()) + '负责合并各分片的快照')
+            if coordinate is not None:
+                coordinate()
+            started, snapshot, changed = self.__building.read()
+            if changed:
+                self.__started = started
+                if snapshot is not None:
+                    master_machine.mirror(snapshot)
+                    self.__snapshot = snapshot
+            time.sleep(CLUSTER_POLL_INTERVAL)
+
+    def __coordinator(self) -> Callable:
+        """返回合并各分片快照并发布全楼快照的函数，在各分片的快照变化时发布"""
+        readers = [SharedStatus(self.__shard_path(name, 'status')) for name in self.shards.names]
+        publisher = StatusPublisher()
+
+        def coordinate():
+            parts = [reader.read() for reader in readers]
+            if not any(changed for _, _, changed in parts):
+                return
+            snapshot = publisher.publish(
+                lambda: [dict(room) for _, part, _ in parts if part is not None for room in part.status])
+            self.__building.write(all(started for started, _, _ in parts), snapshot)
+
+        return coordinate
+
+    def __serve(self):
+        address = self.__shard_path(self.shard, 'scheduler.sock')
+        if os.path.exists(address):
+            os.unlink(address)
+        listener = Listener(address, 'AF_UNIX', authkey=self.__authkey)
+
+        def handle(connection):
+            with connection:
+                while True:
+                    try:
+                        kwargs = connection.recv()
+                    except (EOFError, OSError):
+                        return
+                    try:
+                        reply = ('OK', self.__execute(**kwargs))
+                    except Exception as error:
+                        if not isinstance(error, RuntimeError):
+                            logger.exception('处理转发请求失败')
+                        reply = ('ERROR', str(error))
+                    try:
+                        connection.send(reply)
+                    except (EOFError, OSError):
+                        return
+                    except Exception as error:
+                        # 结果无法序列化时先于写入失败，连接仍可用
+                        logger.exception('转发请求的结果无法发送')
+                        connection.send(('ERROR', '处理结果无法发送: ' + str(error)))
+
+        def accept():
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as error:
+                    logger.error('接受转发连接失败: ' + str(error))
+                    continue
+                threading.Thread(target=handle, args=(connection,), name='ClusterConnection', daemon=True).start()
+
+        threading.Thread(target=accept, name='ClusterListener', daemon=True).start()
+
+    def forward(self, shard: str, kwargs: dict):
+        """
+        将请求交给分片的调度进程处理并等待结果，本进程负责该分片时直接处理
+
+        连接或发送请求失败时重连一次；请求发出后连接断开时不重发，以免调度进程已处理的请求被处理两次
+        """
+        if shard == self.shard:
+            return self.__execute(**kwargs)
+        connections = self.__local.__dict__.setdefault('connections', {})
+        for retry in (False, True):
+            connection = connections.get(shard)
+            try:
+                if connection is None:
+                    connection = Client(self.__shard_path(shard, 'scheduler.sock'), 'AF_UNIX',
+                                        authkey=self.__authkey)
+                    connections[shard] = connection
+                connection.send(kwargs)
+                break
+            except (EOFError, OSError) as error:
+                connections.pop(shard, None)
+                if retry:
+                    logger.error('分片' + shard + '的调度进程不可用: ' + str(error))
+                    raise RuntimeError('分片' + shard + '的调度进程不可用')
+        try:
+            status, result = connection.recv()
+        except (EOFError, OSError) as error:
+            connections.pop(shard, None)
+            logger.error('分片' + shard + '的调度进程在返回结果前断开: ' + str(error))
+            raise RuntimeError('分片' + shard + '的调度进程在返回结果前断开，请求可能已处理')
+        if status != 'OK':
+            logger.error(result)
+            raise RuntimeError(result)
+        return result
+
+    def scatter(self, requests: List[Tuple[str, dict]]) -> List:
+        """并发地将各请求交给对应分片处理，按请求的顺序返回结果，任一请求失败时抛出其异常"""
+        futures = [self.__scatter.submit(self.forward, shard, kwargs) for shard, kwargs in requests]
+        return [future.result() for future in futures]
@@ -1,25 +1,60 @@
+import os
 import threading
+from typing import List, Tuple
 
-from utils import logger
+from django.conf import settings
+
+from utils import logger, LONG_POLL_TIMEOUT, DEFAULT_BUILDING, BATCH_MAX_COMMANDS, buildings
+from . import journal
+from .cluster import Cluster, ShardMap
+from .entity import BuildingReportFile, BuildingReport
 from .service import (
     AdministratorService, GetFeeService, DetailService,
     InvoiceService, ReportService, PowerService,
-    ChangeTempAndSpeedService, UpdateService)
+    ChangeTempAndSpeedService, UpdateService, Scheduler)
 
 
 class Controller:
     """
     控制器类
 
-    负责将接收到的请求转发至对应的处理模块
+    负责将接收到的请求转发至对应楼宇的处理模块。
+    修改状态的请求作为消息提交给所有楼宇共用的调度线程，与定时任务顺序执行，请求线程等待执行结果；
+    只读请求在请求线程中读取已发布的状态快照或数据库。
+    设置了CLUSTER_DIR时，状态快照的读取和详单导出在本进程处理，打印详单只向分片获取入住时间段，主控机的开机、设置参数、启动和停机发给所有分片，
+    多个房间的报表由各分片分别统计后合并，其余请求交给房间所在分片的调度进程，此时只支持默认楼宇。
+    设置了STATE_DIR时，修改状态的请求和定时任务执行后在调度线程中记录楼宇的状态，初始化时由记录恢复。
+    批量请求中的各条命令在调度线程的同一条消息中依次处理，处理完后统一调度等待队列、发布状态快照和记录状态
     """
 
+    # 可能修改状态的服务
+    MUTATING_SERVICES = ('ADMINISTRATOR', 'SLAVE', 'POWER')
+    # 管理服务中的只读操作
+    READ_OPERATIONS = ('get status', 'get status snapshot', 'subscribe status')
+    # 多进程部署时发给所有分片的管理操作
+    BROADCAST_OPERATIONS = ('power on', 'set param', 'start', 'stop')
+    # 批量请求中数值参数的类型，与单条请求的视图一样转换
+    NUMERIC_FIELDS = {'current_temp': float, 'target_temp': float, 'target_speed': int, 'temp_low_limit': float,
+                      'temp_high_limit': float, 'default_target_temp': float, 'default_speed': int}
+
     __instance_lock = threading.Lock()
 
     def __init__(self):
         """初始化Controller"""
-        self.__started = False
-        self.__update_service = UpdateService.instance()
+        self.__started = set()
+        self.__scheduler = Scheduler.instance()
+        self.__cluster = None
+        self.__journal = None
+        if getattr(settings, 'CLUSTER_DIR', None):
+            if set(buildings()) != {DEFAULT_BUILDING}:
+                logger.error('多进程部署只支持默认楼宇')
+                raise RuntimeError('多进程部署只支持默认楼宇')
+            self.__cluster = Cluster(settings.CLUSTER_DIR, ShardMap(getattr(settings, 'SCHEDULER_SHARDS', None)),
+                                     self.__execute, self.__elected)
+            self.__cluster.start()
+            AdministratorService.instance().init_master_machine()
+        elif getattr(settings, 'STATE_DIR', None):
+            self.__open_journal(settings.STATE_DIR)
         logger.info('初始化Controller')
 
     @classmethod
@@ -31,6 +66,49 @@ class Controller:
                     cls._instance = cls()
         return cls._instance
 
+    def __elected(self, shard: str):
+        """
+        本进程当选为分片的调度进程，包括接管已退出的调度进程的分片时，由该分片的状态日志恢复状态；
+        未设置STATE_DIR时分片从未启动的状态开始，需重新开机、设置参数并启动
+        """
+        if getattr(settings, 'STATE_DIR', None):
+            self.__open_journal(os.path.join(settings.STATE_DIR, shard))
+
+    def __open_journal(self, directory: str):
+        """加载状态日志并恢复各楼宇，此后在调度线程中记录各楼宇的状态"""
+        self.__journal = journal.Journal(directory)
+        self.__scheduler.actor.call(self.__restore)
+        self.__scheduler.add_listener(self.__record)
+
+    def __restore(self):
+        """由状态日志恢复各楼宇，恢复后写入新的快照"""
+        for building_id, state in list(self.__journal.states.items()):
+            if building_id not in buildings():
+                logger.warning('楼宇' + building_id + '已不存在，不恢复其状态')
+                continue
+            AdministratorService.instance(building_id).init_master_machine()
+            if journal.restore(building_id, state):
+                self.__started.add(building_id)
+                UpdateService.instance(building_id).start()
+                if self.__cluster is not None:
+                    self.__cluster.set_started(True)
+                UpdateService.instance(building_id).publish_status()
+            self.__record(building_id)
+        self.__journal.checkpoint()
+
+    def __record(self, building_id: str):
+        """在调度线程中记录楼宇的状态"""
+        self.__journal.record(building_id, journal.capture(building_id, building_id in self.__started))
+
+    @property
+    def started(self):
+        """默认楼宇的主控机是否已启动"""
+        return self.is_started(DEFAULT_BUILDING)
+
+    def is_started(self, building_id: str) -> bool:
+        """楼宇的主控机是否已启动，多进程部署时本进程负责的分片或全楼已启动即为已启动"""
+        return building_id in self.__started or (self.__cluster is not None and self.__cluster.started)
+
     def dispatch(self, **kwargs):
         """
         处理来自视图的请求
@@ -44,7 +122,141 @@ class Controller:
                 'INVOICE': 账单服务
                 'POWER': 从机开关机服务
                 'REPORT': 报表服务
+            building_id: 楼宇号，缺省时为默认楼宇
+        """
+        building_id = kwargs.setdefault('building_id', DEFAULT_BUILDING)
+        if building_id not in buildings():
+            logger.error('楼宇不存在')
+            raise RuntimeError('楼宇不存在')
+        if self.__cluster is not None:
+            return self.__route(**kwargs)
+        return self.__execute(**kwargs)
+
+    def __route(self, **kwargs):
+        """多进程部署时将请求交给本进程或相应分片的调度进程处理"""
+        service_type, operation = kwargs.get('service'), kwargs.get('operation')
+        if (service_type == 'ADMINISTRATOR' and operation in self.READ_OPERATIONS) or service_type == 'GET_FEE' \
+                or (service_type == 'DETAIL' and operation == 'export detail'):
+            return self.__execute(**kwargs)
+        shards = self.__cluster.shards
+        if service_type == 'ADMINISTRATOR' and operation in self.BROADCAST_OPERATIONS:
+            return self.__cluster.scatter([(shard, kwargs) for shard in shards.names])[0]
+        if service_type == 'REPORT' and operation in ('query building report', 'print building report'):
+            room_ids = kwargs.get('room_ids')
+            if room_ids is None:
+                snapshot = self.__execute(service='ADMINISTRATOR', operation='get status snapshot')
+                room_ids = [room['room_id'] for room in snapshot.status]
+            groups = {shard: [] for shard in shards.names}
+            for room_id in room_ids:
+                groups[shards.shard_of(room_id)].append(room_id)
+            parts = self.__cluster.scatter([(shard, dict(kwargs, operation='query building report', room_ids=ids,
+                                                          top=None)) for shard, ids in groups.items()])
+            report = BuildingReport.merge(parts, kwargs.get('top'), kwargs.get('order_by', 'fee'))
+            return report if operation == 'query building report' else BuildingReportFile(report)
+        room_id = kwargs.get('room_id')
+        if room_id is None:
+            logger.error('缺少参数room_id')
+            raise RuntimeError('缺少参数room_id')
+        if service_type == 'DETAIL' and operation == 'print detail':
+            # 只向分片获取入住时间段，详单文件在本进程由数据库逐块生成
+            stay_time = self.__cluster.forward(shards.shard_of(room_id), dict(kwargs, operation='get stay time'))
+            return self.__execute(**dict(kwargs, stay_time=stay_time))
+        return self.__cluster.forward(shards.shard_of(room_id), kwargs)
+
+    def __execute(self, **kwargs):
+        """在本进程处理请求"""
+        kwargs.setdefault('building_id', DEFAULT_BUILDING)
+        if self.__is_mutating(kwargs):
+            return self.__scheduler.actor.call(self.__dispatch, **kwargs)
+        return self.__dispatch(**kwargs)
+
+    def __is_mutating(self, kwargs: dict) -> bool:
+        return kwargs.get('service') in self.MUTATING_SERVICES and kwargs.get('operation') not in self.READ_OPERATIONS
+
+    def dispatch_batch(self, commands: List[dict], building_id: str = DEFAULT_BUILDING) -> List[Tuple[bool, object]]:
         """
+        批量处理修改状态的请求
+
+        各条命令按顺序处理，某条命令失败不影响其余命令。单进程部署时整批命令在调度线程的同一条消息中处理，
+        其间不执行定时任务，开机和改变风速产生的服务暂存而不立即放入队列，也不逐条发布状态快照和记录状态；
+        全部处理后统一调度一次(见UpdateService.flush())，再发布一次状态快照、记录一次状态，
+        因此开机命令返回的是调度前的房间状态。多进程部署时各条命令分别交给房间所在分片处理
+
+        Args:
+            commands: dispatch()的参数的list，service只能为'ADMINISTRATOR'、'SLAVE'或'POWER'且不能为只读操作，
+                命令中的building_id被忽略
+            building_id: 楼宇号
+
+        Returns:
+            与commands一一对应的(是否成功, 成功时为处理结果、失败时为错误信息)的list
+        """
+        if building_id not in buildings():
+            logger.error('楼宇不存在')
+            raise RuntimeError('楼宇不存在')
+        if len(commands) > BATCH_MAX_COMMANDS:
+            logger.error('批量请求的命令过多')
+            raise RuntimeError('批量请求的命令过多')
+        commands = [dict(command, building_id=building_id) for command in commands]
+        if self.__cluster is not None:
+            return [self.__try(self.__route, command) for command in commands]
+        return self.__scheduler.actor.call(self.__dispatch_batch, commands, building_id)
+
+    def __dispatch_batch(self, commands: List[dict], building_id: str) -> List[Tuple[bool, object]]:
+        """在调度线程中依次处理一批命令，最后统一调度、发布状态快照和记录状态"""
+        update_service = UpdateService.instance(building_id)
+        update_service.defer()
+        try:
+            return [self.__try(self.__handle, command) for command in commands]
+        finally:
+            update_service.flush()
+            self.__mutated(building_id)
+
+    def __try(self, handle, command: dict) -> Tuple[bool, object]:
+        """处理批量请求中的一条命令，命令的参数不合法时作为该命令的错误返回"""
+        if not self.__is_mutating(command):
+            return False, '批量请求不支持该操作'
+        try:
+            return True, handle(**self.__convert(command))
+        except (RuntimeError, TypeError, ValueError) as error:
+            if not isinstance(error, RuntimeError):
+                logger.error('批量请求的命令参数不合法: ' + str(error))
+            return False, str(error)
+
+    def __convert(self, command: dict) -> dict:
+        """在处理前转换命令中的数值参数，参数不是数值或数值字符串时抛出ValueError"""
+        command = dict(command)
+        for field, convert in self.NUMERIC_FIELDS.items():
+            if command.get(field) is not None:
+                command[field] = self.__to_number(field, command[field], convert)
+        if command.get('fee_rate') is not None:
+            if not isinstance(command['fee_rate'], list):
+                raise ValueError('参数fee_rate不合法')
+            command['fee_rate'] = tuple(self.__to_number('fee_rate', rate, float) for rate in command['fee_rate'])
+        return command
+
+    @staticmethod
+    def __to_number(field: str, value, convert):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError('参数' + field + '不合法')
+        try:
+            return convert(value)
+        except ValueError:
+            raise ValueError('参数' + field + '不合法')
+
+    def __dispatch(self, **kwargs):
+        result = self.__handle(**kwargs)
+        if self.__is_mutating(kwargs):
+            self.__mutated(kwargs['building_id'])
+        return result
+
+    def __mutated(self, building_id: str):
+        """修改状态的请求处理后立即发布状态快照，不必等到下一次定时任务；并记录楼宇的状态"""
+        if building_id in self.__started:
+            UpdateService.instance(building_id).publish_status()
+        if self.__journal is not None:
+            self.__record(building_id)
+
+    def __handle(self, **kwargs):
         service_type = kwargs.get('service')
         if service_type == 'ADMINISTRATOR':
             return self.__dispatch_administrator_service(**kwargs)
@@ -75,8 +287,12 @@ class Controller:
                 'start': 启动
                 'stop':  停机
                 'get status': 获取从机状态
+                'get status snapshot': 获取最近发布的从机状态快照
+                'subscribe status': 订阅从机状态变化
                 'check in': 入住
                 'check out': 退房
+                'add room': 新增房间
+                'remove room': 删除房间
 
             当operation为'set param'时，需提供以下参数:
             mode: 运行模式
@@ -85,10 +301,14 @@ class Controller:
             default_target_temp: 默认温度
             fee_rate: 阶梯费率的tuple
 
-            当operation为'check in'或'check out'时，需提供以下参数:
+            当operation为'check in'、'check out'、'add room'或'remove room'时，需提供以下参数:
             room_id: 房间号
+
+            当operation为'subscribe status'时，可提供以下参数:
+            room_id: 订阅的房间号，缺省时订阅所有房间
+            since: 客户端已有的快照版本号
         """
-        administrator_service = AdministratorService.instance()
+        administrator_service = AdministratorService.instance(kwargs['building_id'])
         operation = kwargs.get('operation')
         if operation == 'power on':
             administrator_service.init_master_machine()
@@ -99,19 +319,33 @@ class Controller:
             )
         elif operation == 'start':
             result = administrator_service.start_master_machine()
-            self.__started = True
+            self.__started.add(kwargs['building_id'])
+            if self.__cluster is not None and self.__cluster.shard is not None:
+                self.__cluster.set_started(True)
             return result
         elif operation == 'stop':
             administrator_service.stop_master_machine()
-            self.__started = False
+            self.__started.discard(kwargs['building_id'])
+            if self.__cluster is not None and self.__cluster.shard is not None:
+                self.__cluster.set_started(False)
         elif operation == 'get status':
             return administrator_service.get_status()
+        elif operation == 'get status snapshot':
+            return administrator_service.get_status_snapshot()
+        elif operation == 'subscribe status':
+            return administrator_service.subscribe_status(kwargs.get('room_id'), kwargs.get('since'))
         elif operation == 'check in':
             room_id = kwargs.get('room_id')
             return administrator_service.check_in(room_id)
         elif operation == 'check out':
             room_id = kwargs.get('room_id')
             return administrator_service.check_out(room_id)
+        elif operation == 'add room':
+            room_id = kwargs.get('room_id')
+            return administrator_service.add_room(room_id)
+        elif operation == 'remove room':
+            room_id = kwargs.get('room_id')
+            return administrator_service.remove_room(room_id)
         else:
             logger.error('不支持的操作')
             raise RuntimeError('不支持的操作')
@@ -134,11 +368,11 @@ class Controller:
             target_speed: 目标风速
 
         """
-        if not self.__started:
+        if not self.is_started(kwargs['building_id']):
             logger.error('主控机未启动')
             raise RuntimeError('主控机未启动')
         operation = kwargs.get('operation')
-        change_temp_and_speed_service = ChangeTempAndSpeedService.instance()
+        change_temp_and_speed_service = ChangeTempAndSpeedService.instance(kwargs['building_id'])
         room_id = kwargs.get('room_id')
         if room_id is None:
             logger.error('缺少参数room_id')
@@ -166,12 +400,12 @@ class Controller:
             当operation为'power off'时, 要提供的参数为:
             room_id: 要关闭的从机的房间号
         """
-        change_temp_and_speed_service = ChangeTempAndSpeedService.instance()
-        if not self.__started:
+        change_temp_and_speed_service = ChangeTempAndSpeedService.instance(kwargs['building_id'])
+        if not self.is_started(kwargs['building_id']):
             logger.error('主控机未启动')
             raise RuntimeError('主控机未启动')
         operation = kwargs.get('operation')
-        power_service = PowerService.instance()
+        power_service = PowerService.instance(kwargs['building_id'])
         room_id = kwargs.get('room_id')
         if room_id is None:
             logger.error('缺少参数room_id')
@@ -192,15 +426,20 @@ class Controller:
 
         Keyword Args:
             room_id: 要关闭的从机的房间号
+            version: 客户端已有的该房间状态的版本号，提供时等待状态变化后再返回(长轮询)
+            timeout: 长轮询的最长等待时间(秒)
         """
-        if not self.__started:
+        if not self.is_started(kwargs['building_id']):
             logger.error('主控机未启动')
             raise RuntimeError('主控机未启动')
-        get_fee_service = GetFeeService.instance()
+        get_fee_service = GetFeeService.instance(kwargs['building_id'])
         room_id = kwargs.get('room_id')
         if room_id is None:
             logger.error('缺少参数room_id')
             raise RuntimeError('缺少参数room_id')
+        version = kwargs.get('version')
+        if version is not None:
+            return get_fee_service.wait_fee(room_id, version, kwargs.get('timeout', LONG_POLL_TIMEOUT))
         return get_fee_service.get_current_fee(room_id)
 
     def __dispatch_detail_service(self, **kwargs):
@@ -211,13 +450,27 @@ class Controller:
             operation: 请求的操作, 可选值为:
                 'query detail': 查询详单
                 'print detail': 打印详单
+                'get stay time': 获取本次入住的入住时间和退房时间
+                'export detail': 导出时间段内一组房间的详单，只读取数据库，主控机未启动时也可导出
             room_id: 房间号
+
+            当operation为'print detail'时，可提供以下参数:
+            stay_time: 本次入住的入住时间和退房时间，多进程部署时由房间所在分片获取
+
+            当operation为'export detail'时，不需要room_id，需提供以下参数:
+            start_time: 起始时间
+            finish_time: 终止时间
+            fmt: 导出格式, 'csv'或'ndjson'
+            room_ids: 房间号的list，缺省时导出本楼宇的所有房间
         """
-        if not self.__started:
+        detail_service = DetailService.instance(kwargs['building_id'])
+        operation = kwargs.get('operation')
+        if operation == 'export detail':
+            return detail_service.export_detail(kwargs.get('start_time'), kwargs.get('finish_time'),
+                                                kwargs.get('fmt', 'csv'), kwargs.get('room_ids'))
+        if not self.is_started(kwargs['building_id']):
             logger.error('主控机未启动')
             raise RuntimeError('主控机未启动')
-        detail_service = DetailService.instance()
-        operation = kwargs.get('operation')
         room_id = kwargs.get('room_id')
         if room_id is None:
             logger.error('缺少参数room_id')
@@ -225,7 +478,9 @@ class Controller:
         if operation == 'query detail':
             return detail_service.get_detail(room_id)
         elif operation == 'print detail':
-            return detail_service.print_detail(room_id)
+            return detail_service.print_detail(room_id, kwargs.get('stay_time'))
+        elif operation == 'get stay time':
+            return detail_service.get_stay_time(room_id)
         else:
             logger.error('不支持的操作')
             raise RuntimeError('不支持的操作')
@@ -240,10 +495,10 @@ class Controller:
                 'print invoice': 打印账单
             room_id: 房间号
         """
-        if not self.__started:
+        if not self.is_started(kwargs['building_id']):
             logger.error('主控机未启动')
             raise RuntimeError('主控机未启动')
-        invoice_service = InvoiceService.instance()
+        invoice_service = InvoiceService.instance(kwargs['building_id'])
         operation = kwargs.get('operation')
         room_id = kwargs.get('room_id')
         if room_id is None:
@@ -265,6 +520,8 @@ class Controller:
             operation: 请求的操作, 可选值为:
                 'query report': 获得报表
                 'print report': 打印报表
+                'query building report': 获得多个房间的报表
+                'print building report': 打印多个房间的报表
             room_id: 房间号
             qtype: 查询报表的类型, 可选值为:
                 'day': 日报表
@@ -272,15 +529,26 @@ class Controller:
                 'month': 月报表
                 'year': 年报表
             date: 查询日期
+
+            当operation为'query building report'或'print building report'时，不需要room_id，可提供以下参数:
+            room_ids: 房间号的list，缺省时统计所有房间
+            top: 只保留排名前top的房间
+            order_by: 排名依据, 'fee'或'service_time'
         """
-        if not self.__started:
+        if not self.is_started(kwargs['building_id']):
             logger.error('主控机未启动')
             raise RuntimeError('主控机未启动')
-        report_service = ReportService.instance()
+        report_service = ReportService.instance(kwargs['building_id'])
         operation = kwargs.get('operation')
         room_id = kwargs.get('room_id')
         qtype = kwargs.get('qtype')
         date = kwargs.get('date')
+        if operation == 'query building report':
+            return report_service.get_building_report(kwargs.get('room_ids'), qtype, date, kwargs.get('top'),
+                                                      kwargs.get('order_by', 'fee'))
+        elif operation == 'print building report':
+            return report_service.print_building_report(kwargs.get('room_ids'), qtype, date, kwargs.get('top'),
+                                                        kwargs.get('order_by', 'fee'))
         if room_id is None:
             logger.error('缺少参数room_id')
             raise RuntimeError('缺少参数room_id')
@@ -0,0 +1,371 @@
+"""
+温控引擎
+
+VectorizedTickEngine将服务队列和等待队列中各房间的状态保存在连续的NumPy数组中，
+每个周期以批量数组运算完成所有房间的更新，并以布尔掩码选出到达目标温度和等待超时的服务对象。
+NumPy为可选依赖，未安装时UpdateService使用逐对象更新
+
+AnalyticEngine不按周期更新，读取时由(起始时刻, 起始状态, 速率)计算当前温度、费用和时长，
+并只在房间到达目标温度或等待超时的时刻触发一次事件
+"""
+import threading
+import time
+from typing import List, Optional, Dict, Union
+
+from utils import logger, master_machine_mode, UPDATE_FREQUENCY, TEMPERATURE_CHANGE_RATE_PER_SEC, DEFAULT_BUILDING, \
+    IndexedHeap
+from .entity import MasterMachine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class VectorizedTickEngine:
+    """
+    向量化温控引擎，每个楼宇一个
+
+    每个服务对象占用一个槽位，槽位释放后复用。
+    绑定期间，Room和AirConditionerService通过get/set读写对应槽位的数组元素
+
+    Attributes:
+        FIELDS: 按槽位保存的状态
+        __capacity: 数组容量
+        __size: 已分配过的最大槽位数
+        __free_slots: 可复用的槽位
+        __services: 槽位到服务对象的映射
+        __slots: 房间号到槽位的映射
+        __arrays: 状态名到数组的dict
+        __active: 槽位是否被占用
+        __serving: 槽位是否处于服务队列
+    """
+
+    FIELDS = ('current_temp', 'target_temp', 'fee', 'service_time', 'duration', 'wait_time',
+              'fee_since_start', 'fee_rate_per_sec', 'temp_rate')
+
+    __instance_lock = threading.Lock()
+    _instances = {}
+
+    def __init__(self, capacity: int = 1024):
+        if numpy is None:
+            logger.error('未安装numpy')
+            raise RuntimeError('未安装numpy')
+        self.__capacity = capacity
+        self.__size = 0
+        self.__free_slots = []  # type: List[int]
+        self.__services = [None] * capacity  # type: list
+        self.__slots = {}  # type: Dict[str, int]
+        self.__arrays = {field: numpy.zeros(capacity) for field in self.FIELDS}
+        self.__active = numpy.zeros(capacity, dtype=bool)
+        self.__serving = numpy.zeros(capacity, dtype=bool)
+        logger.info('初始化VectorizedTickEngine')
+
+    @classmethod
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
+            with cls.__instance_lock:
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls()
+        return cls._instances[building_id]
+
+    def __len__(self):
+        return len(self.__slots)
+
+    def __grow(self):
+        """容量翻倍"""
+        self.__arrays = {field: numpy.concatenate((array, numpy.zeros(self.__capacity)))
+                         for field, array in self.__arrays.items()}
+        self.__active = numpy.concatenate((self.__active, numpy.zeros(self.__capacity, dtype=bool)))
+        self.__serving = numpy.concatenate((self.__serving, numpy.zeros(self.__capacity, dtype=bool)))
+        self.__services.extend([None] * self.__capacity)
+        self.__capacity *= 2
+        logger.info('VectorizedTickEngine扩容至' + str(self.__capacity))
+
+    def get(self, slot: int, field: str) -> float:
+        return float(self.__arrays[field][slot])
+
+    def set(self, slot: int, field: str, value: float):
+        self.__arrays[field][slot] = value
+
+    def attach(self, service, serving: bool):
+        """
+        将服务对象及其房间的状态装入槽位
+
+        Args:
+            service: 服务对象
+            serving: True表示处于服务队列，False表示处于等待队列
+        """
+        self.detach(service)
+        if self.__free_slots:
+            slot = self.__free_slots.pop()
+        else:
+            if self.__size == self.__capacity:
+                self.__grow()
+            slot = self.__size
+            self.__size += 1
+        room = service.room
+        values = {
+            'current_temp': room.current_temp,
+            'target_temp': room.target_temp,
+            'fee': room.fee,
+            'service_time': room.service_time,
+            'duration': service.duration,
+            'wait_time': service.wait_time,
+            'fee_since_start': service.fee_since_start,
+            'fee_rate_per_sec': service.fee_rate_per_sec,
+            'temp_rate': TEMPERATURE_CHANGE_RATE_PER_SEC[service.target_speed],
+        }
+        for field, value in values.items():
+            self.__arrays[field][slot] = value
+        self.__active[slot] = True
+        self.__serving[slot] = serving
+        self.__services[slot] = service
+        self.__slots[room.room_id] = slot
+        room.bind(self, slot)
+        service.bind(self, slot)
+
+    def detach(self, service):
+        """将槽位中的状态写回服务对象及其房间，并释放槽位"""
+        slot = self.__slots.pop(service.room.room_id, None)
+        if slot is None:
+            return
+        service.room.bind(None, None)
+        service.bind(None, None)
+        self.__active[slot] = False
+        self.__services[slot] = None
+        self.__free_slots.append(slot)
+
+    def update_serving(self, mode, elapsed: float = UPDATE_FREQUENCY) -> list:
+        """
+        更新服务队列中所有对象的状态
+
+        Returns:
+            到达目标温度的服务对象
+        """
+        serving = self.__active & self.__serving
+        step = serving * elapsed
+        arrays = self.__arrays
+        arrays['duration'] += step
+        arrays['service_time'] += step
+        fee = arrays['fee_rate_per_sec'] * step
+        arrays['fee_since_start'] += fee
+        arrays['fee'] += fee
+        if mode == master_machine_mode.COOL:
+            arrays['current_temp'] -= arrays['temp_rate'] * step
+            reached = serving & (arrays['current_temp'] - arrays['target_temp'] < 0.001)
+        else:
+            arrays['current_temp'] += arrays['temp_rate'] * step
+            reached = serving & (arrays['current_temp'] - arrays['target_temp'] > 0.001)
+        return [self.__services[slot] for slot in numpy.flatnonzero(reached)]
+
+    def update_waiting(self, elapsed: float = UPDATE_FREQUENCY) -> list:
+        """
+        更新等待队列中所有对象的等待时长
+
+        Returns:
+            到达等待时间的服务对象
+        """
+        waiting = self.__active & ~self.__serving
+        self.__arrays['wait_time'] -= waiting * elapsed
+        timeout = waiting & (self.__arrays['wait_time'] <= 0)
+        return [self.__services[slot] for slot in numpy.flatnonzero(timeout)]
+
+
+class AnalyticEngine:
+    """
+    解析式温控引擎，每个楼宇一个
+
+    每个房间保存最近一次状态变化时刻(anchor)的状态，读取时按经过的时间解析计算，
+    写入时先将状态结算到当前时刻再修改。
+    服务中的房间以到达目标温度的时刻、等待中的房间以等待超时的时刻登记为事件
+
+    Attributes:
+        __master_machine: 主控机，用于取得制冷/制热模式
+        __tracks: 房间号到状态dict的映射
+        __reach_events: 到达目标温度事件堆
+        __timeout_events: 等待超时事件堆
+        __dirty: 服务队列出现空位，需要立即调度
+        wakeup: 事件时刻变化时设置，唤醒EventTimer，所有楼宇的引擎共用
+    """
+
+    __instance_lock = threading.Lock()
+    _instances = {}
+    wakeup = threading.Event()
+
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__master_machine = MasterMachine.instance(building_id)
+        self.__tracks = {}  # type: Dict[str, dict]
+        self.__reach_events = IndexedHeap()
+        self.__timeout_events = IndexedHeap()
+        self.__dirty = False
+        logger.info('初始化AnalyticEngine')
+
+    @classmethod
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
+            with cls.__instance_lock:
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
+
+    def __len__(self):
+        return len(self.__tracks)
+
+    def __direction(self) -> int:
+        return -1 if self.__master_machine.mode == master_machine_mode.COOL else 1
+
+    def __elapsed(self, track: dict, now: float) -> float:
+        """从anchor到now经过的时长，服务中的房间不超过到达目标温度的时刻"""
+        end = now if track['deadline'] is None else min(now, track['deadline'])
+        return max(end - track['anchor'], 0.0)
+
+    def __evaluate(self, track: dict, field: str, now: float) -> float:
+        value = track[field]
+        elapsed = self.__elapsed(track, now)
+        if track['serving']:
+            if field in ('duration', 'service_time'):
+                return value + elapsed
+            if field in ('fee', 'fee_since_start'):
+                return value + track['fee_rate_per_sec'] * elapsed
+            if field == 'current_temp':
+                return value + self.__direction() * track['temp_rate'] * elapsed
+        elif field == 'wait_time':
+            return value - elapsed
+        return value
+
+    def __schedule(self, slot: str, track: dict):
+        """按当前状态计算并登记下一次事件"""
+        if track['serving']:
+            # 与逐周期更新相同的判定阈值
+            if self.__direction() < 0:
+                gap = track['current_temp'] - track['target_temp'] - 0.001
+            else:
+                gap = track['target_temp'] + 0.001 - track['current_temp']
+            rate = track['temp_rate']
+            track['deadline'] = track['anchor'] + (max(gap, 0.0) / rate if rate > 0 else float('inf'))
+            self.__reach_events.push(slot, track['deadline'])
+        else:
+            track['deadline'] = None
+            self.__timeout_events.push(slot, track['anchor'] + track['wait_time'])
+        self.wakeup.set()
+
+    def __settle(self, track: dict, now: float):
+        """将状态结算到now并以now为新的anchor"""
+        for field in ('current_temp', 'fee', 'service_time', 'duration', 'wait_time', 'fee_since_start'):
+            track[field] = self.__evaluate(track, field, now)
+        track['anchor'] = now
+
+    def get(self, slot: str, field: str) -> float:
+        return self.__evaluate(self.__tracks[slot], field, time.monotonic())
+
+    def set(self, slot: str, field: str, value: float):
+        track = self.__tracks[slot]
+        self.__settle(track, time.monotonic())
+        track[field] = value
+        self.__schedule(slot, track)
+
+    def attach(self, service, serving: bool):
+        """
+        登记服务对象及其房间的状态
+
+        Args:
+            service: 服务对象
+            serving: True表示处于服务队列，False表示处于等待队列
+        """
+        self.detach(service)
+        room = service.room
+        slot = room.room_id
+        track = {
+            'anchor': time.monotonic(),
+            'deadline': None,
+            'serving': serving,
+            'current_temp': room.current_temp,
+            'target_temp': room.target_temp,
+            'fee': room.fee,
+            'service_time': room.service_time,
+            'duration': service.duration,
+            'wait_time': service.wait_time,
+            'fee_since_start': service.fee_since_start,
+            'fee_rate_per_sec': service.fee_rate_per_sec,
+            'temp_rate': TEMPERATURE_CHANGE_RATE_PER_SEC[service.target_speed],
+            'service': service,
+        }
+        self.__tracks[slot] = track
+        self.__schedule(slot, track)
+        room.bind(self, slot)
+        service.bind(self, slot)
+
+    def detach(self, service):
+        """将结算后的状态写回服务对象及其房间，并取消其事件"""
+        slot = service.room.room_id
+        track = self.__tracks.get(slot)
+        if track is None:
+            return
+        service.room.bind(None, None)
+        service.bind(None, None)
+        del self.__tracks[slot]
+        self.__reach_events.remove(slot)
+        self.__timeout_events.remove(slot)
+        if track['serving']:
+            # 服务队列出现空位，需立即调度等待队列
+            self.__dirty = True
+            self.wakeup.set()
+
+    def next_deadline(self) -> Optional[float]:
+        """下一次事件的时刻，没有事件时返回None"""
+        if self.__dirty:
+            return time.monotonic()
+        deadlines = [deadline for deadline in (self.__reach_events.peek_priority(),
+                                               self.__timeout_events.peek_priority()) if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    @staticmethod
+    def __pop_due(events: IndexedHeap, now: float) -> List[str]:
+        slots = []
+        while len(events) != 0 and events.peek_priority() <= now:
+            slots.append(events.pop())
+        return slots
+
+    def update_serving(self, mode, elapsed: float = UPDATE_FREQUENCY) -> list:
+        """
+        取出已到达目标温度的服务对象
+
+        Returns:
+            到达目标温度的服务对象
+        """
+        self.__dirty = False
+        return [self.__tracks[slot]['service'] for slot in self.__pop_due(self.__reach_events, time.monotonic())]
+
+    def update_waiting(self, elapsed: float = UPDATE_FREQUENCY) -> list:
+        """
+        取出已到达等待时间的服务对象
+
+        Returns:
+            到达等待时间的服务对象
+        """
+        return [self.__tracks[slot]['service'] for slot in self.__pop_due(self.__timeout_events, time.monotonic())]
+
+
+def get_engine(name: Optional[str], building_id: str = DEFAULT_BUILDING) \
+        -> Optional[Union[VectorizedTickEngine, AnalyticEngine]]:
+    """
+    按配置取得楼宇的温控引擎
+
+    Args:
+        name: 'vectorized'表示使用VectorizedTickEngine，'analytic'表示使用AnalyticEngine，其余值表示逐对象更新
+        building_id: 楼宇号
+
+    Returns:
+        温控引擎，逐对象更新或未安装numpy时返回None
+    """
+    if name == 'analytic':
+        return AnalyticEngine.instance(building_id)
+    if name == 'vectorized':
+        if numpy is None:
+            logger.warning('未安装numpy，使用逐对象更新')
+            return None
+        return VectorizedTickEngine.instance(building_id)
+    return None
@@ -1,17 +1,34 @@
 """实体类"""
+import bisect
+import csv
 import datetime
+import io
+import json
+import os
 import threading
-from typing import List, Dict, Optional
+import time
+import types
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Iterable, List, Dict, Optional, Tuple
 
-from air_conditioner.models import DetailModel, Log
-from utils import master_machine_mode, master_machine_status, room_status, logger, room_ids, operations, DBFacade
+from django.conf import settings
+from django.db.models import Q
+
+from air_conditioner import rollup
+from air_conditioner.models import DetailModel, Log, RoomModel
+from utils import master_machine_mode, master_machine_status, room_status, logger, room_ids, DBFacade, \
+    REPORT_CACHE_SIZE, EXPORT_CHUNK_SIZE, UPDATE_FREQUENCY, EVENT_HEARTBEAT_INTERVAL, DEFAULT_BUILDING, EventBroker, \
+    Subscription, buildings
 
 
 class MasterMachine:
     """
-    主控机
+    主控机，每个楼宇一个
 
     Attributes:
+        __building_id:      楼宇号
         __mode:             工作模式
         __status:           工作状态
         __start_time:       开机时间，在start()方法里设置
@@ -21,13 +38,19 @@ class MasterMachine:
         __default_speed:     默认风速
         __speed:            工作风速
         __fee_rate:         费率，tuple类型，对应每一级风速的费用
-        __room_list:        房间列表
+        __rooms:            房间注册表
+        __publisher:        由本主控机的从机状态发布快照
+        __view:             读取状态快照和订阅状态变化的来源，多进程部署时为其他进程发布的快照，否则为__publisher
+        __actor:            调度线程，设置后过期的快照只在调度线程中重新发布
     """
 
     __instance_lock = threading.Lock()
 
-    def __init__(self):
+    _instances = {}
+
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
         """初始化主控机"""
+        self.__building_id = building_id
         self.__mode = master_machine_mode.NOT_SET
         self.__status = master_machine_status.STANDBY
         self.__start_time = None
@@ -37,17 +60,25 @@ class MasterMachine:
         self.__default_speed = None
         self.__speed = None
         self.__fee_rate = None
-        self.__room_list = []
-        logger.info('初始化主控机')
+        self.__rooms = RoomRegistry(building_id)
+        self.__rooms.load()
+        self.__publisher = StatusPublisher()
+        self.__view = self.__publisher
+        self.__actor = None
+        logger.info('初始化楼宇' + building_id + '的主控机')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
+
+    @property
+    def building_id(self):
+        return self.__building_id
 
     def set_param(self, mode: str, temp_low_limit: float, temp_high_limit: float,
                   default_target_temp: float, default_speed: int, fee_rate: tuple) -> None:
@@ -69,8 +100,10 @@ class MasterMachine:
         self.__default_speed = default_speed
         self.__speed = default_speed
         self.__fee_rate = fee_rate
-        for _ in room_ids:
-            self.__room_list.append(Room(_, self.default_target_temp, self.default_speed))
+        for room in self.__rooms:
+            if room.status == room_status.AVAILABLE:
+                room.target_temp = default_target_temp
+                room.current_speed = default_speed
         logger.info('设置主控机参数为: mode=' + self.__mode + ' temp_low_limit=' + str(self.__temp_low_limit) +
                     ' temp_high_limit=' + str(self.__temp_high_limit) + ' default_target_temp=' +
                     str(self.__default_target_temp) + ' default_speed=' + str(self.__default_speed) +
@@ -112,11 +145,71 @@ class MasterMachine:
     def fee_rate(self):
         return self.__fee_rate
 
+    @property
+    def rooms(self):
+        return self.__rooms
+
+    def state(self) -> dict:
+        """主控机的运行参数，用于状态快照"""
+        return {
+            'mode': self.__mode,
+            'status': self.__status,
+            'start_time': self.__start_time,
+            'temp_low_limit': self.__temp_low_limit,
+            'temp_high_limit': self.__temp_high_limit,
+            'default_target_temp': self.__default_target_temp,
+            'default_speed': self.__default_speed,
+            'speed': self.__speed,
+            'fee_rate': self.__fee_rate,
+        }
+
+    def restore(self, state: dict, rooms: Iterable[tuple]):
+        """
+        由状态快照恢复主控机
+
+        Args:
+            state: state()的结果
+            rooms: 各房间Room.state()的结果，不在房间注册表中的房间被忽略
+        """
+        self.__mode = state['mode']
+        self.__status = state['status']
+        self.__start_time = state['start_time']
+        self.__temp_low_limit = state['temp_low_limit']
+        self.__temp_high_limit = state['temp_high_limit']
+        self.__default_target_temp = state['default_target_temp']
+        self.__default_speed = state['default_speed']
+        self.__speed = state['speed']
+        self.__fee_rate = state['fee_rate']
+        for room_state in rooms:
+            room = self.__rooms.get(room_state[0])
+            if room is not None:
+                room.restore(room_state)
+        logger.info('楼宇' + self.__building_id + '由状态快照恢复')
+
     def get_room(self, room_id):
-        if room_id not in room_ids:
+        room = self.__rooms.get(room_id)
+        if room is None:
             logger.error('房间号不存在')
             raise RuntimeError('房间号不存在')
-        return self.__room_list[room_ids.index(room_id)]
+        return room
+
+    def add_room(self, room_id: str):
+        """新增房间"""
+        if not room_id or len(room_id) > 16:
+            logger.error('房间号不合法')
+            raise RuntimeError('房间号不合法')
+        if self.__rooms.get(room_id) is not None:
+            logger.error('房间号已存在')
+            raise RuntimeError('房间号已存在')
+        self.__rooms.add(Room(room_id, self.__default_target_temp, self.__default_speed))
+
+    def remove_room(self, room_id: str):
+        """删除房间"""
+        room = self.get_room(room_id)
+        if room.status != room_status.AVAILABLE:
+            logger.error('需先退房才能删除房间')
+            raise RuntimeError('需先退房才能删除房间')
+        self.__rooms.remove(room_id)
 
     def start(self) -> dict:
         """启动主控机"""
@@ -131,7 +224,7 @@ class MasterMachine:
     def stop(self) -> None:
         """关闭主控机"""
         self.__status = master_machine_status.STOPPED
-        for room in self.__room_list:
+        for room in self.__rooms:
             room.status = room_status.CLOSED
         logger.info('主控机关机')
 
@@ -141,42 +234,104 @@ class MasterMachine:
         if room.status != room_status.AVAILABLE:
             logger.error('需先退房')
             raise RuntimeError('需先退房')
-        details = DBFacade.exec(DetailModel.objects.filter, room_id=room_id, start_time__gte=room.check_in_time,
-                                finish_time__lte=room.check_out_time)
-        return room.check_in_time, [Detail(d.detail_id, d.room_id, d.start_time, d.finish_time, d.speed, d.fee_rate,
-                                           d.fee) for d in details]
+        return room.check_in_time, list(self.__settle(room).details)
 
     def get_invoice(self, room_id: str):
         """获取指定房间的账单"""
         room = self.get_room(room_id)
-        details = self.get_detail(room_id)[1]
-        details.sort(key=lambda x: x.start_time)
-        total_fee = 0
-        for detail in details:
-            total_fee += detail.fee
-        return Invoice(room_id, room.check_in_time, room.check_out_time, round(total_fee, 2))
+        if room.status != room_status.AVAILABLE:
+            logger.error('需先退房')
+            raise RuntimeError('需先退房')
+        return Invoice(room_id, room.check_in_time, room.check_out_time, round(self.__settle(room).total_fee, 2))
+
+    @staticmethod
+    def __settle(room):
+        """取得房间本次入住的结算，尚未结算时写入排队中的详单后查询详单"""
+        if room.stay is None:
+            DBFacade.flush()
+            details = DBFacade.query(DetailModel.objects.filter, room_id=room.room_id,
+                                     start_time__gte=room.check_in_time, finish_time__lte=room.check_out_time)
+            room.stay = Stay([Detail(d.detail_id, d.room_id, d.start_time, d.finish_time, d.speed, d.fee_rate,
+                                     d.fee) for d in details])
+        return room.stay
+
+    def get_stay_time(self, room_id: str) -> Tuple[datetime.datetime, datetime.datetime]:
+        """获取指定房间本次入住的入住时间和退房时间"""
+        room = self.get_room(room_id)
+        if room.status != room_status.AVAILABLE:
+            logger.error('需先退房')
+            raise RuntimeError('需先退房')
+        return room.check_in_time, room.check_out_time
+
+    @staticmethod
+    def stream_detail(room_id: str, check_in_time: datetime.datetime, check_out_time: datetime.datetime):
+        """
+        逐块查询指定房间一次入住的详单，用于导出详单文件
+
+        与get_detail不同，不结算也不在内存中保留整次入住的详单，只读取数据库，可以在任一进程中执行
+
+        Returns:
+            按起始时间排序的详单的生成器，按(起始时间, 详单号)的键集分页，每次查询EXPORT_CHUNK_SIZE条
+        """
+        # 退房前的详单可能仍在写入队列中
+        DBFacade.flush()
+        after = None
+        while True:
+            queryset = DetailModel.objects.filter(room_id=room_id, start_time__gte=check_in_time,
+                                                  finish_time__lte=check_out_time)
+            if after is not None:
+                start_time, detail_id = after
+                queryset = queryset.filter(Q(start_time__gt=start_time) |
+                                           Q(start_time=start_time, detail_id__gt=detail_id))
+            rows = DBFacade.query(lambda: queryset.order_by('start_time', 'detail_id')[:EXPORT_CHUNK_SIZE])
+            if len(rows) == 0:
+                return
+            for d in rows:
+                yield Detail(d.detail_id, d.room_id, d.start_time, d.finish_time, d.speed, d.fee_rate, d.fee)
+            after = (rows[-1].start_time, rows[-1].detail_id)
 
     def get_report(self, room_id: str, start_time: datetime.datetime, finish_time: datetime.datetime):
-        """获取指定房间的报表"""
-        details = DBFacade.exec(DetailModel.objects.filter, room_id=room_id, start_time__gte=start_time,
-                                finish_time__lte=finish_time)
-        logs = DBFacade.exec(Log.objects.filter, room_id=room_id, op_time__gte=start_time, op_time__lte=finish_time)
-        duration = 0
-        fee = 0.0
-        for d in details:
-            duration += (d.finish_time - d.start_time).seconds
-            fee += d.fee
-        times_of_on_off = 0
-        times_of_dispatch = 0
-        times_of_change_temp = 0
-        times_of_change_speed = 0
-        for l in logs:
-            times_of_on_off += 1 if l.operation == operations.POWER_ON or l.operation == operations.POWER_OFF else 0
-            times_of_dispatch += 1 if l.operation == operations.DISPATCH else 0
-            times_of_change_temp += 1 if l.operation == operations.CHANGE_TEMP else 0
-            times_of_change_speed += 1 if l.operation == operations.CHANGE_SPEED else 0
-        return Report(room_id, start_time, finish_time, duration, times_of_on_off, times_of_dispatch,
-                      times_of_change_temp, times_of_change_speed, len(details), round(fee, 2))
+        """获取指定房间的报表，由按小时和按日预聚合的记录汇总"""
+        summary = DBFacade.query(rollup.summarize, room_id=room_id, start_time=start_time, finish_time=finish_time)
+        return self.__summary_report(room_id, start_time, finish_time, summary)
+
+    def get_building_report(self, room_ids: Optional[List[str]], start_time: datetime.datetime,
+                            finish_time: datetime.datetime, top: Optional[int] = None, order_by: str = 'fee'):
+        """
+        获取多个房间的报表，各房间的数据由一次分组汇总得到
+
+        Args:
+            room_ids: 房间号的list，为None时统计本楼宇的所有房间，默认楼宇还包括不属于其他楼宇的已删除房间
+            start_time: 起始时间
+            finish_time: 终止时间
+            top: 只保留排名前top的房间，为None时保留全部
+            order_by: 排名依据, 'fee'为总费用, 'service_time'为服务时长
+        """
+        if order_by not in BuildingReport.ORDERS:
+            logger.error('不支持的排序字段')
+            raise RuntimeError('不支持的排序字段')
+        if room_ids is None and self.__building_id != DEFAULT_BUILDING:
+            room_ids = [room.room_id for room in self.__rooms]
+        summaries = DBFacade.query(rollup.summarize_rooms, room_ids=room_ids, start_time=start_time,
+                                   finish_time=finish_time)
+        if room_ids is None:
+            others = set(DBFacade.query(lambda: list(RoomModel.objects.exclude(
+                building_id=DEFAULT_BUILDING).values_list('room_id', flat=True))))
+            summaries = {room_id: summary for room_id, summary in summaries.items() if room_id not in others}
+            room_ids = set(summaries) | {room.room_id for room in self.__rooms}
+        empty = dict.fromkeys(rollup.FIELDS, 0)
+        reports = [self.__summary_report(room_id, start_time, finish_time, summaries.get(room_id, empty))
+                   for room_id in sorted(set(room_ids))]
+        total = {field: sum(summary[field] for summary in summaries.values()) for field in rollup.FIELDS}
+        return BuildingReport(start_time, finish_time, reports,
+                              self.__summary_report(None, start_time, finish_time, total), top, order_by)
+
+    @staticmethod
+    def __summary_report(room_id, start_time, finish_time, summary: Dict):
+        return Report(room_id, start_time, finish_time, int(summary['service_time']),
+                      summary['times_of_on_off'], summary['times_of_dispatch'],
+                      summary['times_of_change_temp'], summary['times_of_change_speed'],
+                      summary['number_of_detail'], round(summary['fee'], 2))
 
     def get_slave_status(self, room) -> Dict:
         """获取指定从机的状态"""
@@ -188,7 +343,7 @@ class MasterMachine:
             'mode': mode,
             'current_temper': round(room.current_temp, 2) if room.current_temp is not None else None,
             'speed': room.current_speed,
-            'service_time': room.service_time,
+            'service_time': int(room.service_time),
             'target_temper': room.target_temp,
             'highest_temper': self.temp_high_limit,
             'lowest_temper': self.temp_low_limit,
@@ -199,11 +354,105 @@ class MasterMachine:
     def get_all_status(self) -> List[dict]:
         """获取主机关联的所有从机的状态"""
         slave_status = []
-        for room in self.__room_list:
+        for room in self.__rooms:
             slave_status.append(self.get_slave_status(room))
         logger.info('获取所有从机状态')
         return slave_status
 
+    @property
+    def actor(self):
+        return self.__actor
+
+    @actor.setter
+    def actor(self, actor):
+        self.__actor = actor
+
+    def publish_status(self) -> 'StatusSnapshot':
+        """由当前状态发布从机状态快照，设置了调度线程时需在调度线程中调用"""
+        return self.__publisher.publish(lambda: [self.get_slave_status(room) for room in self.__rooms])
+
+    def add_publish_listener(self, listener):
+        """
+        注册快照发布监听器
+
+        Args:
+            listener: 接收新发布的快照的函数，在发布快照的锁内按发布顺序调用
+        """
+        self.__publisher.add_listener(listener)
+
+    def follow(self):
+        """改为读取其他进程发布的快照，此后状态读取和订阅不再使用本主控机发布的快照"""
+        if self.__view is self.__publisher:
+            self.__view = StatusPublisher()
+
+    def mirror(self, snapshot: 'StatusSnapshot'):
+        """采用其他进程发布的快照"""
+        self.follow()
+        self.__view.mirror(snapshot)
+
+    def status_snapshot(self) -> 'StatusSnapshot':
+        """
+        获取最近发布的从机状态快照，超过UPDATE_FREQUENCY秒未发布时先在调度线程中发布，
+        不在定时任务或修改状态的请求中途读取房间状态；
+        读取其他进程发布的快照时，在收到第一个快照前抛出RuntimeError
+        """
+        if self.__view is not self.__publisher:
+            snapshot = self.__view.snapshot
+            if snapshot is None:
+                logger.error('主控机未启动')
+                raise RuntimeError('主控机未启动')
+            return snapshot
+        snapshot = self.__publisher.snapshot
+        if snapshot is not None and time.monotonic() - self.__publisher.time < UPDATE_FREQUENCY:
+            return snapshot
+        if self.__actor is None:
+            return self.__publish_if_stale()
+        return self.__actor.call(self.__publish_if_stale)
+
+    def __publish_if_stale(self) -> 'StatusSnapshot':
+        """快照仍过期时发布，排队等待期间已由其他请求或定时任务发布时不再发布"""
+        snapshot = self.__publisher.snapshot
+        if snapshot is None or time.monotonic() - self.__publisher.time >= UPDATE_FREQUENCY:
+            snapshot = self.publish_status()
+        return snapshot
+
+    def subscribe_status(self, room_id: Optional[str] = None, since: Optional[int] = None) -> 'StatusStream':
+        """
+        订阅从机状态变化
+
+        Args:
+            room_id: 订阅的房间号，为None时订阅所有房间
+            since: 客户端已有的快照版本号，为None时先发送订阅范围内所有房间的状态
+        """
+        snapshot = self.status_snapshot()
+        if room_id is not None and snapshot.status_of(room_id) is None:
+            logger.error('房间号不存在')
+            raise RuntimeError('房间号不存在')
+        return StatusStream(self, self.__view.subscribe(room_id), room_id, since)
+
+    def wait_status(self, room_id: str, version: int, timeout: float) -> Tuple[int, bytes]:
+        """
+        等待从机状态变化(长轮询)
+
+        Args:
+            room_id: 房间号
+            version: 客户端已有的该房间状态的版本号
+            timeout: 最长等待时间(秒)
+
+        Returns:
+            (该房间最近一次变化时的快照版本号, 序列化后的从机状态)，超时时返回当前状态
+        """
+        events = self.subscribe_status(room_id, version).events(heartbeat=timeout)
+        try:
+            next(events)
+        finally:
+            events.close()
+        result = self.status_snapshot().room(room_id)
+        if result is None:
+            logger.error('房间号不存在')
+            raise RuntimeError('房间号不存在')
+        return result
+
     def check_in(self, room_id):
         self.get_room(room_id).check_in()
 
@@ -211,6 +460,278 @@ class MasterMachine:
         self.get_room(room_id).check_out()
 
 
+class StatusPublisher:
+    """
+    从机状态快照的发布者
+
+    由各从机状态生成带版本号的快照并按房间发布状态变化事件，或采用其他进程发布的快照
+
+    Attributes:
+        __snapshot:     最近发布的快照
+        __time:         最近一次发布的时刻(time.monotonic())
+        __epoch:        本次运行的标识，与版本号一起组成快照的ETag
+        __status_keys:  房间号到上一个快照中参与增量比较的状态字段
+        __removed:      房间号到该房间被删除时的快照版本号
+        __events:       按房间号发布状态变化事件
+        __listeners:    发布新快照时调用的函数
+    """
+
+    def __init__(self):
+        self.__snapshot = None  # type: Optional[StatusSnapshot]
+        self.__time = 0.0
+        self.__epoch = uuid.uuid4().hex[:8]
+        self.__status_keys = {}
+        self.__removed = {}
+        self.__events = EventBroker()
+        self.__listeners = []
+        self.__lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> Optional['StatusSnapshot']:
+        return self.__snapshot
+
+    @property
+    def time(self):
+        return self.__time
+
+    def publish(self, collect) -> 'StatusSnapshot':
+        """
+        发布快照
+
+        状态与上一个快照相同时沿用原快照，版本号不变。
+        房间的状态、显示精度的温度、风速、费用或目标温度变化时，将该房间标记为在新版本中变化
+
+        Args:
+            collect: 返回各从机状态的list的函数，在发布锁内调用，保证快照按状态的先后发布
+        """
+        with self.__lock:
+            status = collect()
+            fragments = [json.dumps(room).encode() for room in status]
+            self.__time = time.monotonic()
+            previous = self.__snapshot
+            if previous is not None and previous.fragments == tuple(fragments):
+                return previous
+            version = previous.version + 1 if previous is not None else 1
+            keys = {room['room_id']: tuple(room[field] for field in StatusSnapshot.DELTA_FIELDS) for room in status}
+            changed = {room_id: (previous.changed[room_id]
+                                 if previous is not None and self.__status_keys.get(room_id) == key else version)
+                       for room_id, key in keys.items()}
+            for room_id in self.__status_keys.keys() - keys.keys():
+                self.__removed[room_id] = version
+            for room_id in keys.keys() & self.__removed.keys():
+                del self.__removed[room_id]
+            self.__status_keys = keys
+            self.__snapshot = StatusSnapshot(version, self.__epoch, status, fragments, changed, dict(self.__removed))
+            self.__publish_events(self.__snapshot, version - 1)
+            for listener in self.__listeners:
+                listener(self.__snapshot)
+            return self.__snapshot
+
+    def mirror(self, snapshot: 'StatusSnapshot'):
+        """采用其他进程发布的快照，并发布与上一个快照相比的状态变化事件"""
+        with self.__lock:
+            previous = self.__snapshot
+            self.__snapshot = snapshot
+            self.__time = time.monotonic()
+            if previous is None or previous.epoch != snapshot.epoch or previous.version > snapshot.version:
+                # 发布方重启后版本号重新计数
+                self.__publish_events(snapshot, 0)
+            elif previous.version < snapshot.version:
+                self.__publish_events(snapshot, previous.version)
+
+    def __publish_events(self, snapshot: 'StatusSnapshot', since: int):
+        """发布快照中since之后变化和删除的房间的事件"""
+        for room, fragment in zip(snapshot.status, snapshot.fragments):
+            if snapshot.changed[room['room_id']] > since:
+                self.__events.publish(room['room_id'], (snapshot.version, 'status', fragment))
+        for room_id, removed_version in snapshot.removed.items():
+            if removed_version > since:
+                self.__events.publish(room_id, (snapshot.version, 'removed', json.dumps(room_id).encode()))
+
+    def subscribe(self, room_id: Optional[str] = None) -> Subscription:
+        """订阅指定房间或所有房间的状态变化事件"""
+        return self.__events.subscribe(room_id)
+
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+
+class StatusSnapshot:
+    """
+    从机状态快照
+
+    发布后不再修改，请求线程直接返回预先序列化好的响应体
+
+    Attributes:
+        __version: 版本号，状态变化时递增
+        __status: 各从机状态的只读dict的tuple
+        __fragments: 各从机状态序列化后的bytes的tuple
+        __changed: 房间号到该房间最近一次变化时的版本号的只读dict
+        __removed: 房间号到该房间被删除时的版本号的只读dict
+        __index: 房间号到该房间在__status中的下标
+        __body: 序列化后的check_room_state响应体
+        __etag: ETag
+    """
+
+    # 增量状态比较的字段，服务时长等每秒变化的字段不单独触发增量
+    DELTA_FIELDS = ('status', 'current_temper', 'speed', 'fee', 'target_temper')
+
+    def __init__(self, version: int, epoch: str, status: List[dict], fragments: List[bytes], changed: Dict[str, int],
+                 removed: Dict[str, int]):
+        self.__version = version
+        self.__epoch = epoch
+        self.__status = tuple(types.MappingProxyType(room) for room in status)
+        self.__fragments = tuple(fragments)
+        self.__changed = types.MappingProxyType(changed)
+        self.__removed = types.MappingProxyType(removed)
+        self.__index = {room['room_id']: i for i, room in enumerate(status)}
+        self.__body = b'{"message": "OK", "result": [' + b', '.join(self.__fragments) + b']}'
+        self.__etag = '"' + epoch + '-' + str(version) + '"'
+
+    def __reduce__(self):
+        return StatusSnapshot, (self.__version, self.__epoch, [dict(room) for room in self.__status],
+                                list(self.__fragments), dict(self.__changed), dict(self.__removed))
+
+    @property
+    def version(self):
+        return self.__version
+
+    @property
+    def epoch(self):
+        return self.__epoch
+
+    @property
+    def status(self):
+        return self.__status
+
+    @property
+    def fragments(self):
+        return self.__fragments
+
+    @property
+    def changed(self):
+        return self.__changed
+
+    @property
+    def removed(self):
+        return self.__removed
+
+    @property
+    def body(self):
+        return self.__body
+
+    @property
+    def etag(self):
+        return self.__etag
+
+    def status_of(self, room_id: str) -> Optional[types.MappingProxyType]:
+        """返回指定从机状态的只读dict，房间不在快照中时返回None"""
+        i = self.__index.get(room_id)
+        return self.__status[i] if i is not None else None
+
+    def room(self, room_id: str) -> Optional[Tuple[int, bytes]]:
+        """返回(该房间最近一次变化时的版本号, 序列化后的从机状态)，房间不在快照中时返回None"""
+        i = self.__index.get(room_id)
+        return (self.__changed[room_id], self.__fragments[i]) if i is not None else None
+
+    def delta(self, since: int) -> bytes:
+        """
+        生成增量状态的响应体
+
+        Args:
+            since: 客户端已有的版本号，大于当前版本号时(如服务重启后)返回全部房间
+
+        Returns:
+            包含当前版本号、since之后变化的房间的状态和since之后删除的房间号的响应体
+        """
+        if since > self.__version:
+            since = 0
+        rooms = [fragment for room, fragment in zip(self.__status, self.__fragments)
+                 if self.__changed[room['room_id']] > since]
+        removed = sorted(room_id for room_id, version in self.__removed.items() if version > since)
+        return b'{"message": "OK", "result": {"version": ' + str(self.__version).encode() + \
+            b', "rooms": [' + b', '.join(rooms) + b'], "removed": ' + json.dumps(removed).encode() + b'}}'
+
+
+class StatusStream:
+    """
+    从机状态推送流
+
+    先发送订阅范围内since之后变化过的房间的当前状态，此后转发版本号更大的状态变化事件。
+    订阅队列溢出时，发送自最后一个完整送达的版本之后变化过的房间的当前状态
+
+    Attributes:
+        __master_machine: 主控机
+        __subscription: 事件订阅
+        __room_id: 订阅的房间号，为None时订阅所有房间
+        __since: 客户端已有的快照版本号
+    """
+
+    def __init__(self, master_machine: MasterMachine, subscription: Subscription, room_id: Optional[str],
+                 since: Optional[int]):
+        self.__master_machine = master_machine
+        self.__subscription = subscription
+        self.__room_id = room_id
+        self.__since = since
+
+    def events(self, heartbeat: float = EVENT_HEARTBEAT_INTERVAL):
+        """
+        生成状态变化事件，close()后结束
+
+        Yields:
+            (版本号, 事件名, 数据)，事件名为'status'时数据为房间状态的JSON，为'removed'时为房间号的JSON；
+            heartbeat秒内没有事件时生成None
+        """
+        try:
+            delivered = yield from self.__resend(self.__since or 0)
+            while not self.__subscription.closed:
+                event = self.__subscription.get(heartbeat)
+                if self.__subscription.closed:
+                    return
+                if self.__subscription.overflowed:
+                    self.__subscription.overflowed = False
+                    delivered = yield from self.__resend(delivered)
+                elif event is None:
+                    yield None
+                elif event[0] > delivered:
+                    # 同一版本的事件一起发布，收到版本v的事件说明v之前的版本已完整送达
+                    yield event
+                    delivered = max(delivered, event[0] - 1)
+        finally:
+            self.close()
+
+    def __resend(self, since: int):
+        """发送since之后变化过的房间的当前状态，返回所用快照的版本号"""
+        snapshot = self.__master_machine.status_snapshot()
+        if since > snapshot.version:
+            since = 0
+        for room, fragment in zip(snapshot.status, snapshot.fragments):
+            if self.__room_id in (None, room['room_id']) and snapshot.changed[room['room_id']] > since:
+                yield snapshot.version, 'status', fragment
+        if since > 0:
+            for room_id, version in sorted(snapshot.removed.items()):
+                if self.__room_id in (None, room_id) and version > since:
+                    yield snapshot.version, 'removed', json.dumps(room_id).encode()
+        return snapshot.version
+
+    def __iter__(self):
+        """
+        按Server-Sent Events格式生成响应体，心跳为注释行
+
+        StreamingHttpResponse关闭时调用close()，响应未开始迭代便关闭时也能取消订阅
+        """
+        for event in self.events():
+            if event is None:
+                yield b': heartbeat\n\n'
+            else:
+                version, name, data = event
+                yield b'id: ' + str(version).encode() + b'\nevent: ' + name.encode() + b'\ndata: ' + data + b'\n\n'
+
+    def close(self):
+        """取消订阅"""
+        self.__subscription.close()
+
+
 class Room:
     """
     房间
@@ -225,6 +746,9 @@ class Room:
         __service_time: 房间服务时长
         __check_in_time: 入住时间
         __check_out_time: 退房时间
+        __stay: 退房后首次查询详单或账单时结算的本次入住的详单和总费用，下次入住时清除
+        __engine: 绑定的温控引擎，绑定期间温度、费用和服务时长保存在引擎中
+        __slot: 在温控引擎中的槽位
     """
 
     def __init__(self, room_id: str, target_temp: float, target_speed: int):
@@ -245,8 +769,21 @@ class Room:
         self.__service_time = 0
         self.__check_in_time = ...  # type: datetime.datetime
         self.__check_out_time = ...  # type: datetime.datetime
+        self.__stay = None  # type: Optional[Stay]
+        self.__engine = None
+        self.__slot = None  # type: Optional[int]
         logger.info('初始化房间' + room_id)
 
+    def bind(self, engine, slot: Optional[int]):
+        """绑定到温控引擎的槽位，slot为None时取回引擎中的状态并解除绑定"""
+        if slot is None and self.__slot is not None:
+            self.__current_temp = self.__engine.get(self.__slot, 'current_temp')
+            self.__target_temp = self.__engine.get(self.__slot, 'target_temp')
+            self.__fee = self.__engine.get(self.__slot, 'fee')
+            self.__service_time = self.__engine.get(self.__slot, 'service_time')
+        self.__engine = engine if slot is not None else None
+        self.__slot = slot
+
     @property
     def room_id(self):
         return self.__room_id
@@ -259,12 +796,25 @@ class Room:
     def status(self, status):
         self.__status = status
 
+    def state(self) -> tuple:
+        """房间的状态，用于状态快照"""
+        return (self.__room_id, self.__status, self.current_temp, self.__current_speed, self.target_temp, self.fee,
+                self.service_time, self.__check_in_time, self.__check_out_time)
+
+    def restore(self, state: tuple):
+        """由state()的结果恢复状态，只用于未绑定温控引擎的房间"""
+        (_, self.__status, current_temp, self.__current_speed, self.__target_temp, self.__fee, self.__service_time,
+         self.__check_in_time, self.__check_out_time) = state
+        self.__current_temp = ... if current_temp is None else current_temp
+        self.__stay = None
+
     def check_in(self):
         """办理入住"""
         self.__status = room_status.CLOSED
         self.__fee = 0
         self.__service_time = 0
         self.__check_in_time = datetime.datetime.now()
+        self.__stay = None
         logger.info('房间' + self.__room_id + '入住')
 
     def power_on(self, current_temp):
@@ -289,10 +839,14 @@ class Room:
 
     @property
     def current_temp(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'current_temp')
         return self.__current_temp if self.__current_temp is not ... else None
 
     @current_temp.setter
     def current_temp(self, current_temp):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'current_temp', current_temp)
         self.__current_temp = current_temp
 
     @property
@@ -305,26 +859,38 @@ class Room:
 
     @property
     def target_temp(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'target_temp')
         return self.__target_temp
 
     @target_temp.setter
     def target_temp(self, target_temp):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'target_temp', target_temp)
         self.__target_temp = target_temp
 
     @property
     def fee(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'fee')
         return self.__fee
 
     @fee.setter
     def fee(self, fee):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'fee', fee)
         self.__fee = fee
 
     @property
     def service_time(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'service_time')
         return self.__service_time
 
     @service_time.setter
     def service_time(self, service_time):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'service_time', service_time)
         self.__service_time = service_time
 
     @property
@@ -335,6 +901,93 @@ class Room:
     def check_out_time(self):
         return self.__check_out_time
 
+    @property
+    def stay(self):
+        return self.__stay
+
+    @stay.setter
+    def stay(self, stay):
+        self.__stay = stay
+
+
+class RoomRegistry:
+    """
+    房间注册表
+
+    以房间号为key保存一个楼宇的Room对象，按房间号查找为O(1)。
+    房间定义保存在RoomModel中，数据库中没有该楼宇的房间时从settings.BUILDINGS中该楼宇的rooms加载，
+    默认楼宇缺省rooms时从settings.ROOM_CONFIG_FILE(房间号的JSON数组)加载，配置文件不存在时使用utils.room_ids，并写入数据库
+
+    Attributes:
+        __building_id: 楼宇号
+        __rooms: 房间号到Room的dict
+    """
+
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__building_id = building_id
+        self.__rooms = {}  # type: Dict[str, Room]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__rooms)
+
+    def __contains__(self, room_id):
+        return room_id in self.__rooms
+
+    def __iter__(self):
+        return iter(list(self.__rooms.values()))
+
+    def __load_config(self) -> List[str]:
+        config = buildings().get(self.__building_id, {})
+        if 'rooms' in config:
+            return [str(room_id) for room_id in config['rooms']]
+        if self.__building_id != DEFAULT_BUILDING:
+            return []
+        config_file = getattr(settings, 'ROOM_CONFIG_FILE', None)
+        if config_file and os.path.exists(config_file):
+            with open(config_file, 'r') as file:
+                logger.info('从' + config_file + '加载房间')
+                return [str(room_id) for room_id in json.load(file)]
+        return list(room_ids)
+
+    def load(self):
+        """从数据库或配置文件加载房间"""
+        ids = DBFacade.query(lambda: list(RoomModel.objects.filter(building_id=self.__building_id)
+                                          .values_list('room_id', flat=True)))
+        if len(ids) == 0:
+            ids = self.__load_config()
+            DBFacade.exec(RoomModel.objects.bulk_create,
+                          objs=[RoomModel(room_id=room_id, building_id=self.__building_id) for room_id in ids])
+        with self.__lock:
+            self.__rooms = {room_id: Room(room_id, None, None) for room_id in ids}
+        logger.info('楼宇' + self.__building_id + '加载房间' + str(len(ids)) + '个')
+
+    def get(self, room_id) -> Optional['Room']:
+        return self.__rooms.get(room_id)
+
+    def retain(self, predicate):
+        """只保留房间号使predicate为真的房间，不修改数据库"""
+        with self.__lock:
+            self.__rooms = {room_id: room for room_id, room in self.__rooms.items() if predicate(room_id)}
+
+    def add(self, room: 'Room'):
+        """新增房间并持久化，房间号已属于其他楼宇时抛出异常"""
+        model, _ = DBFacade.exec(RoomModel.objects.get_or_create, room_id=room.room_id,
+                                 defaults={'building_id': self.__building_id})
+        if model.building_id != self.__building_id:
+            logger.error('房间号已属于其他楼宇')
+            raise RuntimeError('房间号已属于其他楼宇')
+        with self.__lock:
+            self.__rooms[room.room_id] = room
+        logger.info('新增房间' + room.room_id)
+
+    def remove(self, room_id: str):
+        """删除房间并持久化"""
+        DBFacade.exec(lambda: RoomModel.objects.filter(room_id=room_id, building_id=self.__building_id).delete())
+        with self.__lock:
+            self.__rooms.pop(room_id, None)
+        logger.info('删除房间' + room_id)
+
 
 class Detail:
     """
@@ -421,6 +1074,28 @@ class Detail:
         return DetailFile(room_id, check_in_time, detail_list)
 
 
+class Stay:
+    """
+    一次入住的结算
+
+    Attributes:
+        __details: 按起始时间排序的详单tuple
+        __total_fee: 总费用
+    """
+
+    def __init__(self, details: List[Detail]):
+        self.__details = tuple(sorted(details, key=lambda detail: detail.start_time))
+        self.__total_fee = sum(detail.fee for detail in self.__details)
+
+    @property
+    def details(self):
+        return self.__details
+
+    @property
+    def total_fee(self):
+        return self.__total_fee
+
+
 class Invoice:
     """
     账单
@@ -565,29 +1240,189 @@ class Report:
         return ReportFile(self)
 
 
+class BuildingReport:
+    """
+    多个房间的报表
+
+    Attributes:
+        __start_time: 起始时间
+        __finish_time: 终止时间
+        __reports: 按房间号排序的各房间报表的list
+        __total: 所有选中房间的合计，room_id为None
+        __top: 按order_by降序排列的前top个房间的报表，未指定top时为None
+        __order_by: 排名依据
+    """
+
+    ORDERS = ('fee', 'service_time')
+
+    def __init__(self, start_time, finish_time, reports: List[Report], total: Report, top: Optional[int] = None,
+                 order_by: str = 'fee'):
+        self.__start_time = start_time
+        self.__finish_time = finish_time
+        self.__reports = reports
+        self.__total = total
+        self.__order_by = order_by
+        self.__top = None
+        if top is not None:
+            key = (lambda report: report.fee) if order_by == 'fee' else (lambda report: report.duration)
+            self.__top = sorted(reports, key=key, reverse=True)[:top]
+
+    @property
+    def start_time(self):
+        return self.__start_time
+
+    @property
+    def finish_time(self):
+        return self.__finish_time
+
+    @property
+    def reports(self):
+        return self.__reports
+
+    @property
+    def total(self):
+        return self.__total
+
+    @property
+    def top(self):
+        return self.__top
+
+    @property
+    def order_by(self):
+        return self.__order_by
+
+    @staticmethod
+    def merge(parts: List['BuildingReport'], top: Optional[int] = None, order_by: str = 'fee') -> 'BuildingReport':
+        """合并同一时间段内不同房间的报表，重新计算合计和排名"""
+        start_time, finish_time = parts[0].start_time, parts[0].finish_time
+        reports = sorted((report for part in parts for report in part.reports), key=lambda report: report.room_id)
+        totals = [part.total for part in parts]
+        total = Report(None, start_time, finish_time, sum(report.duration for report in totals),
+                       sum(report.times_of_on_off for report in totals),
+                       sum(report.times_of_dispatch for report in totals),
+                       sum(report.times_of_change_temp for report in totals),
+                       sum(report.times_of_change_speed for report in totals),
+                       sum(report.number_of_detail for report in totals),
+                       round(sum(report.fee for report in totals), 2))
+        return BuildingReport(start_time, finish_time, reports, total, top, order_by)
+
+
+class ReportCache:
+    """
+    报表缓存
+
+    以(房间号, 报表类型, 起始时间)为键缓存报表，超出容量时淘汰最久未使用的报表。
+    报表不设过期时间: 已结束的时段不再有写入，报表一直有效; 当前时段内写入详单或日志时，包含该时刻的报表失效
+
+    Attributes:
+        __capacity: 最大缓存条数
+        __reports: 键到报表的OrderedDict，按最近使用排序
+        __rooms: 房间号到该房间已缓存报表的键的集合
+        __generations: 房间号到该房间的失效次数，失效前开始计算的该房间的报表不写入缓存
+    """
+
+    def __init__(self, capacity: int = REPORT_CACHE_SIZE):
+        self.__capacity = capacity
+        self.__reports = OrderedDict()
+        self.__rooms = {}
+        self.__generations = {}  # type: Dict[str, int]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__reports)
+
+    def generation(self, room_id: str) -> int:
+        """房间的失效次数，开始计算报表前取得，缓存时传给put()"""
+        return self.__generations.get(room_id, 0)
+
+    def get(self, key) -> Optional[Report]:
+        with self.__lock:
+            report = self.__reports.get(key)
+            if report is not None:
+                self.__reports.move_to_end(key)
+            return report
+
+    def put(self, key, report: Report, generation: int):
+        """
+        缓存报表
+
+        Args:
+            key: (房间号, 报表类型, 起始时间)
+            report: 报表
+            generation: 开始计算报表时该房间的generation，此后该房间发生过失效则不缓存
+        """
+        with self.__lock:
+            if generation != self.generation(report.room_id):
+                return
+            self.__reports[key] = report
+            self.__reports.move_to_end(key)
+            self.__rooms.setdefault(report.room_id, set()).add(key)
+            while len(self.__reports) > self.__capacity:
+                self.__discard(next(iter(self.__reports)))
+
+    def __discard(self, key):
+        report = self.__reports.pop(key)
+        keys = self.__rooms[report.room_id]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.__rooms[report.room_id]
+
+    def invalidate(self, batch):
+        """DBFacade提交监听器，使包含新写入的详单或日志的报表失效"""
+        times = {}
+        for obj in batch:
+            if isinstance(obj, DetailModel):
+                times.setdefault(obj.room_id, []).append(obj.start_time)
+            elif isinstance(obj, Log):
+                times.setdefault(obj.room_id, []).append(obj.op_time)
+        if len(times) == 0:
+            return
+        with self.__lock:
+            for room_id, room_times in times.items():
+                self.__generations[room_id] = self.generation(room_id) + 1
+                room_times.sort()
+                for key in list(self.__rooms.get(room_id, ())):
+                    report = self.__reports[key]
+                    index = bisect.bisect_left(room_times, report.start_time)
+                    if index < len(room_times) and room_times[index] <= report.finish_time:
+                        self.__discard(key)
+
+
+def stream_lines(lines):
+    """逐行生成CSV文件的内容，行间以\\r\\n分隔"""
+    separator = ''
+    for line in lines:
+        yield separator + line
+        separator = '\r\n'
+
+
 class DetailFile:
     """
     详单文件
 
     Attributes:
-        __structured_detail: 结构化的详单信息的list
+        __room_id: 房间号
+        __details: 按起始时间排序的详单的可迭代对象，导出时逐条生成文件行
         __filename: 文件名
     """
 
-    def __init__(self, room_id: str, check_in_time: datetime.datetime, detail_list: List[Detail]):
+    def __init__(self, room_id: str, check_in_time: datetime.datetime, detail_list: Iterable[Detail]):
         """
         初始化详单文件
 
         Args:
-            detail_list:    要输出到文件的详单列表
+            detail_list:    要输出到文件的详单，需按起始时间排序
         """
-        detail_list.sort(key=lambda item: item.start_time)
-        self.__structured_detail = [
-            'ROOM ID, ' + str(room_id),
-            'START TIME, END TIME, SPEED, SERVICE TIME, FEE RATE, FEE',
-        ]
-        for detail in detail_list:
-            self.__structured_detail.append(
+        self.__room_id = room_id
+        self.__details = detail_list
+        self.__filename = room_id + '-' + check_in_time.strftime('%Y%m%d%H%M%S') + '-detail.csv'
+
+    @property
+    def structured_detail(self):
+        yield 'ROOM ID, ' + str(self.__room_id)
+        yield 'START TIME, END TIME, SPEED, SERVICE TIME, FEE RATE, FEE'
+        for detail in self.__details:
+            yield (
                 detail.start_time.strftime('%Y-%m-%d %H:%M:%S') + ', ' +
                 detail.finish_time.strftime('%Y-%m-%d %H:%M:%S') + ', ' +
                 str(detail.target_speed) + ', ' +
@@ -595,29 +1430,125 @@ class DetailFile:
                 str(detail.fee_rate) + ', ' +
                 str(round(detail.fee, 2))
             )
-        self.__filename = room_id + '-' + check_in_time.strftime('%Y%m%d%H%M%S') + '-detail.csv'
-
-    @property
-    def structured_detail(self):
-        return self.__structured_detail
 
     @property
     def filename(self):
         return self.__filename
 
-    def save(self):
+    def stream(self):
         """
-        保存详单文件
+        导出详单文件
 
         Returns:
-            生成的详单文件的文件名
+            逐行生成文件内容的生成器
         """
-        with open(self.__filename, 'w') as detail_file:
-            detail_file.write('\r\n'.join(self.__structured_detail))
-        logger.info('保存详单文件' + self.__filename)
+        logger.info('导出详单文件' + self.__filename)
+        return stream_lines(self.structured_detail)
 
+
+class DetailExport:
+    """
+    一组房间的详单导出文件
+
+    按(房间号, 起始时间, 详单号)的键集分页，每次查询EXPORT_CHUNK_SIZE条，逐块编码并以gzip压缩后输出，
+    导出任意长的时间段也只占用一块的内存
+
+    Attributes:
+        __start_time: 起始时间，导出起始时间不早于此的详单
+        __finish_time: 终止时间，导出起始时间早于此的详单
+        __fmt: 导出格式, 'csv'或'ndjson'
+        __room_ids: 导出的房间号，为None时导出楼宇登记的所有房间，默认楼宇还包括不属于其他楼宇的已删除房间
+        __building_id: 楼宇号
+        __filename: 文件名
+    """
+
+    FIELDS = ('detail_id', 'room_id', 'start_time', 'finish_time', 'speed', 'fee_rate', 'fee')
+    FORMATS = ('csv', 'ndjson')
+
+    def __init__(self, start_time: datetime.datetime, finish_time: datetime.datetime, fmt: str = 'csv',
+                 room_ids: Optional[Iterable[str]] = None, building_id: str = DEFAULT_BUILDING):
+        if fmt not in DetailExport.FORMATS:
+            logger.error('不支持的导出格式')
+            raise RuntimeError('不支持的导出格式')
+        self.__start_time = start_time
+        self.__finish_time = finish_time
+        self.__fmt = fmt
+        self.__room_ids = sorted(set(room_ids)) if room_ids is not None else None
+        self.__building_id = building_id
+        self.__filename = 'detail-' + start_time.strftime('%Y%m%d') + '-' + finish_time.strftime('%Y%m%d') + \
+                          '.' + fmt + '.gz'
+
+    @property
+    def filename(self):
         return self.__filename
 
+    def __rooms(self, queryset):
+        """按导出的房间过滤，楼宇登记的房间以子查询在数据库中过滤"""
+        if self.__room_ids is not None:
+            return queryset.filter(room_id__in=self.__room_ids)
+        if self.__building_id == DEFAULT_BUILDING:
+            return queryset.exclude(room_id__in=RoomModel.objects.exclude(
+                building_id=DEFAULT_BUILDING).values('room_id'))
+        return queryset.filter(room_id__in=RoomModel.objects.filter(
+            building_id=self.__building_id).values('room_id'))
+
+    def chunks(self):
+        """按(房间号, 起始时间, 详单号)的顺序逐块查询详单，每块为values_list的list"""
+        after = None
+        while True:
+            queryset = self.__rooms(DetailModel.objects.filter(start_time__gte=self.__start_time,
+                                                               start_time__lt=self.__finish_time))
+            if after is not None:
+                room_id, start_time, detail_id = after
+                queryset = queryset.filter(
+                    Q(room_id__gt=room_id) |
+                    Q(room_id=room_id, start_time__gt=start_time) |
+                    Q(room_id=room_id, start_time=start_time, detail_id__gt=detail_id))
+            rows = DBFacade.query(lambda: queryset.order_by('room_id', 'start_time', 'detail_id').values_list(
+                *DetailExport.FIELDS)[:EXPORT_CHUNK_SIZE])
+            if len(rows) == 0:
+                return
+            yield rows
+            last = rows[-1]
+            after = (last[1], last[2], last[0])
+
+    def __encode(self, rows) -> str:
+        if self.__fmt == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                (detail_id, room_id, start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                 finish_time.strftime('%Y-%m-%d %H:%M:%S'), speed, fee_rate, round(fee, 2))
+                for detail_id, room_id, start_time, finish_time, speed, fee_rate, fee in rows)
+            return buffer.getvalue()
+        return ''.join(json.dumps({
+            'detail_id': detail_id,
+            'room_id': room_id,
+            'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'finish_time': finish_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'speed': speed,
+            'fee_rate': fee_rate,
+            'fee': round(fee, 2),
+        }) + '\n' for detail_id, room_id, start_time, finish_time, speed, fee_rate, fee in rows)
+
+    def stream(self):
+        """
+        导出详单
+
+        Returns:
+            逐块生成gzip压缩内容的生成器
+        """
+        logger.info('导出详单文件' + self.__filename)
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        if self.__fmt == 'csv':
+            header = compressor.compress((','.join(DetailExport.FIELDS) + '\r\n').encode())
+            if header:
+                yield header
+        for rows in self.chunks():
+            data = compressor.compress(self.__encode(rows).encode())
+            if data:
+                yield data
+        yield compressor.flush()
+
 
 class InvoiceFile:
     """
@@ -651,18 +1582,15 @@ class InvoiceFile:
     def filename(self):
         return self.__filename
 
-    def save(self):
+    def stream(self):
         """
-        保存账单文件
+        导出账单文件
 
         Returns:
-            生成的账单文件的文件名
+            逐行生成文件内容的生成器
         """
-        with open(self.__filename, 'w') as invoice_file:
-            invoice_file.write('\r\n'.join(self.__structured_invoice))
-        logger.info('保存账单文件' + self.__filename)
-
-        return self.__filename
+        logger.info('导出账单文件' + self.__filename)
+        return stream_lines(self.__structured_invoice)
 
 
 class ReportFile:
@@ -697,15 +1625,65 @@ class ReportFile:
     def filename(self):
         return self.__filename
 
-    def save(self):
+    def stream(self):
         """
-        保存报表文件
+        导出报表文件
 
         Returns:
-            生成的报表文件的文件名
+            逐行生成文件内容的生成器
         """
-        with open(self.__filename, 'w') as report_file:
-            report_file.write('\r\n'.join(self.__structured_report))
-        logger.info('保存报表文件' + self.__filename)
+        logger.info('导出报表文件' + self.__filename)
+        return stream_lines(self.__structured_report)
+
+
+class BuildingReportFile:
+    """
+    多个房间的报表文件
+
+    每个房间一行，随后是合计行；指定了top时再附上排名
 
+    Attributes:
+        __report: 多个房间的报表
+        __filename: 文件名
+    """
+
+    COLUMNS = 'TIMES OF ON AND OFF, TIMES OF DISPATCH, TIMES OF CHANGE TEMPERATURE, ' \
+              'TIMES OF CHANGE FAN SPEED, RDR NUMBER, SERVICE TIME, FEE'
+
+    def __init__(self, report: BuildingReport):
+        self.__report = report
+        self.__filename = 'building-' + report.start_time.strftime('%Y%m%d%H%M%S') + '-report.csv'
+
+    @staticmethod
+    def __row(label, report: Report):
+        return ', '.join((label, str(report.times_of_on_off), str(report.times_of_dispatch),
+                          str(report.times_of_change_temp), str(report.times_of_change_speed),
+                          str(report.number_of_detail), str(report.duration), str(round(report.fee, 2))))
+
+    @property
+    def structured_report(self):
+        yield 'START TIME, ' + self.__report.start_time.strftime('%Y-%m-%d %H:%M:%S')
+        yield 'FINISH TIME, ' + self.__report.finish_time.strftime('%Y-%m-%d %H:%M:%S')
+        yield 'ROOM ID, ' + BuildingReportFile.COLUMNS
+        for report in self.__report.reports:
+            yield self.__row(report.room_id, report)
+        yield self.__row('TOTAL', self.__report.total)
+        if self.__report.top is not None:
+            yield 'RANK BY ' + self.__report.order_by.upper().replace('_', ' ') + ', ROOM ID, ' + \
+                  BuildingReportFile.COLUMNS
+            for rank, report in enumerate(self.__report.top, 1):
+                yield str(rank) + ', ' + self.__row(report.room_id, report)
+
+    @property
+    def filename(self):
         return self.__filename
+
+    def stream(self):
+        """
+        导出多个房间的报表文件
+
+        Returns:
+            逐行生成文件内容的生成器
+        """
+        logger.info('导出报表文件' + self.__filename)
+        return stream_lines(self.structured_report)
@@ -0,0 +1,204 @@
+"""
+状态快照与日志
+
+调度线程在每次修改状态的请求和每次定时任务之后记录楼宇的状态(主控机参数、各房间状态、服务队列和等待队列)，
+与上一次记录相比发生变化的部分作为一条记录追加到日志文件，每隔STATE_SNAPSHOT_INTERVAL秒将所有楼宇的状态写入快照文件
+并清空日志。启动时加载快照并按顺序应用日志中序号大于快照的记录，即可恢复重启前最后一次记录的状态。
+
+快照先写临时文件、fsync后再替换，日志的每条记录带长度和CRC32，末尾写了一半的记录在加载时被丢弃。
+日志只写入操作系统缓冲区而不逐条fsync，可以应对进程崩溃和重启，但不能应对断电
+"""
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Dict
+
+from utils import logger, room_status, STATE_SNAPSHOT_INTERVAL
+from .entity import MasterMachine
+from .service import AirConditionerService, AirConditionerServiceQueue, WaitQueue, UpdateService
+
+# 日志记录头: 记录长度, 记录的CRC32
+HEADER = struct.Struct('>II')
+
+
+def capture(building_id: str, started: bool) -> dict:
+    """
+    取得楼宇的状态，只在调度线程中调用
+
+    Args:
+        building_id: 楼宇号
+        started: 主控机是否已启动
+
+    Returns:
+        started: 主控机是否已启动
+        master: 主控机的运行参数
+        rooms: 房间号到房间状态的dict
+        serving: 服务队列中各服务的状态，按服务开始的顺序排列
+        waiting: 等待队列中各服务的状态
+    """
+    master_machine = MasterMachine.instance(building_id)
+    return {
+        'started': started,
+        'master': master_machine.state(),
+        'rooms': {room.room_id: room.state() for room in master_machine.rooms},
+        'serving': [service.state() for service in AirConditionerServiceQueue.instance(building_id).queue.values()],
+        'waiting': [service.state() for service in WaitQueue.instance(building_id).queue.values()],
+    }
+
+
+def restore(building_id: str, state: dict) -> bool:
+    """
+    由capture()的结果恢复楼宇的状态，只在调度线程中、楼宇的服务队列和等待队列为空时调用
+
+    重启前正在进行的服务时段按记录的时长结束并写入详单，房间随后重新参与调度，开始新的服务时段；
+    等待中的房间保留剩余等待时长
+
+    Returns:
+        主控机是否已启动
+    """
+    master_machine = MasterMachine.instance(building_id)
+    master_machine.restore(state['master'], state['rooms'].values())
+    update_service = UpdateService.instance(building_id)
+    for service_state in state['serving']:
+        room = master_machine.rooms.get(service_state[0])
+        if room is None:
+            continue
+        service = AirConditionerService(room, service_state[1], service_state[2])
+        service.restore(service_state)
+        service.finish()
+        room.status = room_status.STANDBY
+        update_service.push_service(AirConditionerService(room, service_state[1], service_state[2]))
+    wait_queue = WaitQueue.instance(building_id)
+    for service_state in state['waiting']:
+        room = master_machine.rooms.get(service_state[0])
+        if room is None:
+            continue
+        service = AirConditionerService(room, service_state[1], service_state[2])
+        service.restore(service_state)
+        wait_queue.push(service)
+    return state['started']
+
+
+def _apply(states: Dict[str, dict], building_id: str, changes: dict):
+    """将一条日志记录应用到各楼宇的状态"""
+    state = states.setdefault(building_id, {'rooms': {}})
+    for key, value in changes.items():
+        if key == 'rooms':
+            state['rooms'].update(value)
+        elif key == 'removed':
+            for room_id in value:
+                state['rooms'].pop(room_id, None)
+        else:
+            state[key] = value
+
+
+class Journal:
+    """
+    状态日志
+
+    Attributes:
+        __snapshot_path: 快照文件路径
+        __journal_path: 日志文件路径
+        __file: 以追加方式打开的日志文件
+        __seq: 最近一条记录的序号，快照保存写入时的序号
+        __states: 楼宇号到最近记录的状态，与快照加上日志中的记录一致
+        __snapshot_time: 最近一次写入快照的时刻(time.monotonic())
+    """
+
+    def __init__(self, directory: str):
+        """
+        加载快照和日志
+
+        Args:
+            directory: 存放快照文件和日志文件的目录
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.__snapshot_path = os.path.join(directory, 'snapshot')
+        self.__journal_path = os.path.join(directory, 'journal')
+        self.__seq = 0
+        self.__states = {}  # type: Dict[str, dict]
+        offset = self.__load()
+        self.__file = open(self.__journal_path, 'ab')
+        self.__file.truncate(offset)
+        self.__snapshot_time = time.monotonic()
+
+    @property
+    def states(self) -> Dict[str, dict]:
+        return self.__states
+
+    def __load(self) -> int:
+        """
+        Returns:
+            日志中最后一条完整记录的结束位置
+        """
+        started = time.monotonic()
+        try:
+            with open(self.__snapshot_path, 'rb') as file:
+                self.__seq, self.__states = pickle.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, pickle.UnpicklingError) as error:
+            logger.error('读取状态快照失败: ' + str(error))
+        offset, count = 0, 0
+        try:
+            with open(self.__journal_path, 'rb') as file:
+                while True:
+                    header = file.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    length, crc = HEADER.unpack(header)
+                    payload = file.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        logger.warning('丢弃日志末尾不完整的记录')
+                        break
+                    seq, building_id, changes = pickle.loads(payload)
+                    if seq > self.__seq:
+                        _apply(self.__states, building_id, changes)
+                        self.__seq = seq
+                        count += 1
+                    offset = file.tell()
+        except FileNotFoundError:
+            pass
+        if self.__states:
+            logger.info('加载状态快照和' + str(count) + '条日志记录，耗时' +
+                        str(round((time.monotonic() - started) * 1000, 1)) + 'ms')
+        return offset
+
+    def record(self, building_id: str, state: dict):
+        """
+        记录楼宇的状态，只追加与上一次记录相比发生变化的部分，到达快照间隔时写入快照
+
+        Args:
+            building_id: 楼宇号
+            state: capture()的结果
+        """
+        last = self.__states.get(building_id, {'rooms': {}})
+        changes = {key: value for key, value in state.items() if key != 'rooms' and last.get(key) != value}
+        rooms = {room_id: room for room_id, room in state['rooms'].items() if last['rooms'].get(room_id) != room}
+        removed = [room_id for room_id in last['rooms'] if room_id not in state['rooms']]
+        if rooms:
+            changes['rooms'] = rooms
+        if removed:
+            changes['removed'] = removed
+        self.__states[building_id] = state
+        if changes:
+            self.__seq += 1
+            payload = pickle.dumps((self.__seq, building_id, changes), pickle.HIGHEST_PROTOCOL)
+            self.__file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.__file.flush()
+        if time.monotonic() - self.__snapshot_time >= STATE_SNAPSHOT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """将所有楼宇最近记录的状态写入快照并清空日志"""
+        temp = self.__snapshot_path + '.tmp'
+        with open(temp, 'wb') as file:
+            pickle.dump((self.__seq, self.__states), file, pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.__snapshot_path)
+        # 替换快照后清空日志前退出时，日志中的记录序号不大于快照的序号，加载时被跳过
+        self.__file.truncate(0)
+        self.__snapshot_time = time.monotonic()
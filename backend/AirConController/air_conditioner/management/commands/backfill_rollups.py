@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from air_conditioner import rollup
+
+
+class Command(BaseCommand):
+    help = '由详单和日志重建报表预聚合记录，应在服务停止时执行'
+
+    def handle(self, *args, **options):
+        hours, days = rollup.backfill()
+        self.stdout.write('重建了' + str(hours) + '条小时记录和' + str(days) + '条日记录')
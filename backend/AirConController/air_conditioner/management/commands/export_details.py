@@ -0,0 +1,38 @@
+import datetime
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from air_conditioner.entity import DetailExport
+from utils import DEFAULT_BUILDING
+
+
+class Command(BaseCommand):
+    help = '导出时间段内一组房间的详单，输出gzip压缩的CSV或NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('start', help='起始日期, 格式为YYYY-MM-DD')
+        parser.add_argument('end', help='终止日期(含), 格式为YYYY-MM-DD')
+        parser.add_argument('--format', choices=DetailExport.FORMATS, default='csv', help='导出格式')
+        parser.add_argument('--output', help='输出文件，默认为导出文件名，为-时输出到标准输出')
+        parser.add_argument('--rooms', help='逗号分隔的房间号，默认为楼宇登记的所有房间')
+        parser.add_argument('--building', default=DEFAULT_BUILDING, help='楼宇号')
+
+    def handle(self, *args, **options):
+        try:
+            start_time = datetime.datetime.strptime(options['start'], '%Y-%m-%d')
+            finish_time = datetime.datetime.strptime(options['end'], '%Y-%m-%d') + datetime.timedelta(days=1)
+        except ValueError as error:
+            raise CommandError(str(error))
+        room_ids = options['rooms'].split(',') if options['rooms'] else None
+        export = DetailExport(start_time, finish_time, options['format'], room_ids, options['building'])
+        output = options['output'] or export.filename
+        if output == '-':
+            for chunk in export.stream():
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+        with open(output, 'wb') as export_file:
+            for chunk in export.stream():
+                export_file.write(chunk)
+        self.stdout.write('导出到' + output)
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-19 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('air_conditioner', '0003_remove_detailmodel_temp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomModel',
+            fields=[
+                ('room_id', models.CharField(max_length=16, primary_key=True, serialize=False)),
+            ],
+        ),
+    ]
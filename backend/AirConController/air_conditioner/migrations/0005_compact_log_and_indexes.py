@@ -0,0 +1,92 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:10
+
+import logging
+
+from django.db import migrations, models
+
+logger = logging.getLogger('django')
+
+# 无法识别的操作的编码，与utils.operations.UNKNOWN相同
+UNKNOWN_CODE = 0
+
+OPERATION_CODES = {
+    'power on': 1,
+    'power off': 2,
+    'dispatch': 3,
+    'change temp': 4,
+    'change speed': 5,
+}
+
+
+def encode_operations(apps, schema_editor):
+    """将操作名转换为编码，大小写和首尾空白不同的旧数据同样转换；无法识别的操作保留日志条目并编码为UNKNOWN_CODE"""
+    Log = apps.get_model('air_conditioner', 'Log')
+    for log in Log.objects.exclude(operation__in=OPERATION_CODES).only('operation'):
+        name = (log.operation or '').strip().lower()
+        if name in OPERATION_CODES:
+            Log.objects.filter(pk=log.pk).update(operation=name)
+    for name, code in OPERATION_CODES.items():
+        Log.objects.filter(operation=name).update(operation_code=code)
+    # 回滚后重新迁移时，回滚写入的'unknown'不再记录
+    Log.objects.filter(operation='unknown').update(operation_code=UNKNOWN_CODE)
+    unknown = Log.objects.filter(operation_code__isnull=True)
+    count = unknown.count()
+    if count > 0:
+        logger.warning(str(count) + '条日志的操作无法识别，编码为' + str(UNKNOWN_CODE) + ': ' +
+                       ', '.join(sorted({str(name) for name in unknown.values_list('operation', flat=True)})))
+        unknown.update(operation_code=UNKNOWN_CODE)
+
+
+def decode_operations(apps, schema_editor):
+    """将编码转换回操作名，UNKNOWN_CODE转换为'unknown'，其余不在OPERATION_CODES中的编码保留为数字字符串"""
+    Log = apps.get_model('air_conditioner', 'Log')
+    for name, code in OPERATION_CODES.items():
+        Log.objects.filter(operation_code=code).update(operation=name)
+    Log.objects.filter(operation_code=UNKNOWN_CODE).update(operation='unknown')
+    for log in Log.objects.filter(operation__isnull=True).only('operation_code'):
+        Log.objects.filter(pk=log.pk).update(operation=str(log.operation_code))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('air_conditioner', '0004_roommodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='operation_code',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='operation',
+            field=models.CharField(max_length=32, null=True),
+        ),
+        migrations.RunPython(encode_operations, decode_operations),
+        migrations.RemoveField(
+            model_name='log',
+            name='operation',
+        ),
+        migrations.RenameField(
+            model_name='log',
+            old_name='operation_code',
+            new_name='operation',
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='operation',
+            field=models.PositiveSmallIntegerField(
+                choices=[(0, 'unknown'), (1, 'power on'), (2, 'power off'), (3, 'dispatch'), (4, 'change temp'),
+                         (5, 'change speed')]),
+        ),
+        migrations.AddIndex(
+            model_name='detailmodel',
+            index=models.Index(fields=['room_id', 'start_time'], name='detail_room_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['room_id', 'op_time'], name='log_room_op_time_idx'),
+        ),
+    ]
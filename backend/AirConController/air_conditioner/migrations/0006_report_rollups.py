@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('air_conditioner', '0005_compact_log_and_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(max_length=16)),
+                ('service_time', models.FloatField(default=0)),
+                ('fee', models.FloatField(default=0)),
+                ('number_of_detail', models.IntegerField(default=0)),
+                ('times_of_on_off', models.IntegerField(default=0)),
+                ('times_of_dispatch', models.IntegerField(default=0)),
+                ('times_of_change_temp', models.IntegerField(default=0)),
+                ('times_of_change_speed', models.IntegerField(default=0)),
+                ('hour', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('room_id', 'hour')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(max_length=16)),
+                ('service_time', models.FloatField(default=0)),
+                ('fee', models.FloatField(default=0)),
+                ('number_of_detail', models.IntegerField(default=0)),
+                ('times_of_on_off', models.IntegerField(default=0)),
+                ('times_of_dispatch', models.IntegerField(default=0)),
+                ('times_of_change_temp', models.IntegerField(default=0)),
+                ('times_of_change_speed', models.IntegerField(default=0)),
+                ('day', models.DateField()),
+            ],
+            options={
+                'unique_together': {('room_id', 'day')},
+            },
+        ),
+    ]
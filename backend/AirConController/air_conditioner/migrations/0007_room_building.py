@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 02:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('air_conditioner', '0006_report_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommodel',
+            name='building_id',
+            field=models.CharField(db_index=True, default='default', max_length=16),
+        ),
+    ]
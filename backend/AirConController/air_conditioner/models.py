@@ -5,6 +5,8 @@
 """
 from django.db import models
 
+from utils import operations, DEFAULT_BUILDING
+
 
 class DetailModel(models.Model):
     """详单持久化类"""
@@ -16,9 +18,60 @@ class DetailModel(models.Model):
     fee_rate = models.FloatField()
     fee = models.FloatField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_id', 'start_time'], name='detail_room_start_idx'),
+        ]
+
 
 class Log(models.Model):
     """操作日志"""
     room_id = models.CharField(max_length=16)
-    operation = models.CharField(max_length=32)
+    operation = models.PositiveSmallIntegerField(choices=operations.CHOICES)
     op_time = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_id', 'op_time'], name='log_room_op_time_idx'),
+        ]
+
+
+class RoomModel(models.Model):
+    """房间定义"""
+    room_id = models.CharField(max_length=16, primary_key=True)
+    building_id = models.CharField(max_length=16, default=DEFAULT_BUILDING, db_index=True)
+
+
+class RollupModel(models.Model):
+    """
+    报表预聚合的公共字段
+
+    详单按start_time、日志按op_time归入所在的时间桶，随详单和日志的写入增量累加
+    """
+    room_id = models.CharField(max_length=16)
+    service_time = models.FloatField(default=0)
+    fee = models.FloatField(default=0)
+    number_of_detail = models.IntegerField(default=0)
+    times_of_on_off = models.IntegerField(default=0)
+    times_of_dispatch = models.IntegerField(default=0)
+    times_of_change_temp = models.IntegerField(default=0)
+    times_of_change_speed = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class HourlyRollup(RollupModel):
+    """按(房间, 小时)预聚合的报表数据"""
+    hour = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('room_id', 'hour'),)
+
+
+class DailyRollup(RollupModel):
+    """按(房间, 日)预聚合的报表数据"""
+    day = models.DateField()
+
+    class Meta:
+        unique_together = (('room_id', 'day'),)
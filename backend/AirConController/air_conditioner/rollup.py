@@ -0,0 +1,180 @@
+"""
+报表预聚合
+
+按(房间, 小时)和(房间, 日)维护HourlyRollup和DailyRollup。详单按start_time、日志按op_time归入所在的时间桶，
+写入线程每写入一批详单和日志便在同一事务内累加到对应的记录，报表只需汇总有限条预聚合记录
+"""
+import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import TruncHour
+
+from utils import operations, DB_WRITE_BATCH_SIZE
+from .models import DetailModel, Log, HourlyRollup, DailyRollup
+
+FIELDS = ('service_time', 'fee', 'number_of_detail', 'times_of_on_off', 'times_of_dispatch',
+          'times_of_change_temp', 'times_of_change_speed')
+
+# 日志操作对应的计数字段
+LOG_FIELDS = {
+    operations.POWER_ON: 'times_of_on_off',
+    operations.POWER_OFF: 'times_of_on_off',
+    operations.DISPATCH: 'times_of_dispatch',
+    operations.CHANGE_TEMP: 'times_of_change_temp',
+    operations.CHANGE_SPEED: 'times_of_change_speed',
+}
+
+
+def _hour_of(time: datetime.datetime) -> datetime.datetime:
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def _merge(buckets: Dict, key, delta: Dict):
+    total = buckets.setdefault(key, dict.fromkeys(FIELDS, 0))
+    for field, value in delta.items():
+        total[field] += value
+
+
+def _daily(hourly: Dict) -> Dict:
+    """将小时桶合并为日桶"""
+    daily = {}
+    for (room_id, hour), delta in hourly.items():
+        _merge(daily, (room_id, hour.date()), delta)
+    return daily
+
+
+def update_rollups(batch):
+    """
+    DBFacade写入监听器，将一批新写入的详单和日志累加到预聚合记录
+
+    Args:
+        batch: 同一事务内写入的模型对象的list
+    """
+    hourly = {}
+    for obj in batch:
+        if isinstance(obj, DetailModel):
+            _merge(hourly, (obj.room_id, _hour_of(obj.start_time)), {
+                'service_time': (obj.finish_time - obj.start_time).total_seconds(),
+                'fee': obj.fee,
+                'number_of_detail': 1,
+            })
+        elif isinstance(obj, Log) and obj.operation in LOG_FIELDS:
+            _merge(hourly, (obj.room_id, _hour_of(obj.op_time)), {LOG_FIELDS[obj.operation]: 1})
+    _accumulate(HourlyRollup, 'hour', hourly)
+    _accumulate(DailyRollup, 'day', _daily(hourly))
+
+
+def _accumulate(model, bucket: str, deltas: Dict):
+    for (room_id, key), delta in deltas.items():
+        changes = {field: F(field) + value for field, value in delta.items() if value}
+        if not model.objects.filter(room_id=room_id, **{bucket: key}).update(**changes):
+            model.objects.create(room_id=room_id, **{bucket: key}, **delta)
+
+
+def backfill():
+    """
+    由全部详单和日志重建预聚合记录
+
+    Returns:
+        (小时记录数, 日记录数)
+    """
+    hourly = {}
+    details = DetailModel.objects.annotate(hour=TruncHour('start_time')).values('room_id', 'hour').annotate(
+        duration=Sum(ExpressionWrapper(F('finish_time') - F('start_time'), output_field=DurationField())),
+        total_fee=Sum('fee'),
+        count=Count('detail_id'),
+    ).order_by()
+    for row in details.iterator():
+        _merge(hourly, (row['room_id'], row['hour']), {
+            'service_time': row['duration'].total_seconds() if row['duration'] else 0,
+            'fee': row['total_fee'] or 0,
+            'number_of_detail': row['count'],
+        })
+    counters = {}
+    for operation, field in LOG_FIELDS.items():
+        counters.setdefault(field, []).append(operation)
+    logs = Log.objects.annotate(hour=TruncHour('op_time')).values('room_id', 'hour').annotate(**{
+        field: Count('id', filter=Q(operation__in=codes)) for field, codes in counters.items()
+    }).order_by()
+    for row in logs.iterator():
+        _merge(hourly, (row['room_id'], row['hour']), {field: row[field] for field in counters})
+    daily = _daily(hourly)
+    with transaction.atomic():
+        HourlyRollup.objects.all().delete()
+        DailyRollup.objects.all().delete()
+        HourlyRollup.objects.bulk_create(
+            (HourlyRollup(room_id=room_id, hour=hour, **delta) for (room_id, hour), delta in hourly.items()),
+            batch_size=DB_WRITE_BATCH_SIZE)
+        DailyRollup.objects.bulk_create(
+            (DailyRollup(room_id=room_id, day=day, **delta) for (room_id, day), delta in daily.items()),
+            batch_size=DB_WRITE_BATCH_SIZE)
+    return len(hourly), len(daily)
+
+
+def _windows(start_time: datetime.datetime, finish_time: datetime.datetime) -> List[Tuple]:
+    """
+    将时间段划分为预聚合记录的查询条件
+
+    整日部分取DailyRollup，首尾不足一日的部分取HourlyRollup，统计精度为小时
+
+    Returns:
+        (预聚合模型, 查询条件)的list
+    """
+    first_day = start_time.date()
+    if start_time.time() != datetime.time():
+        first_day += datetime.timedelta(days=1)
+    last_day = finish_time.date()
+    if finish_time.time() < datetime.time(23, 59, 59):
+        last_day -= datetime.timedelta(days=1)
+    start_hour = _hour_of(start_time)
+    if first_day > last_day:
+        return [(HourlyRollup, Q(hour__gte=start_hour, hour__lte=finish_time))]
+    windows = [(DailyRollup, Q(day__gte=first_day, day__lte=last_day))]
+    hours = Q()
+    first_midnight = datetime.datetime.combine(first_day, datetime.time())
+    if start_hour < first_midnight:
+        hours |= Q(hour__gte=start_hour, hour__lt=first_midnight)
+    next_midnight = datetime.datetime.combine(last_day + datetime.timedelta(days=1), datetime.time())
+    if finish_time >= next_midnight:
+        hours |= Q(hour__gte=next_midnight, hour__lte=finish_time)
+    if hours:
+        windows.append((HourlyRollup, hours))
+    return windows
+
+
+def summarize_rooms(room_ids: Optional[Iterable[str]], start_time: datetime.datetime,
+                    finish_time: datetime.datetime) -> Dict[str, Dict]:
+    """
+    按房间汇总时间段内的预聚合记录，每张预聚合表一条分组聚合查询
+
+    Args:
+        room_ids: 要汇总的房间号，为None时汇总所有房间
+        start_time: 起始时间
+        finish_time: 终止时间
+
+    Returns:
+        房间号到FIELDS中各字段合计的dict，时间段内没有记录的房间不在其中
+    """
+    sums = {'total_' + field: Sum(field) for field in FIELDS}
+    totals = {}
+    for model, window in _windows(start_time, finish_time):
+        queryset = model.objects.filter(window)
+        if room_ids is not None:
+            queryset = queryset.filter(room_id__in=list(room_ids))
+        for row in queryset.values('room_id').annotate(**sums).order_by():
+            _merge(totals, row['room_id'], {field: row['total_' + field] or 0 for field in FIELDS})
+    return totals
+
+
+def summarize(room_id: str, start_time: datetime.datetime, finish_time: datetime.datetime) -> Dict:
+    """
+    汇总一个房间时间段内的预聚合记录
+
+    一年的报表最多汇总366条日记录和48条小时记录
+
+    Returns:
+        FIELDS中各字段的合计
+    """
+    return summarize_rooms([room_id], start_time, finish_time).get(room_id, dict.fromkeys(FIELDS, 0))
@@ -1,16 +1,22 @@
 """
 服务类
 
-除AirConditionerService外，均采用单例模式
+除AirConditionerService和Scheduler外，每个楼宇一个实例，由instance(building_id)取得；所有楼宇共用一个Scheduler
 """
 import datetime
 import threading
+import time
 from typing import List, Tuple, Optional, Dict
 
+from django.conf import settings
+
 from air_conditioner.models import DetailModel, Log
 from utils import logger, master_machine_mode, fan_speed, room_status, UPDATE_FREQUENCY, \
-    TEMPERATURE_CHANGE_RATE_PER_SEC, RepeatTimer, operations, DBFacade, room_ids
-from .entity import MasterMachine, Detail, Invoice, ReportFile, Report, InvoiceFile, Room
+    TEMPERATURE_CHANGE_RATE_PER_SEC, LONG_POLL_TIMEOUT, DEFAULT_BUILDING, Actor, MonotonicTimer, EventTimer, \
+    IndexedHeap, operations, DBFacade, buildings
+from .engine import get_engine, AnalyticEngine
+from .entity import MasterMachine, Detail, DetailFile, DetailExport, Invoice, ReportFile, Report, ReportCache, \
+    BuildingReport, BuildingReportFile, InvoiceFile, Room, StatusSnapshot, StatusStream
 
 
 class AirConditionerService:
@@ -25,6 +31,8 @@ class AirConditionerService:
         __target_speed: 目标风速
         __fee_rate: 费率
         __fee_since_start: 服务开始以来的费用
+        __engine: 绑定的温控引擎，绑定期间服务时长、等待时长和费用保存在引擎中
+        __slot: 在温控引擎中的槽位
     """
 
     def __init__(self, room: Room, target_speed: int, fee_rate: float):
@@ -43,8 +51,19 @@ class AirConditionerService:
         self.__fee_rate = fee_rate
         self.__fee_rate_per_sec = fee_rate / 60
         self.__fee_since_start = 0.0
+        self.__engine = None
+        self.__slot = None  # type: Optional[int]
         logger.info('初始化AirConditionerService')
 
+    def bind(self, engine, slot: Optional[int]):
+        """绑定到温控引擎的槽位，slot为None时取回引擎中的状态并解除绑定"""
+        if slot is None and self.__slot is not None:
+            self.__duration = self.__engine.get(self.__slot, 'duration')
+            self.__wait_time = self.__engine.get(self.__slot, 'wait_time')
+            self.__fee_since_start = self.__engine.get(self.__slot, 'fee_since_start')
+        self.__engine = engine if slot is not None else None
+        self.__slot = slot
+
     @property
     def room(self):
         return self.__room
@@ -55,14 +74,20 @@ class AirConditionerService:
 
     @property
     def duration(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'duration')
         return self.__duration
 
     @property
     def wait_time(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'wait_time')
         return self.__wait_time
 
     @wait_time.setter
     def wait_time(self, wait_time):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'wait_time', wait_time)
         self.__wait_time = wait_time
 
     @property
@@ -71,6 +96,8 @@ class AirConditionerService:
 
     @target_speed.setter
     def target_speed(self, target_speed):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'temp_rate', TEMPERATURE_CHANGE_RATE_PER_SEC[target_speed])
         self.__target_speed = target_speed
 
     @property
@@ -79,13 +106,31 @@ class AirConditionerService:
 
     @fee_rate.setter
     def fee_rate(self, fee_rate):
+        if self.__slot is not None:
+            self.__engine.set(self.__slot, 'fee_rate_per_sec', fee_rate / 60)
         self.__fee_rate_per_sec = fee_rate / 60
         self.__fee_rate = fee_rate
 
+    @property
+    def fee_rate_per_sec(self):
+        return self.__fee_rate_per_sec
+
     @property
     def fee_since_start(self):
+        if self.__slot is not None:
+            return self.__engine.get(self.__slot, 'fee_since_start')
         return self.__fee_since_start
 
+    def state(self) -> tuple:
+        """服务的状态，用于状态快照"""
+        return (self.room.room_id, self.target_speed, self.fee_rate, self.start_time, self.duration, self.wait_time,
+                self.fee_since_start)
+
+    def restore(self, state: tuple):
+        """由state()的结果恢复服务时段和等待时长，只用于未绑定温控引擎的服务"""
+        _, self.target_speed, self.fee_rate, self.__start_time, self.__duration, self.__wait_time, \
+            self.__fee_since_start = state
+
     def start(self):
         """服务开始"""
         self.__duration = 0
@@ -98,55 +143,70 @@ class AirConditionerService:
         detail = Detail(None, self.room.room_id, self.start_time, self.start_time +
                         datetime.timedelta(seconds=self.duration), self.target_speed,
                         self.fee_rate, self.fee_since_start)
-        DBFacade.exec(DetailModel.objects.create, room_id=detail.room_id, start_time=detail.start_time,
-                      finish_time=detail.finish_time, speed=detail.target_speed,
-                      fee_rate=detail.fee_rate, fee=detail.fee)
+        DBFacade.create(DetailModel, room_id=detail.room_id, start_time=detail.start_time,
+                        finish_time=detail.finish_time, speed=detail.target_speed,
+                        fee_rate=detail.fee_rate, fee=detail.fee)
         self.__start_time = ...
         logger.info('房间' + self.room.room_id + '停止服务')
 
-    def update(self, mode):
-        """定时更新队列内服务的状态"""
+    def update(self, mode, elapsed: float = UPDATE_FREQUENCY):
+        """
+        定时更新队列内服务的状态
+
+        Args:
+            mode: 主控机工作模式
+            elapsed: 距上次更新的实际时长
+        """
         if self.start_time is not ...:
-            self.__duration += UPDATE_FREQUENCY
-            self.__room.service_time += UPDATE_FREQUENCY
-            self.__fee_since_start += self.__fee_rate_per_sec * UPDATE_FREQUENCY
-            self.__room.fee += self.__fee_rate_per_sec * UPDATE_FREQUENCY
+            self.__duration += elapsed
+            self.__room.service_time += elapsed
+            self.__fee_since_start += self.__fee_rate_per_sec * elapsed
+            self.__room.fee += self.__fee_rate_per_sec * elapsed
             if mode == master_machine_mode.COOL:
-                self.room.current_temp -= TEMPERATURE_CHANGE_RATE_PER_SEC[self.target_speed] * UPDATE_FREQUENCY
+                self.room.current_temp -= TEMPERATURE_CHANGE_RATE_PER_SEC[self.target_speed] * elapsed
             else:
-                self.room.current_temp += TEMPERATURE_CHANGE_RATE_PER_SEC[self.target_speed] * UPDATE_FREQUENCY
+                self.room.current_temp += TEMPERATURE_CHANGE_RATE_PER_SEC[self.target_speed] * elapsed
         else:
-            self.__wait_time -= UPDATE_FREQUENCY
+            self.__wait_time -= elapsed
 
 
 class AirConditionerServiceQueue:
     """
     空调服务队列
 
+    每级风速维护一个按服务开始顺序排列的IndexedHeap，堆顶即该风速下服务时长最长的服务对象
+
     Attributes:
-        __MAX_NUM: 最大服务对象数
+        __MAX_NUM: 最大服务对象数，由settings.BUILDINGS中楼宇的capacity设置，缺省为3
         __queue: 服务对象dict
+        __levels: 各级风速的服务对象堆
+        __start_seq: 服务开始序号，序号越小服务时长越长
         __min_speed: 队列中的最低风速
         __max_speed: 队列中的最高风速
+        __engine: 温控引擎，为None时逐对象更新
     """
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__MAX_NUM = 3
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__MAX_NUM = buildings().get(building_id, {}).get('capacity', 3)
         self.__queue = {}  # type: Dict[str, AirConditionerService]
-        self.__min_speed = ...  # type: int
-        self.__max_speed = ...  # type: int
+        self.__levels = {speed: IndexedHeap() for speed in (fan_speed.LOW, fan_speed.NORMAL, fan_speed.HIGH)}
+        self.__start_seq = 0
+        self.__min_speed = None  # type: Optional[int]
+        self.__max_speed = None  # type: Optional[int]
+        self.__engine = None
         logger.info('初始化AirConditionerServiceQueue')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     @property
     def queue(self):
@@ -160,14 +220,52 @@ class AirConditionerServiceQueue:
     def max_speed(self):
         return self.__max_speed
 
+    @property
+    def engine(self):
+        return self.__engine
+
+    @engine.setter
+    def engine(self, engine):
+        self.__engine = engine
+
+    @property
+    def capacity(self):
+        return self.__MAX_NUM
+
+    @capacity.setter
+    def capacity(self, capacity: int):
+        """设置最大服务对象数，只在队列为空时设置"""
+        if len(self.__queue) != 0:
+            logger.error('服务队列非空，不能设置最大服务对象数')
+            raise RuntimeError('服务队列非空，不能设置最大服务对象数')
+        self.__MAX_NUM = capacity
+
     def __update_max_min_speed(self):
-        values = self.queue.values()
-        if len(values) == 0:
-            self.__min_speed = None
-            self.__max_speed = None
-        else:
-            self.__min_speed = min(values, key=lambda x: x.target_speed).target_speed
-            self.__max_speed = max(values, key=lambda x: x.target_speed).target_speed
+        speeds = [speed for speed, level in self.__levels.items() if len(level) != 0]
+        self.__min_speed = min(speeds) if speeds else None
+        self.__max_speed = max(speeds) if speeds else None
+
+    def __add(self, service: AirConditionerService):
+        self.queue[service.room.room_id] = service
+        self.__levels[service.target_speed].push(service.room.room_id, self.__start_seq)
+        self.__start_seq += 1
+        self.__update_max_min_speed()
+
+    def __start(self, service: AirConditionerService):
+        service.start()
+        if self.__engine is not None:
+            self.__engine.attach(service, serving=True)
+
+    def __discard(self, room_id: str) -> Optional[AirConditionerService]:
+        service = self.queue.pop(room_id, None)
+        if service is not None:
+            for level in self.__levels.values():
+                if level.remove(room_id):
+                    break
+            self.__update_max_min_speed()
+            if self.__engine is not None:
+                self.__engine.detach(service)
+        return service
 
     def empty(self):
         return len(self.__queue) == 0
@@ -184,23 +282,17 @@ class AirConditionerServiceQueue:
             如果房间不能被加入服务队列, 则返回(False, service)
         """
         if len(self.queue) < self.__MAX_NUM:
-            self.queue[service.room.room_id] = service
-            self.__update_max_min_speed()
-            service.start()
+            self.__add(service)
+            self.__start(service)
             return True, None
         elif service.target_speed > self.__min_speed:
-            services = [s for s in list(self.queue.values()) if s.target_speed == self.__min_speed]
-            if len(services) == 1:
-                service_to_pop = services[0]
-            else:
-                service_to_pop = max(services, key=lambda x: x.duration)
-            self.queue.pop(service_to_pop.room.room_id)
-            self.queue[service.room.room_id] = service
+            # 最低风速中服务时长最长的对象被换出
+            service_to_pop = self.__discard(self.__levels[self.__min_speed].peek())
+            self.__add(service)
             service_to_pop.finish()
-            self.__update_max_min_speed()
-            service.start()
-            DBFacade.exec(Log.objects.create, room_id=service.room.room_id, operation=operations.DISPATCH,
-                          op_time=datetime.datetime.now())
+            self.__start(service)
+            DBFacade.create(Log, room_id=service.room.room_id, operation=operations.DISPATCH,
+                            op_time=datetime.datetime.now())
             return True, service_to_pop
         elif service.target_speed == self.__min_speed and service.target_speed == self.__max_speed:
             service.wait_time = 120
@@ -214,21 +306,27 @@ class AirConditionerServiceQueue:
 
     def remove(self, room_id: str):
         """将指定房间的服务对象从服务队列中移除"""
-        if self.queue.get(room_id) is not None:
-            service = self.queue.pop(room_id)
+        service = self.__discard(room_id)
+        if service is not None:
             service.finish()
 
-    def update(self, mode) -> List[AirConditionerService]:
+    def update(self, mode, elapsed: float = UPDATE_FREQUENCY) -> List[AirConditionerService]:
         """
         更新服务队列所有服务对象的状态
 
+        Args:
+            mode: 主控机工作模式
+            elapsed: 距上次更新的实际时长
+
         Returns:
             到达目标温度的对象
         """
+        if self.__engine is not None:
+            return self.__engine.update_serving(mode, elapsed)
         reach_temp_services = []
         if len(self.queue.values()) != 0:
             for service in self.queue.values():
-                service.update(mode)
+                service.update(mode, elapsed)
                 if mode == master_machine_mode.COOL:
                     if service.room.current_temp - service.room.target_temp < 0.001:
                         reach_temp_services.append(service)
@@ -245,26 +343,34 @@ class WaitQueue:
     """
     等待队列
 
+    所有等待对象的剩余等待时长随时间同步减少，因此以加入时的(time.monotonic() + 等待时长)作为截止时间，
+    每级风速维护一个按截止时间排列的IndexedHeap，堆顶即剩余等待时间最少的对象
+
     Attributes:
         __queue: 等待对象dict
+        __levels: 各级风速的等待对象堆
         __max_speed: 等待队列的最高风速
+        __engine: 温控引擎，为None时逐对象更新
     """
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
         self.__queue = {}  # type: Dict[str, AirConditionerService]
+        self.__levels = {speed: IndexedHeap() for speed in (fan_speed.LOW, fan_speed.NORMAL, fan_speed.HIGH)}
         self.__max_speed = 0
+        self.__engine = None
         logger.info('初始化WaitQueue')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     @property
     def queue(self):
@@ -274,13 +380,40 @@ class WaitQueue:
     def max_speed(self):
         return self.__max_speed
 
+    @property
+    def engine(self):
+        return self.__engine
+
+    @engine.setter
+    def engine(self, engine):
+        self.__engine = engine
+
+    def __update_max_speed(self):
+        speeds = [speed for speed, level in self.__levels.items() if len(level) != 0]
+        self.__max_speed = max(speeds) if speeds else 0
+
+    def __discard(self, room_id: str) -> Optional[AirConditionerService]:
+        service = self.queue.pop(room_id, None)
+        if service is not None:
+            for level in self.__levels.values():
+                if level.remove(room_id):
+                    break
+            self.__update_max_speed()
+            if self.__engine is not None:
+                self.__engine.detach(service)
+        return service
+
     def empty(self):
         return len(self.__queue) == 0
 
     def push(self, service: AirConditionerService) -> None:
         """将房间加入等待队列"""
+        self.__discard(service.room.room_id)
         self.queue[service.room.room_id] = service
-        self.__max_speed = service.target_speed if service.target_speed > self.__max_speed else self.__max_speed
+        self.__levels[service.target_speed].push(service.room.room_id, time.monotonic() + service.wait_time)
+        self.__update_max_speed()
+        if self.__engine is not None:
+            self.__engine.attach(service, serving=False)
         logger.info('房间' + service.room.room_id + '开始等待')
 
     def pop(self) -> Optional[AirConditionerService]:
@@ -292,35 +425,29 @@ class WaitQueue:
         """
         if len(self.queue) == 0:
             return None
-        else:
-            services = [s for s in list(self.queue.values()) if s.target_speed == self.__max_speed]
-            if len(services) == 1:
-                service_to_pop = services[0]
-            else:
-                service_to_pop = min(services, key=lambda x: x.wait_time)
-            self.queue.pop(service_to_pop.room.room_id)
-            self.__max_speed = max(list(self.queue.values()), key=lambda x: x.target_speed) \
-                if len(list(self.queue)) != 0 else 0
-            return service_to_pop
+        return self.__discard(self.__levels[self.__max_speed].peek())
 
     def remove(self, room_id: str):
         """将指定房间的服务对象从等待队列中移除"""
-        if self.queue.get(room_id) is not None:
-            self.queue.pop(room_id)
-            self.__max_speed = max(list(self.queue.values()), key=lambda x: x.target_speed) \
-                if len(list(self.queue)) != 0 else 0
+        self.__discard(room_id)
 
-    def update(self, mode) -> List[AirConditionerService]:
+    def update(self, mode, elapsed: float = UPDATE_FREQUENCY) -> List[AirConditionerService]:
         """
         更新等待队列所有服务对象的状态
 
+        Args:
+            mode: 主控机工作模式
+            elapsed: 距上次更新的实际时长
+
         Returns:
             到达等待时间的对象
         """
+        if self.__engine is not None:
+            return self.__engine.update_waiting(elapsed)
         timeout_services = []
         if len(self.queue.values()) != 0:
             for service in self.queue.values():
-                service.update(mode)
+                service.update(mode, elapsed)
                 if service.wait_time <= 0:
                     timeout_services.append(service)
         return timeout_services
@@ -329,17 +456,33 @@ class WaitQueue:
         return self.queue.get(room_id)
 
 
-class UpdateService:
-    """更新状态服务"""
+class Scheduler:
+    """
+    调度器
+
+    所有楼宇共用一个调度线程和一个定时器: 定时任务和所有修改状态的请求都作为消息在调度线程中顺序执行，
+    定时器到期时以一条消息依次执行各已启动楼宇的定时任务。有楼宇启动时定时器运行，所有楼宇停机后停止
+
+    Attributes:
+        actor: 调度线程
+        __services: 楼宇号到已启动楼宇的UpdateService的dict，修改时整体替换
+        __started_at: 楼宇号到尚未执行过定时任务的楼宇的启动时刻，首次执行时只计入启动后经过的时长
+        __analytic: 是否使用解析式引擎，是则只执行到达事件时刻的楼宇的定时任务
+        __timer: 定时器，没有已启动的楼宇时为None
+        __listeners: 楼宇的定时任务执行后以楼宇号调用的监听器
+    """
 
     __instance_lock = threading.Lock()
 
     def __init__(self):
-        self.__service_queue = AirConditionerServiceQueue.instance()
-        self.__wait_queue = WaitQueue.instance()
-        self.__master_machine = MasterMachine.instance()
-        self.timer = RepeatTimer(UPDATE_FREQUENCY, self._task)
-        logger.info('初始化UpdateService')
+        self.actor = Actor('Scheduler')
+        self.__services = {}  # type: Dict[str, UpdateService]
+        self.__started_at = {}  # type: Dict[str, float]
+        self.__analytic = getattr(settings, 'TICK_ENGINE', None) == 'analytic'
+        self.__timer = None
+        self.__lock = threading.Lock()
+        self.__listeners = []
+        logger.info('初始化Scheduler')
 
     @classmethod
     def instance(cls):
@@ -350,18 +493,140 @@ class UpdateService:
                     cls._instance = cls()
         return cls._instance
 
-    def _task(self):
-        """周期定时任务"""
-        reach_temp_services = self.__service_queue.update(self.__master_machine.mode)
+    def add(self, update_service: 'UpdateService'):
+        """楼宇启动时加入调度"""
+        with self.__lock:
+            services = dict(self.__services)
+            services[update_service.building_id] = update_service
+            self.__started_at[update_service.building_id] = time.monotonic()
+            self.__services = services
+            if self.__timer is None:
+                self.__timer = self.__new_timer()
+                self.__timer.start()
+            elif self.__analytic:
+                AnalyticEngine.wakeup.set()
+
+    def add_listener(self, listener):
+        """注册在调度线程中、楼宇的定时任务执行后调用的监听器"""
+        self.__listeners.append(listener)
+
+    def remove(self, building_id: str):
+        """楼宇停机时移出调度"""
+        with self.__lock:
+            services = dict(self.__services)
+            services.pop(building_id, None)
+            self.__started_at.pop(building_id, None)
+            self.__services = services
+            if not services and self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+
+    def __new_timer(self):
+        if self.__analytic:
+            return EventTimer(self.__next_deadline, self.__tick, AnalyticEngine.wakeup)
+        return MonotonicTimer(UPDATE_FREQUENCY, self.__tick)
+
+    def __next_deadline(self) -> Optional[float]:
+        deadlines = [deadline for deadline in (service.next_deadline() for service in self.__services.values())
+                     if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def __tick(self, *args):
+        self.actor.call(self._task, *args)
+
+    def _task(self, elapsed: float = UPDATE_FREQUENCY):
+        """依次执行各已启动楼宇的定时任务"""
+        now = time.monotonic()
+        for building_id, update_service in self.__services.items():
+            try:
+                if self.__analytic:
+                    deadline = update_service.next_deadline()
+                    if deadline is None or deadline > now:
+                        continue
+                    update_service._task()
+                else:
+                    started_at = self.__started_at.pop(building_id, None)
+                    update_service._task(elapsed if started_at is None else min(elapsed, now - started_at))
+                for listener in self.__listeners:
+                    listener(building_id)
+            except Exception:
+                logger.exception('楼宇' + building_id + '的定时任务执行失败')
+
+
+class UpdateService:
+    """
+    更新状态服务
+
+    Attributes:
+        building_id: 楼宇号
+        actor: 调度线程，所有楼宇共用
+        __pending: 批量处理期间暂存的待调度服务，房间号到服务，不在批量处理中时为None
+    """
+
+    __instance_lock = threading.Lock()
+    _instances = {}
+
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.building_id = building_id
+        self.__service_queue = AirConditionerServiceQueue.instance(building_id)
+        self.__wait_queue = WaitQueue.instance(building_id)
+        self.__master_machine = MasterMachine.instance(building_id)
+        self.__engine = get_engine(getattr(settings, 'TICK_ENGINE', None), building_id)
+        self.__service_queue.engine = self.__engine
+        self.__wait_queue.engine = self.__engine
+        self.actor = Scheduler.instance().actor
+        self.__pending = None  # type: Optional[Dict[str, AirConditionerService]]
+        logger.info('初始化UpdateService')
+
+    @classmethod
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
+            with cls.__instance_lock:
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
+
+    def start(self):
+        """开始执行定时任务"""
+        Scheduler.instance().add(self)
+
+    def stop(self):
+        """停止执行定时任务，丢弃批量处理中暂存的服务"""
+        Scheduler.instance().remove(self.building_id)
+        if self.__pending is not None:
+            self.__pending.clear()
+
+    def next_deadline(self) -> Optional[float]:
+        """解析式引擎下下一个事件的时刻"""
+        return self.__engine.next_deadline()
+
+    def _task(self, elapsed: float = UPDATE_FREQUENCY):
+        """
+        定时任务
+
+        逐对象更新和向量化引擎下每UPDATE_FREQUENCY秒执行一次，
+        解析式引擎下仅在房间到达目标温度、等待超时或服务队列出现空位时执行
+
+        Args:
+            elapsed: 距上次执行的实际时长
+        """
+        reach_temp_services = self.__service_queue.update(self.__master_machine.mode, elapsed)
         for service in reach_temp_services:
             self.__service_queue.remove(service.room.room_id)
             logger.info('房间' + service.room.room_id + '到达设定温度')
             service.room.status = room_status.STANDBY
-        timeout_services = self.__wait_queue.update(self.__master_machine.mode)
+        timeout_services = self.__wait_queue.update(self.__master_machine.mode, elapsed)
         for service in timeout_services:
+            self.__wait_queue.remove(service.room.room_id)
             if self.push_service(service) is True:
-                DBFacade.exec(Log.objects.create, room_id=service.room.room_id, operation=operations.DISPATCH,
-                              op_time=datetime.datetime.now())
+                DBFacade.create(Log, room_id=service.room.room_id, operation=operations.DISPATCH,
+                                op_time=datetime.datetime.now())
+        self.schedule()
+        self.publish_status()
+
+    def schedule(self):
+        """将等待队列中的服务依次放入服务队列的空位"""
         while self.__service_queue.has_space():
             service = self.__wait_queue.pop()
             if service is not None:
@@ -369,13 +634,47 @@ class UpdateService:
             else:
                 break
 
+    def defer(self):
+        """开始批量处理，此后放入队列的服务先暂存，由flush()统一调度"""
+        self.__pending = {}
+
+    def flush(self):
+        """
+        结束批量处理并统一调度
+
+        先将等待队列中的服务放入服务队列的空位，再将暂存的服务按目标风速从高到低(风速相同时按暂存的顺序)放入队列，
+        每个房间只放入一次，同一批中后放入的服务不会再换出先放入的服务。
+        某个服务放入失败时记录错误并继续放入其余服务
+        """
+        pending, self.__pending = self.__pending, None
+        self.schedule()
+        for service in sorted(pending.values(), key=lambda service: -service.target_speed):
+            try:
+                self.push_service(service)
+            except Exception:
+                logger.exception('房间' + service.room.room_id + '的服务放入队列失败')
+
+    def get_pending(self, room_id: str) -> Optional[AirConditionerService]:
+        """批量处理中暂存的指定房间的服务"""
+        return self.__pending.get(room_id) if self.__pending is not None else None
+
+    def remove_service(self, room_id: str):
+        """将指定房间的服务移出服务队列、等待队列和暂存的服务"""
+        self.__service_queue.remove(room_id)
+        self.__wait_queue.remove(room_id)
+        if self.__pending is not None:
+            self.__pending.pop(room_id, None)
+
     def push_service(self, service: AirConditionerService) -> Optional[bool]:
         """
-        将指定服务放入服务队列或等待队列中
+        将指定服务放入服务队列或等待队列中，批量处理期间暂存
 
         Returns:
-            True表示放入服务队列, False表示放入等待队列, None表示无需服务
+            True表示放入服务队列, False表示放入等待队列, None表示无需服务或已暂存
         """
+        if self.__pending is not None:
+            self.__pending[service.room.room_id] = service
+            return None
         serving_room = self.__master_machine.get_room(service.room.room_id)  # type: Room
         if (self.__master_machine.mode == master_machine_mode.COOL
             and serving_room.current_temp <= serving_room.target_temp) \
@@ -396,31 +695,32 @@ class UpdateService:
                 self.__wait_queue.push(service)
             return in_service_queue
 
-    def reset(self):
-        self.timer.cancel()
-        self.timer = RepeatTimer(UPDATE_FREQUENCY, self._task)
+    def publish_status(self):
+        """发布从机状态快照"""
+        return self.__master_machine.publish_status()
 
 
 class ChangeTempAndSpeedService:
     """改变温度/风速服务"""
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__master_machine = MasterMachine.instance()
-        self.__service_queue = AirConditionerServiceQueue.instance()
-        self.__update_service = UpdateService.instance()
-        self.__wait_queue = WaitQueue.instance()
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__master_machine = MasterMachine.instance(building_id)
+        self.__service_queue = AirConditionerServiceQueue.instance(building_id)
+        self.__update_service = UpdateService.instance(building_id)
+        self.__wait_queue = WaitQueue.instance(building_id)
         logger.info('初始化ChangeTempAndSpeedService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     def init_temp_and_speed(self, room_id: str, target_temp: float, target_speed: int):
         """
@@ -455,8 +755,8 @@ class ChangeTempAndSpeedService:
             logger.error('未入住或未开机')
             raise RuntimeError('未入住或未开机')
         room.target_temp = target_temp
-        DBFacade.exec(Log.objects.create, room_id=room_id, operation=operations.CHANGE_TEMP,
-                      op_time=datetime.datetime.now())
+        DBFacade.create(Log, room_id=room_id, operation=operations.CHANGE_TEMP,
+                        op_time=datetime.datetime.now())
         logger.info('房间' + room_id + '改变目标温度为' + str(target_temp))
 
     def change_speed(self, room_id: str, target_speed: int):
@@ -475,8 +775,12 @@ class ChangeTempAndSpeedService:
             logger.error('未入住或未开机')
             raise RuntimeError('未入住或未开机')
         room.current_speed = target_speed
+        pending_service = self.__update_service.get_pending(room_id)
         air_conditioner_service = self.__service_queue.get_service(room_id)
-        if air_conditioner_service is not None:  # 在服务队列中
+        if pending_service is not None:  # 批量处理中暂存
+            pending_service.target_speed = target_speed
+            pending_service.fee_rate = self.__master_machine.fee_rate[target_speed]
+        elif air_conditioner_service is not None:  # 在服务队列中
             self.__service_queue.remove(room_id)
             air_conditioner_service.target_speed = target_speed
             air_conditioner_service.fee_rate = self.__master_machine.fee_rate[target_speed]
@@ -494,8 +798,8 @@ class ChangeTempAndSpeedService:
                 air_conditioner_service.target_speed = target_speed
                 air_conditioner_service.fee_rate = self.__master_machine.fee_rate[target_speed]
                 self.__update_service.push_service(air_conditioner_service)
-        DBFacade.exec(Log.objects.create, room_id=room_id, operation=operations.CHANGE_SPEED,
-                      op_time=datetime.datetime.now())
+        DBFacade.create(Log, room_id=room_id, operation=operations.CHANGE_SPEED,
+                        op_time=datetime.datetime.now())
         logger.info('房间' + room_id + '改变目标风速为' + str(target_speed))
 
 
@@ -503,21 +807,21 @@ class PowerService:
     """开关机服务"""
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__master_machine = MasterMachine.instance()
-        self.__service_queue = AirConditionerServiceQueue.instance()
-        self.__wait_queue = WaitQueue.instance()
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__master_machine = MasterMachine.instance(building_id)
+        self.__update_service = UpdateService.instance(building_id)
         logger.info('初始化PowerService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     def slave_machine_power_on(self, room_id: str, current_temp: float) -> Tuple[float, int]:
         """
@@ -543,8 +847,8 @@ class PowerService:
             logger.error('房间已开机或未入住')
             raise RuntimeError('房间已开机或入住')
         room.power_on(current_temp)
-        DBFacade.exec(Log.objects.create, room_id=room_id, operation=operations.POWER_ON,
-                      op_time=datetime.datetime.now())
+        DBFacade.create(Log, room_id=room_id, operation=operations.POWER_ON,
+                        op_time=datetime.datetime.now())
         return target_temp, speed
 
     def slave_machine_power_off(self, room_id):
@@ -553,11 +857,10 @@ class PowerService:
         if room.status == room_status.CLOSED:
             logger.error('房间已关机')
             raise RuntimeError('房间已关机')
-        self.__service_queue.remove(room_id)
-        self.__wait_queue.remove(room_id)
+        self.__update_service.remove_service(room_id)
         room.close_up()
-        DBFacade.exec(Log.objects.create, room_id=room_id, operation=operations.POWER_OFF,
-                      op_time=datetime.datetime.now())
+        DBFacade.create(Log, room_id=room_id, operation=operations.POWER_OFF,
+                        op_time=datetime.datetime.now())
 
 
 class AdministratorService:
@@ -565,27 +868,31 @@ class AdministratorService:
     管理服务
 
     Attributes:
+        __building_id: 楼宇号
         __master_machine: 主控机的对象
     """
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__building_id = building_id
         self.__master_machine = ...  # type: MasterMachine
         logger.info('初始化AdministratorService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     def init_master_machine(self) -> None:
-        """初始化主控机"""
-        self.__master_machine = MasterMachine.instance()
+        """初始化主控机，过期的状态快照交给调度线程发布"""
+        self.__master_machine = MasterMachine.instance(self.__building_id)
+        self.__master_machine.actor = Scheduler.instance().actor
 
     def set_master_machine_param(self, mode: str, temp_low_limit: float, temp_high_limit: float,
                                  default_target_temp: float, default_speed: int, fee_rate: tuple) -> None:
@@ -619,8 +926,9 @@ class AdministratorService:
         if self.__master_machine is ...:
             logger.error('主控机未初始化')
             raise RuntimeError('主控机未初始化')
-        UpdateService.instance().timer.start()
-        return self.__master_machine.start()
+        result = self.__master_machine.start()
+        UpdateService.instance(self.__building_id).start()
+        return result
 
     def stop_master_machine(self) -> None:
         """关闭主控机"""
@@ -628,10 +936,11 @@ class AdministratorService:
             logger.error('主控机未初始化')
             raise RuntimeError('主控机未初始化')
         self.__master_machine.stop()
-        for room_id in room_ids:
-            AirConditionerServiceQueue.instance().remove(room_id)
-            WaitQueue.instance().remove(room_id)
-        UpdateService.instance().reset()
+        for room in self.__master_machine.rooms:
+            AirConditionerServiceQueue.instance(self.__building_id).remove(room.room_id)
+            WaitQueue.instance(self.__building_id).remove(room.room_id)
+        UpdateService.instance(self.__building_id).stop()
+        DBFacade.flush()
 
     def get_status(self) -> List[dict]:
         """
@@ -651,7 +960,21 @@ class AdministratorService:
         if self.__master_machine is ...:
             logger.error('主控机未初始化')
             raise RuntimeError('主控机未初始化')
-        return self.__master_machine.get_all_status()
+        return [dict(room) for room in self.__master_machine.status_snapshot().status]
+
+    def get_status_snapshot(self) -> StatusSnapshot:
+        """获取最近发布的从机状态快照"""
+        if self.__master_machine is ...:
+            logger.error('主控机未初始化')
+            raise RuntimeError('主控机未初始化')
+        return self.__master_machine.status_snapshot()
+
+    def subscribe_status(self, room_id: Optional[str], since: Optional[int]) -> StatusStream:
+        """订阅从机状态变化"""
+        if self.__master_machine is ...:
+            logger.error('主控机未初始化')
+            raise RuntimeError('主控机未初始化')
+        return self.__master_machine.subscribe_status(room_id, since)
 
     def check_in(self, room_id: str):
         if self.__master_machine is ...:
@@ -665,106 +988,153 @@ class AdministratorService:
             raise RuntimeError('主控机未初始化')
         self.__master_machine.check_out(room_id)
 
+    def add_room(self, room_id: str):
+        """运行时新增房间"""
+        if self.__master_machine is ...:
+            logger.error('主控机未初始化')
+            raise RuntimeError('主控机未初始化')
+        self.__master_machine.add_room(room_id)
+
+    def remove_room(self, room_id: str):
+        """运行时删除房间"""
+        if self.__master_machine is ...:
+            logger.error('主控机未初始化')
+            raise RuntimeError('主控机未初始化')
+        self.__master_machine.remove_room(room_id)
+
 
 class GetFeeService:
     """获取费用服务"""
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__master_machine = MasterMachine.instance()
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__master_machine = MasterMachine.instance(building_id)
         logger.info('初始化GetFeeService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     def get_current_fee(self, room_id: str) -> Dict:
-        """获取指定从机当前费用"""
-        return self.__master_machine.get_slave_status(self.__master_machine.get_room(room_id))
+        """由最近发布的状态快照获取指定从机当前费用"""
+        status = self.__master_machine.status_snapshot().status_of(room_id)
+        if status is None:
+            logger.error('房间号不存在')
+            raise RuntimeError('房间号不存在')
+        return dict(status)
+
+    def wait_fee(self, room_id: str, version: int, timeout: float) -> Tuple[int, bytes]:
+        """等待指定从机的状态在version之后变化，最长等待timeout秒，不超过LONG_POLL_TIMEOUT"""
+        return self.__master_machine.wait_status(room_id, version, min(max(timeout, 0), LONG_POLL_TIMEOUT))
 
 
 class DetailService:
     """详单服务"""
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__master_machine = MasterMachine.instance()
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__building_id = building_id
+        self.__master_machine = MasterMachine.instance(building_id)
         logger.info('初始化DetailService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     def get_detail(self, room_id: str) -> List[Detail]:
         """获取详单"""
         return self.__master_machine.get_detail(room_id)[1]
 
-    def print_detail(self, room_id: str) -> str:
-        """打印详单"""
-        check_in_time, details = self.__master_machine.get_detail(room_id)
-        return Detail.get_detail_file(room_id, check_in_time, details).save()
+    def get_stay_time(self, room_id: str) -> Tuple[datetime.datetime, datetime.datetime]:
+        """获取本次入住的入住时间和退房时间"""
+        return self.__master_machine.get_stay_time(room_id)
+
+    def print_detail(self, room_id: str, stay_time: Optional[Tuple[datetime.datetime, datetime.datetime]] = None) \
+            -> DetailFile:
+        """
+        打印详单
+
+        Args:
+            stay_time: 本次入住的入住时间和退房时间，缺省时由本进程的主控机获取
+        """
+        check_in_time, check_out_time = stay_time if stay_time is not None else self.get_stay_time(room_id)
+        return Detail.get_detail_file(room_id, check_in_time,
+                                      MasterMachine.stream_detail(room_id, check_in_time, check_out_time))
+
+    def export_detail(self, start_time: datetime.datetime, finish_time: datetime.datetime, fmt: str,
+                      room_ids: Optional[List[str]] = None) -> DetailExport:
+        """导出时间段内一组房间的详单，room_ids为None时导出本楼宇的所有房间"""
+        return DetailExport(start_time, finish_time, fmt, room_ids, self.__building_id)
 
 
 class InvoiceService:
     """账单服务"""
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__master_machine = MasterMachine.instance()
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__master_machine = MasterMachine.instance(building_id)
         logger.info('初始化InvoiceService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
     def get_invoice(self, room_id: str) -> Invoice:
         """获取账单"""
         return self.__master_machine.get_invoice(room_id)
 
-    def print_invoice(self, room_id: str) -> str:
+    def print_invoice(self, room_id: str) -> InvoiceFile:
         """打印账单"""
         invoice = self.__master_machine.get_invoice(room_id)
-        return InvoiceFile(invoice).save()
+        return InvoiceFile(invoice)
 
 
 class ReportService:
     """报表服务"""
 
     __instance_lock = threading.Lock()
+    _instances = {}
 
-    def __init__(self):
-        self.__master_machine = MasterMachine.instance()
+    def __init__(self, building_id: str = DEFAULT_BUILDING):
+        self.__master_machine = MasterMachine.instance(building_id)
+        self.__cache = ReportCache()
+        # 提交后才使缓存失效，否则并发的查询可能在提交前读到旧数据并以新的generation缓存
+        DBFacade.add_commit_listener(self.__cache.invalidate)
         logger.info('初始化ReportService')
 
     @classmethod
-    def instance(cls):
-        """Singleton"""
-        if not hasattr(cls, '_instance'):
+    def instance(cls, building_id: str = DEFAULT_BUILDING):
+        """每个楼宇一个实例"""
+        if building_id not in cls._instances:
             with cls.__instance_lock:
-                if not hasattr(cls, '_instance'):
-                    cls._instance = cls()
-        return cls._instance
+                if building_id not in cls._instances:
+                    cls._instances[building_id] = cls(building_id)
+        return cls._instances[building_id]
 
-    def get_report(self, room_id: str, qtype: str, date: datetime.datetime) -> Report:
-        """获取报表"""
+    @staticmethod
+    def __period(qtype: str, date: datetime.datetime):
+        """由报表类型和日期得到报表的起止时间"""
         if qtype == 'day':
             start_time = datetime.datetime(date.year, date.month, date.day)
             finish_time = datetime.datetime(date.year, date.month, date.day, 23, 59, 59)
@@ -775,16 +1145,45 @@ class ReportService:
             finish_time = datetime.datetime(last_day.year, last_day.month, last_day.day, 23, 59, 59)
         elif qtype == 'month':
             start_time = datetime.datetime(date.year, date.month, 1)
-            finish_time = datetime.datetime(date.year, date.month + 1, 1) - datetime.timedelta(days=1)
+            next_month = datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+            finish_time = next_month - datetime.timedelta(seconds=1)
         elif qtype == 'year':
             start_time = datetime.datetime(date.year, 1, 1)
-            finish_time = datetime.datetime(date.year + 1, 1, 1) - datetime.timedelta(days=1)
+            finish_time = datetime.datetime(date.year + 1, 1, 1) - datetime.timedelta(seconds=1)
         else:
             logger.error('不支持的qtype')
             raise RuntimeError('不支持的qtype')
-        return self.__master_machine.get_report(room_id, start_time, finish_time)
+        return start_time, finish_time
 
-    def print_report(self, room_id: str, qtype: str, date: datetime.datetime) -> str:
+    def get_report(self, room_id: str, qtype: str, date: datetime.datetime) -> Report:
+        """
+        获取报表，优先从报表缓存中取得
+
+        缓存命中时不等待写入线程，排队中的详单和日志提交后才使报表失效；未命中时先写入排队中的详单和日志再统计
+        """
+        start_time, finish_time = self.__period(qtype, date)
+        key = (room_id, qtype, start_time)
+        report = self.__cache.get(key)
+        if report is None:
+            DBFacade.flush()
+            generation = self.__cache.generation(room_id)
+            report = self.__master_machine.get_report(room_id, start_time, finish_time)
+            self.__cache.put(key, report, generation)
+        return report
+
+    def print_report(self, room_id: str, qtype: str, date: datetime.datetime) -> ReportFile:
         """打印报表"""
         report = self.get_report(room_id, qtype, date)
-        return ReportFile(report).save()
+        return ReportFile(report)
+
+    def get_building_report(self, room_ids: Optional[List[str]], qtype: str, date: datetime.datetime,
+                            top: Optional[int] = None, order_by: str = 'fee') -> BuildingReport:
+        """获取多个房间的报表，先写入排队中的详单和日志再统计"""
+        start_time, finish_time = self.__period(qtype, date)
+        DBFacade.flush()
+        return self.__master_machine.get_building_report(room_ids, start_time, finish_time, top, order_by)
+
+    def print_building_report(self, room_ids: Optional[List[str]], qtype: str, date: datetime.datetime,
+                              top: Optional[int] = None, order_by: str = 'fee') -> BuildingReportFile:
+        """打印多个房间的报表"""
+        return BuildingReportFile(self.get_building_report(room_ids, qtype, date, top, order_by))
@@ -1,15 +1,961 @@
+import csv
 import datetime
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import time
-from threading import Thread
+import unittest
+from multiprocessing.connection import Listener
+from threading import Thread, get_ident
+from unittest import mock
 
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
 
+from air_conditioner import cluster, engine, journal, rollup
+from air_conditioner.cluster import SharedStatus, ShardMap
 from air_conditioner.controller import Controller
-from air_conditioner.models import Log
-from utils import master_machine_mode, fan_speed, RepeatTimer, DBFacade
+from air_conditioner.entity import Room, MasterMachine, RoomRegistry, Report, ReportCache, Detail, DetailExport, \
+    BuildingReport, BuildingReportFile
+from air_conditioner.models import Log, DetailModel, RoomModel
+from main_machine.views import check_room_state
+from slave.views import batch
+from air_conditioner.service import AirConditionerService, AirConditionerServiceQueue, WaitQueue, ReportService, \
+    UpdateService, Scheduler
+from utils import master_machine_mode, fan_speed, room_status, operations, RepeatTimer, MonotonicTimer, DBFacade, Actor, \
+    UPDATE_FREQUENCY
 
+try:
+    from asgiref.sync import async_to_sync
+    from channels.routing import URLRouter
+    from channels.testing import WebsocketCommunicator
+    from main_machine.routing import websocket_urlpatterns
+except ImportError:
+    WebsocketCommunicator = None
 
-class ControllerTest(TestCase):
+
+class DBTestCase(TestCase):
+    """写入详单或日志的测试，结束时等待写入线程写完，避免测试数据库删除后才写入"""
+
+    def setUp(self):
+        # 最先注册，在其他清理执行完后等待写入
+        self.addCleanup(DBFacade.flush)
+        self.__clock = 0
+
+    def new_master_machine(self, *room_ids):
+        """新建设置了制冷参数的主控机并加入房间，测试结束时移除仍在的房间"""
+        master_machine = MasterMachine()
+        master_machine.set_param(master_machine_mode.COOL, 16, 30, 24, fan_speed.NORMAL, (0.5, 0.75, 1.5))
+        for room_id in room_ids:
+            master_machine.add_room(room_id)
+            self.addCleanup(self.__remove_room, master_machine, room_id)
+        return master_machine
+
+    @staticmethod
+    def __remove_room(master_machine, room_id):
+        if room_id in master_machine.rooms:
+            master_machine.get_room(room_id).status = room_status.AVAILABLE
+            master_machine.remove_room(room_id)
+
+    def start_building(self, building_id, room_ids, current_temp, **param):
+        """
+        主控机开机、设置参数并启动，房间入住并开机，测试结束时关机、退房并停机
+
+        Args:
+            param: 覆盖缺省制冷参数的set param参数
+        """
+        controller = Controller.instance()
+        param = dict(dict(mode=master_machine_mode.COOL, temp_low_limit=16, temp_high_limit=30,
+                          default_target_temp=24, default_speed=fan_speed.NORMAL, fee_rate=(0.5, 0.75, 1.5)), **param)
+        controller.dispatch(service='ADMINISTRATOR', operation='power on', building_id=building_id)
+        controller.dispatch(service='ADMINISTRATOR', operation='set param', building_id=building_id, **param)
+        controller.dispatch(service='ADMINISTRATOR', operation='start', building_id=building_id)
+        self.addCleanup(controller.dispatch, service='ADMINISTRATOR', operation='stop', building_id=building_id)
+        for room_id in room_ids:
+            controller.dispatch(service='ADMINISTRATOR', operation='check in', room_id=room_id,
+                                building_id=building_id)
+            controller.dispatch(service='POWER', operation='power on', room_id=room_id, current_temp=current_temp,
+                                building_id=building_id)
+            self.addCleanup(self.__check_out, controller, building_id, room_id)
+        return controller
+
+    @staticmethod
+    def __check_out(controller, building_id, room_id):
+        controller.dispatch(service='POWER', operation='power off', room_id=room_id, building_id=building_id)
+        controller.dispatch(service='ADMINISTRATOR', operation='check out', room_id=room_id, building_id=building_id)
+
+    def tick(self, building_id):
+        """
+        在调度线程中执行一次楼宇的定时任务，不等待定时器
+
+        解析式引擎按time.monotonic()计算状态，因此在测试结束前将引擎的时钟拨快UPDATE_FREQUENCY秒
+        """
+        self.__clock += UPDATE_FREQUENCY
+        clock = self.__clock
+        patcher = mock.patch.object(engine, 'time', mock.Mock(monotonic=lambda: time.monotonic() + clock))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        update_service = UpdateService.instance(building_id)
+        update_service.actor.call(update_service._task)
+
+
+class QueueTest(DBTestCase):
+
+    @staticmethod
+    def new_service(room_id, speed):
+        room = Room(room_id, 24, speed)
+        room.current_temp = 28
+        return AirConditionerService(room, speed, 1.0)
+
+    def test_service_queue_preempt(self):
+        service_queue = AirConditionerServiceQueue()
+        first, second, third = (self.new_service(room_id, fan_speed.LOW) for room_id in ('a', 'b', 'c'))
+        for service in (first, second, third):
+            self.assertEqual(service_queue.push(service), (True, None))
+        self.assertEqual((service_queue.min_speed, service_queue.max_speed), (fan_speed.LOW, fan_speed.LOW))
+        # 风速相同时不抢占
+        status, _ = service_queue.push(self.new_service('d', fan_speed.LOW))
+        self.assertFalse(status)
+        # 抢占服务时长最长的最低风速对象
+        self.assertEqual(service_queue.push(self.new_service('e', fan_speed.HIGH)), (True, first))
+        self.assertEqual(service_queue.push(self.new_service('f', fan_speed.NORMAL)), (True, second))
+        self.assertEqual((service_queue.min_speed, service_queue.max_speed), (fan_speed.LOW, fan_speed.HIGH))
+        service_queue.remove('c')
+        self.assertEqual(service_queue.min_speed, fan_speed.NORMAL)
+        self.assertEqual(service_queue.has_space(), 1)
+        # 队列非空时不能设置最大服务对象数
+        with self.assertRaises(RuntimeError):
+            service_queue.capacity = 4
+        self.assertEqual(service_queue.capacity, 3)
+
+    def test_wait_queue_pop(self):
+        wait_queue = WaitQueue()
+        self.assertIsNone(wait_queue.pop())
+        services = {}
+        for room_id, speed, wait_time in (('a', fan_speed.LOW, 10), ('b', fan_speed.NORMAL, 120),
+                                          ('c', fan_speed.NORMAL, 30), ('d', fan_speed.LOW, 5)):
+            services[room_id] = self.new_service(room_id, speed)
+            services[room_id].wait_time = wait_time
+            wait_queue.push(services[room_id])
+        self.assertEqual(wait_queue.max_speed, fan_speed.NORMAL)
+        self.assertEqual(wait_queue.update(master_machine_mode.COOL), [])
+        wait_queue.remove('c')
+        self.assertIs(wait_queue.pop(), services['b'])
+        self.assertEqual(wait_queue.max_speed, fan_speed.LOW)
+        self.assertIs(wait_queue.pop(), services['d'])
+        self.assertIs(wait_queue.pop(), services['a'])
+        self.assertTrue(wait_queue.empty())
+        self.assertEqual(wait_queue.max_speed, 0)
+
+
+@unittest.skipIf(engine.numpy is None, 'numpy未安装')
+class VectorizedTickEngineTest(DBTestCase):
+
+    def test_same_as_object_update(self):
+        results = []
+        for tick_engine in (None, engine.VectorizedTickEngine(capacity=2)):
+            service_queue, wait_queue = AirConditionerServiceQueue(), WaitQueue()
+            service_queue.engine = wait_queue.engine = tick_engine
+            services = [QueueTest.new_service(room_id, fan_speed.NORMAL) for room_id in ('a', 'b', 'c', 'd')]
+            services[0].room.target_temp = 27.995
+            for service in services[:3]:
+                service_queue.push(service)
+            status, service = service_queue.push(services[3])
+            self.assertFalse(status)
+            wait_queue.push(service)
+            reached = service_queue.update(master_machine_mode.COOL)
+            self.assertEqual(wait_queue.update(master_machine_mode.COOL), [])
+            self.assertEqual([s.room.room_id for s in reached], ['a'])
+            service_queue.remove('a')
+            self.assertIs(wait_queue.pop(), services[3])
+            results.append([(s.room.current_temp, s.room.fee, s.room.service_time, s.duration, s.wait_time)
+                            for s in services])
+        for expected, actual in zip(*results):
+            for e, a in zip(expected, actual):
+                self.assertAlmostEqual(e, a)
+
+
+class AnalyticEngineTest(DBTestCase):
+
+    def test_evaluate_on_read(self):
+        MasterMachine.instance().set_param(master_machine_mode.COOL, 16, 30, 24, fan_speed.NORMAL, (0.5, 0.75, 1.5))
+        analytic_engine = engine.AnalyticEngine()
+        service_queue = AirConditionerServiceQueue()
+        service_queue.engine = analytic_engine
+        service = QueueTest.new_service('a', fan_speed.HIGH)
+        service.room.target_temp = 27
+        with mock.patch('air_conditioner.engine.time.monotonic', return_value=100):
+            service_queue.push(service)
+            self.assertAlmostEqual(analytic_engine.next_deadline(), 100 + 0.999 * 60)
+        with mock.patch('air_conditioner.engine.time.monotonic', return_value=130):
+            self.assertAlmostEqual(service.room.current_temp, 27.5)
+            self.assertAlmostEqual(service.room.fee, 0.5)
+            self.assertEqual(service.duration, 30)
+            self.assertEqual(service_queue.update(master_machine_mode.COOL), [])
+            # 修改目标温度后重新计算到达时刻
+            service.room.target_temp = 27.4
+            self.assertAlmostEqual(analytic_engine.next_deadline(), 130 + 0.099 * 60)
+        with mock.patch('air_conditioner.engine.time.monotonic', return_value=200):
+            self.assertEqual(service_queue.update(master_machine_mode.COOL), [service])
+            service_queue.remove('a')
+            self.assertAlmostEqual(service.room.current_temp, 27.401)
+            self.assertEqual(analytic_engine.next_deadline(), 200)
+
+
+class MonotonicTimerTest(TestCase):
+
+    def test_catch_up(self):
+        calls = []
+
+        def task(elapsed):
+            calls.append(elapsed)
+            if len(calls) == 1:
+                time.sleep(0.35)
+
+        timer = MonotonicTimer(0.1, task)
+        start = time.monotonic()
+        timer.start()
+        time.sleep(0.62)
+        timer.cancel()
+        timer.join()
+        # 错过的周期被补执行，且总时长与实际经过的时间一致
+        self.assertEqual(timer.overruns, 1)
+        self.assertEqual(timer.missed_ticks, 2)
+        self.assertGreaterEqual(len(calls), 5)
+        self.assertAlmostEqual(sum(calls), time.monotonic() - start, delta=0.15)
+
+    def test_task_error(self):
+        calls = []
+
+        def task(elapsed):
+            calls.append(elapsed)
+            raise RuntimeError('tick failed')
+
+        timer = MonotonicTimer(0.05, task)
+        with self.assertLogs('django', 'ERROR'):
+            timer.start()
+            time.sleep(0.28)
+            timer.cancel()
+            timer.join()
+        # 定时任务抛出异常后定时器继续运行
+        self.assertGreaterEqual(len(calls), 3)
+
+
+class SchedulerTest(TestCase):
+
+    def test_building_error(self):
+        scheduler = Scheduler()
+        broken = mock.Mock(building_id='broken', next_deadline=lambda: 0, _task=mock.Mock(side_effect=RuntimeError))
+        healthy = mock.Mock(building_id='healthy', next_deadline=lambda: 0)
+        with mock.patch.object(Scheduler, '_Scheduler__new_timer'):
+            scheduler.add(broken)
+            scheduler.add(healthy)
+        ticked = []
+        scheduler.add_listener(ticked.append)
+        with self.assertLogs('django', 'ERROR'):
+            scheduler.actor.call(scheduler._task)
+        # 一个楼宇的定时任务失败不影响其他楼宇
+        broken._task.assert_called_once()
+        healthy._task.assert_called_once()
+        self.assertEqual(ticked, ['healthy'])
+
+
+class ActorTest(TestCase):
+
+    def test_single_writer(self):
+        actor = Actor('ActorTest')
+        counter = {'value': 0, 'threads': set()}
+
+        def increment():
+            value = counter['value']
+            time.sleep(0.001)
+            counter['value'] = value + 1
+            counter['threads'].add(get_ident())
+
+        threads = [Thread(target=lambda: [actor.call(increment) for _ in range(20)]) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 并发提交的修改在同一线程中顺序执行，没有丢失更新
+        self.assertEqual(counter['value'], 100)
+        self.assertEqual(len(counter['threads']), 1)
+        # 在执行线程内提交时直接执行，异常通过Future返回
+        self.assertEqual(actor.call(lambda: actor.call(lambda: 1) + 1), 2)
+        with self.assertRaises(ZeroDivisionError):
+            actor.call(lambda: 1 / 0)
+
+
+class DBWriterTest(DBTestCase):
+
+    def test_write_behind(self):
+        count = DBFacade.exec(Log.objects.count)
+        for _ in range(3):
+            DBFacade.create(Log, room_id='writer', operation=operations.POWER_ON, op_time=datetime.datetime.now())
+        # exec前等待已提交的写入完成
+        self.assertEqual(DBFacade.exec(Log.objects.count), count + 3)
+        # 只读查询不等待写入线程
+        with mock.patch.object(DBFacade, 'flush') as flush:
+            logs = DBFacade.query(Log.objects.filter, room_id='writer')
+            flush.assert_not_called()
+        self.assertIsInstance(logs, list)
+        self.assertEqual(len(logs), 3)
+
+    def test_listeners(self):
+        # 写入监听器在事务内调用，提交监听器在事务提交后调用
+        calls = []
+        listener = lambda batch: calls.append(('write', connection.in_atomic_block))
+        commit_listener = lambda batch: calls.append(('commit', connection.in_atomic_block))
+        DBFacade.add_listener(listener)
+        DBFacade.add_commit_listener(commit_listener)
+        try:
+            DBFacade.create(Log, room_id='listener', operation=operations.POWER_ON, op_time=datetime.datetime.now())
+            DBFacade.flush()
+        finally:
+            DBFacade._listeners.remove(listener)
+            DBFacade._commit_listeners.remove(commit_listener)
+        self.assertEqual(calls, [('write', True), ('commit', False)])
+
+
+class ReportTest(DBTestCase):
+
+    def test_aggregate_report(self):
+        start = datetime.datetime(2019, 6, 1, 8)
+        for minutes, speed, fee in ((0, fan_speed.LOW, 0.5), (10, fan_speed.HIGH, 1.5)):
+            DBFacade.create(DetailModel, room_id='report', start_time=start + datetime.timedelta(minutes=minutes),
+                            finish_time=start + datetime.timedelta(minutes=minutes + 1),
+                            speed=speed, fee_rate=fee, fee=fee)
+        for operation in (operations.POWER_ON, operations.DISPATCH, operations.CHANGE_TEMP,
+                          operations.CHANGE_TEMP, operations.POWER_OFF):
+            DBFacade.create(Log, room_id='report', operation=operation, op_time=start)
+        # 查询不等待写入线程
+        DBFacade.flush()
+        report = MasterMachine.instance().get_report('report', datetime.datetime(2019, 6, 1),
+                                                     datetime.datetime(2019, 6, 1, 23, 59, 59))
+        self.assertEqual(report.duration, 120)
+        self.assertEqual(report.fee, 2.0)
+        self.assertEqual(report.number_of_detail, 2)
+        self.assertEqual((report.times_of_on_off, report.times_of_dispatch, report.times_of_change_temp,
+                          report.times_of_change_speed), (2, 1, 2, 0))
+        empty = MasterMachine.instance().get_report('report', datetime.datetime(2019, 7, 1),
+                                                    datetime.datetime(2019, 7, 1, 23, 59, 59))
+        self.assertEqual((empty.duration, empty.fee, empty.number_of_detail), (0, 0.0, 0))
+
+    def test_rollup(self):
+        start = datetime.datetime(2019, 6, 2, 8, 30)
+        for days in (0, 1):
+            DBFacade.create(DetailModel, room_id='rollup', start_time=start + datetime.timedelta(days=days),
+                            finish_time=start + datetime.timedelta(days=days, minutes=2),
+                            speed=fan_speed.NORMAL, fee_rate=1.0, fee=1.0)
+            DBFacade.create(Log, room_id='rollup', operation=operations.CHANGE_SPEED,
+                            op_time=start + datetime.timedelta(days=days))
+        DBFacade.flush()
+        master_machine = MasterMachine.instance()
+        expected = {
+            # 整日走日记录，首尾不足一日的部分按小时汇总
+            (datetime.datetime(2019, 6, 2), datetime.datetime(2019, 6, 3, 23, 59, 59)): (240, 2, 2),
+            (datetime.datetime(2019, 6, 2, 8), datetime.datetime(2019, 6, 3, 8, 59, 59)): (240, 2, 2),
+            (datetime.datetime(2019, 6, 2, 9), datetime.datetime(2019, 6, 3, 23, 59, 59)): (120, 1, 1),
+            (datetime.datetime(2019, 6, 2, 9), datetime.datetime(2019, 6, 3, 7, 59, 59)): (0, 0, 0),
+        }
+        for _ in range(2):
+            for (start_time, finish_time), result in expected.items():
+                report = master_machine.get_report('rollup', start_time, finish_time)
+                self.assertEqual((report.duration, report.number_of_detail, report.times_of_change_speed), result)
+            # 重建后的预聚合记录与增量维护的一致
+            DBFacade.exec(rollup.backfill)
+
+    def test_building_report(self):
+        start = datetime.datetime(2017, 3, 1, 10)
+        for room_id, minutes, fee in (('b1', 3, 1.0), ('b2', 1, 4.0), ('b3', 2, 2.0), ('b1', 1, 0.5)):
+            DBFacade.create(DetailModel, room_id=room_id, start_time=start,
+                            finish_time=start + datetime.timedelta(minutes=minutes),
+                            speed=fan_speed.HIGH, fee_rate=1.5, fee=fee)
+        DBFacade.flush()
+        master_machine = MasterMachine.instance()
+        report = master_machine.get_building_report(['b1', 'b2', 'b3', 'b4'], datetime.datetime(2017, 3, 1),
+                                                    datetime.datetime(2017, 3, 1, 23, 59, 59), 2, 'service_time')
+        self.assertEqual([(room.room_id, room.duration, room.fee) for room in report.reports],
+                         [('b1', 240, 1.5), ('b2', 60, 4.0), ('b3', 120, 2.0), ('b4', 0, 0)])
+        self.assertEqual((report.total.duration, report.total.fee, report.total.number_of_detail), (420, 7.5, 4))
+        self.assertEqual([room.room_id for room in report.top], ['b1', 'b3'])
+        lines = list(BuildingReportFile(report).stream())
+        self.assertEqual(len(lines), 3 + 4 + 1 + 1 + 2)
+        self.assertEqual(lines[7], '\r\nTOTAL, 0, 0, 0, 0, 4, 420, 7.5')
+        everyone = master_machine.get_building_report(None, datetime.datetime(2017, 3, 1),
+                                                      datetime.datetime(2017, 3, 1, 23, 59, 59))
+        self.assertIsNone(everyone.top)
+        self.assertTrue({'b1', 'b2', 'b3', '309c'} <= {room.room_id for room in everyone.reports})
+        with self.assertRaises(RuntimeError):
+            master_machine.get_building_report(None, start, start, 1, 'speed')
+        # 各分片分别统计的报表合并后与一次统计的相同
+        parts = [master_machine.get_building_report(room_ids, datetime.datetime(2017, 3, 1),
+                                                    datetime.datetime(2017, 3, 1, 23, 59, 59))
+                 for room_ids in (['b2', 'b4'], ['b1', 'b3'])]
+        merged = BuildingReport.merge(parts, 2, 'service_time')
+        self.assertEqual([room.room_id for room in merged.reports], ['b1', 'b2', 'b3', 'b4'])
+        self.assertEqual((merged.total.duration, merged.total.fee, merged.total.number_of_detail), (420, 7.5, 4))
+        self.assertEqual([room.room_id for room in merged.top], ['b1', 'b3'])
+
+    def test_report_cache(self):
+        report_service = ReportService.instance()
+        date = datetime.datetime(2019, 6, 5)
+        with mock.patch.object(MasterMachine, 'get_report', wraps=MasterMachine.instance().get_report) as get_report:
+            self.assertEqual(report_service.get_report('cache', 'day', date).number_of_detail, 0)
+            with mock.patch.object(DBFacade, 'flush') as flush:
+                report_service.get_report('cache', 'day', date)
+                flush.assert_not_called()
+            self.assertEqual(get_report.call_count, 1)
+            # 其他时段的写入不影响缓存
+            DBFacade.create(Log, room_id='cache', operation=operations.POWER_ON, op_time=date - datetime.timedelta(1))
+            report_service.get_report('cache', 'day', date)
+            self.assertEqual(get_report.call_count, 1)
+            DBFacade.create(DetailModel, room_id='cache', start_time=date, finish_time=date, speed=fan_speed.LOW,
+                            fee_rate=0.5, fee=0)
+            # 缓存命中时不等待写入线程，提交后报表失效
+            DBFacade.flush()
+            self.assertEqual(report_service.get_report('cache', 'day', date).number_of_detail, 1)
+            self.assertEqual(get_report.call_count, 2)
+
+    def test_report_cache_eviction(self):
+        cache = ReportCache(capacity=2)
+        reports = [Report('lru', datetime.datetime(2019, 6, day), datetime.datetime(2019, 6, day, 23, 59, 59),
+                          0, 0, 0, 0, 0, 0, 0) for day in (1, 2, 3)]
+        for report in reports[:2]:
+            cache.put(('lru', 'day', report.start_time), report, cache.generation('lru'))
+        cache.get(('lru', 'day', reports[0].start_time))
+        cache.put(('lru', 'day', reports[2].start_time), reports[2], cache.generation('lru'))
+        self.assertIsNone(cache.get(('lru', 'day', reports[1].start_time)))
+        self.assertIs(cache.get(('lru', 'day', reports[0].start_time)), reports[0])
+        # 计算期间该房间发生失效的报表不写入缓存，其他房间的失效不影响
+        generation = cache.generation('lru')
+        cache.invalidate([Log(room_id='lru', operation=operations.POWER_ON, op_time=reports[2].start_time)])
+        self.assertIsNone(cache.get(('lru', 'day', reports[2].start_time)))
+        cache.put(('lru', 'day', reports[2].start_time), reports[2], generation)
+        self.assertEqual(len(cache), 1)
+        generation = cache.generation('lru')
+        cache.invalidate([Log(room_id='other', operation=operations.POWER_ON, op_time=reports[2].start_time)])
+        cache.put(('lru', 'day', reports[2].start_time), reports[2], generation)
+        self.assertEqual(len(cache), 2)
+
+
+class RoomRegistryTest(DBTestCase):
+
+    def test_add_remove_room(self):
+        master_machine = self.new_master_machine()
+        self.assertEqual(len(master_machine.rooms), 5)
+        self.assertEqual(master_machine.get_room('309c').room_id, '309c')
+        master_machine.add_room('401a')
+        self.assertIn('401a', master_machine.rooms)
+        with self.assertRaises(RuntimeError):
+            master_machine.add_room('401a')
+        master_machine.check_in('309c')
+        with self.assertRaises(RuntimeError):
+            master_machine.remove_room('309c')
+        master_machine.remove_room('310c')
+        with self.assertRaises(RuntimeError):
+            master_machine.get_room('310c')
+        # 重新加载时以数据库中的房间定义为准
+        registry = RoomRegistry()
+        registry.load()
+        self.assertEqual(sorted(room.room_id for room in registry), ['309c', '311c', '312c', '401a', 'f3'])
+
+
+class StayTest(DBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.master_machine = self.new_master_machine()
+        self.master_machine.check_in('311c')
+        check_in_time = self.master_machine.get_room('311c').check_in_time
+        for fee in (1.25, 0.5, 0.75):
+            DBFacade.create(DetailModel, room_id='311c', start_time=check_in_time, finish_time=check_in_time,
+                            speed=fan_speed.NORMAL, fee_rate=1.0, fee=fee)
+
+    def test_settle_after_check_out(self):
+        # 退房在调度线程中执行，不查询数据库
+        with mock.patch.object(DBFacade, 'query') as query:
+            self.master_machine.check_out('311c')
+            query.assert_not_called()
+        self.assertIsNone(self.master_machine.get_room('311c').stay)
+        self.assertEqual(self.master_machine.get_invoice('311c').total_fee, 2.5)
+        with mock.patch.object(DBFacade, 'query') as query:
+            self.assertEqual(len(self.master_machine.get_detail('311c')[1]), 3)
+            query.assert_not_called()
+        self.master_machine.check_in('311c')
+        self.assertIsNone(self.master_machine.get_room('311c').stay)
+
+    def test_stream_detail(self):
+        self.master_machine.check_out('311c')
+        # 导出详单文件时逐块查询，不结算
+        check_in_time, check_out_time = self.master_machine.get_stay_time('311c')
+        with mock.patch('air_conditioner.entity.EXPORT_CHUNK_SIZE', 2):
+            detail_file = Detail.get_detail_file('311c', check_in_time,
+                                                 MasterMachine.stream_detail('311c', check_in_time, check_out_time))
+            lines = ''.join(detail_file.stream()).split('\r\n')
+        self.assertEqual([line.split(', ')[-1] for line in lines[2:]], ['1.25', '0.5', '0.75'])
+        self.assertIsNone(self.master_machine.get_room('311c').stay)
+
+
+class DetailExportTest(DBTestCase):
+
+    def test_export(self):
+        start = datetime.datetime(2018, 1, 1)
+        for room_id, minutes in (('e2', 0), ('e1', 5), ('e1', 0), ('e2', 0), ('e1', 3)):
+            DBFacade.create(DetailModel, room_id=room_id, start_time=start + datetime.timedelta(minutes=minutes),
+                            finish_time=start + datetime.timedelta(minutes=minutes + 1),
+                            speed=fan_speed.LOW, fee_rate=0.5, fee=0.5)
+        DBFacade.create(DetailModel, room_id='e1', start_time=start + datetime.timedelta(days=1),
+                        finish_time=start + datetime.timedelta(days=1), speed=fan_speed.LOW, fee_rate=0.5, fee=0)
+        DBFacade.flush()
+        with mock.patch('air_conditioner.entity.EXPORT_CHUNK_SIZE', 2):
+            content = gzip.decompress(b''.join(
+                DetailExport(start, start + datetime.timedelta(days=1)).stream())).decode()
+            lines = [json.loads(line) for line in gzip.decompress(b''.join(
+                DetailExport(start, start + datetime.timedelta(days=1), 'ndjson').stream())).decode().splitlines()]
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], list(DetailExport.FIELDS))
+        self.assertEqual([(row[1], row[2][-5:]) for row in rows[1:]],
+                         [('e1', '00:00'), ('e1', '03:00'), ('e1', '05:00'), ('e2', '00:00'), ('e2', '00:00')])
+        self.assertEqual([line['detail_id'] for line in lines], [int(row[0]) for row in rows[1:]])
+        with self.assertRaises(RuntimeError):
+            DetailExport(start, start, 'xml')
+
+    def test_export_rooms(self):
+        start = datetime.datetime(2018, 2, 1)
+        for room_id in ('x1', 'x2', 'x3'):
+            DBFacade.create(DetailModel, room_id=room_id, start_time=start, finish_time=start,
+                            speed=fan_speed.LOW, fee_rate=0.5, fee=0.5)
+        DBFacade.create(RoomModel, room_id='x2', building_id='archive')
+        self.addCleanup(DBFacade.exec, lambda: RoomModel.objects.filter(room_id='x2').delete())
+        DBFacade.flush()
+        end = start + datetime.timedelta(days=1)
+
+        def exported(*args):
+            content = gzip.decompress(b''.join(DetailExport(start, end, 'csv', *args).stream())).decode()
+            return [row[1] for row in list(csv.reader(io.StringIO(content)))[1:]]
+        # 缺省导出楼宇登记的房间，默认楼宇不包括其他楼宇的房间
+        self.assertEqual(exported(), ['x1', 'x3'])
+        self.assertEqual(exported(None, 'archive'), ['x2'])
+        self.assertEqual(exported(['x3', 'x2']), ['x2', 'x3'])
+        # 导出只读取数据库，主控机未启动时也可导出
+        with override_settings(BUILDINGS={'default': {}, 'archive': {'rooms': []}}):
+            response = self.client.get('/buildings/archive/logger/export_rdr',
+                                       {'start': '2018-2-1', 'end': '2018-2-1'})
+        self.assertEqual(list(csv.reader(io.StringIO(gzip.decompress(b''.join(
+            response.streaming_content)).decode())))[1][1], 'x2')
+
+
+class StatusSnapshotTest(DBTestCase):
+
+    def test_snapshot(self):
+        master_machine = self.new_master_machine()
+        first = master_machine.publish_status()
+        self.assertIs(master_machine.publish_status(), first)
+        self.assertIs(master_machine.status_snapshot(), first)
+        master_machine.check_in('309c')
+        second = master_machine.publish_status()
+        self.assertEqual(second.version, first.version + 1)
+        self.assertEqual(json.loads(second.body.decode())['result'][0]['status'], second.status[0]['status'])
+        with self.assertRaises(TypeError):
+            second.status[0]['status'] = None
+        with mock.patch.object(Controller, 'dispatch', return_value=second):
+            response = check_room_state(RequestFactory().get('/check_room_state'))
+            self.assertEqual((response.status_code, response['ETag']), (200, second.etag))
+            response = check_room_state(RequestFactory().get('/check_room_state',
+                                                             HTTP_IF_NONE_MATCH=first.etag + ', ' + second.etag))
+            self.assertEqual(response.status_code, 304)
+
+    def test_republish_on_actor(self):
+        master_machine = self.new_master_machine()
+        master_machine.actor = Actor('SnapshotTest')
+        first = master_machine.publish_status()
+        publish = MasterMachine.publish_status
+        threads = []
+        # 过期的快照在调度线程中重新发布，不在请求线程中读取房间状态
+        with mock.patch('air_conditioner.entity.UPDATE_FREQUENCY', 0), \
+                mock.patch.object(MasterMachine, 'publish_status', autospec=True,
+                                  side_effect=lambda machine: threads.append(get_ident()) or publish(machine)):
+            master_machine.get_room('309c').check_in()
+            self.assertEqual(master_machine.status_snapshot().version, first.version + 1)
+        self.assertEqual(threads, [master_machine.actor.ident])
+
+    def test_delta(self):
+        master_machine = self.new_master_machine('delta1', 'delta2', 'delta3')
+        first = master_machine.publish_status()
+        delta = json.loads(first.delta(0).decode())['result']
+        self.assertEqual((delta['version'], len(delta['rooms'])), (first.version, len(master_machine.rooms)))
+        room = master_machine.get_room('delta1')
+        room.check_in()
+        room.service_time = 1
+        second = master_machine.publish_status()
+        # 只有服务时长变化的房间不出现在增量中
+        master_machine.get_room('delta2').service_time = 3
+        third = master_machine.publish_status()
+        self.assertEqual(third.version, second.version + 1)
+        delta = json.loads(third.delta(first.version).decode())['result']
+        self.assertEqual([room['room_id'] for room in delta['rooms']], ['delta1'])
+        self.assertEqual(json.loads(third.delta(second.version).decode())['result']['rooms'], [])
+        room.status = room_status.AVAILABLE
+        for room_id in ('delta1', 'delta2', 'delta3'):
+            master_machine.remove_room(room_id)
+        delta = json.loads(master_machine.publish_status().delta(third.version).decode())['result']
+        self.assertEqual((delta['rooms'], delta['removed']), ([], ['delta1', 'delta2', 'delta3']))
+        # 版本号超过当前版本时(如服务重启后)返回全部房间
+        self.assertEqual(len(json.loads(third.delta(third.version + 5).decode())['result']['rooms']),
+                         len(third.status))
+
+    def test_stream(self):
+        master_machine = self.new_master_machine('stream1', 'stream2')
+        first = master_machine.publish_status()
+        stream = master_machine.subscribe_status('stream1')
+        events = stream.events(heartbeat=0.1)
+        version, name, data = next(events)
+        self.assertEqual((version, name, json.loads(data.decode())['room_id']), (first.version, 'status', 'stream1'))
+        self.assertIsNone(next(events))
+        # 其他房间的变化不推送给只订阅stream1的客户端
+        master_machine.get_room('stream2').check_in()
+        master_machine.publish_status()
+        self.assertIsNone(next(events))
+        room = master_machine.get_room('stream1')
+        room.check_in()
+        second = master_machine.publish_status()
+        fragments = {room['room_id']: fragment for room, fragment in zip(second.status, second.fragments)}
+        self.assertEqual(next(events), (second.version, 'status', fragments['stream1']))
+        # 从second恢复的所有房间订阅只收到之后的变化
+        resumed = iter(master_machine.subscribe_status(since=second.version))
+        room.status = room_status.AVAILABLE
+        master_machine.get_room('stream2').status = room_status.AVAILABLE
+        master_machine.remove_room('stream1')
+        third = master_machine.publish_status()
+        fragments = {room['room_id']: fragment for room, fragment in zip(third.status, third.fragments)}
+        self.assertEqual(next(resumed), b'id: %d\nevent: status\ndata: %s\n\n' % (third.version, fragments['stream2']))
+        self.assertEqual(next(resumed), b'id: %d\nevent: removed\ndata: "stream1"\n\n' % third.version)
+        resumed.close()
+        stream.close()
+        self.assertEqual(list(events), [])
+
+    def test_wait_status(self):
+        master_machine = self.new_master_machine('poll1')
+        version, status = master_machine.wait_status('poll1', 0, 5)
+        self.assertEqual(json.loads(status.decode())['room_id'], 'poll1')
+        # 超时时返回当前状态
+        self.assertEqual(master_machine.wait_status('poll1', version, 0.1), (version, status))
+
+        def check_in():
+            time.sleep(0.2)
+            master_machine.get_room('poll1').check_in()
+            master_machine.publish_status()
+        Thread(target=check_in).start()
+        begin = time.monotonic()
+        version, status = master_machine.wait_status('poll1', version, 5)
+        self.assertLess(time.monotonic() - begin, 5)
+        self.assertEqual(json.loads(status.decode())['status'], room_status.CLOSED)
+
+    def test_follow_before_first_snapshot(self):
+        follower = MasterMachine()
+        follower.follow()
+        with self.assertRaisesMessage(RuntimeError, '主控机未启动'):
+            follower.status_snapshot()
+        with mock.patch.object(Controller, 'dispatch', side_effect=lambda **kwargs: follower.status_snapshot()):
+            response = check_room_state(RequestFactory().get('/check_room_state'))
+        self.assertEqual((response.status_code, json.loads(response.content.decode())),
+                         (200, {'message': '主控机未启动'}))
+
+    def test_mirror(self):
+        leader = self.new_master_machine('mirror1')
+        with tempfile.TemporaryDirectory() as directory:
+            shared = SharedStatus(os.path.join(directory, 'status'))
+            leader.add_publish_listener(lambda snapshot: shared.write(True, snapshot))
+            first = leader.publish_status()
+            reader = SharedStatus(os.path.join(directory, 'status'))
+            started, snapshot, changed = reader.read()
+            self.assertTrue(started and changed)
+            self.assertEqual((snapshot.body, snapshot.etag, snapshot.delta(0)), (first.body, first.etag, first.delta(0)))
+            self.assertFalse(reader.read()[2])
+            # 非调度进程采用共享的快照，并向本进程的订阅者发布变化
+            follower = MasterMachine()
+            follower.mirror(snapshot)
+            events = follower.subscribe_status('mirror1', first.version).events(heartbeat=0.1)
+            self.assertIsNone(next(events))
+            leader.get_room('mirror1').check_in()
+            second = leader.publish_status()
+            follower.mirror(reader.read()[1])
+            self.assertEqual(follower.status_snapshot().version, second.version)
+            self.assertEqual(next(events)[:2], (second.version, 'status'))
+            events.close()
+
+
+class ShardMapTest(TestCase):
+
+    def test_shard_of(self):
+        shards = ShardMap({'floor3': {'prefixes': ('3',), 'capacity': 3}, 'suite': {'prefixes': ('30',)},
+                           'floor4': {'prefixes': ('4',)}})
+        self.assertEqual([shards.shard_of(room_id) for room_id in ('309c', '310c', '410b', '101')],
+                         ['suite', 'floor3', 'floor4', 'floor3'])
+        self.assertEqual((shards.capacity('floor3'), shards.capacity('floor4')), (3, None))
+        self.assertEqual(ShardMap(None).shard_of('309c'), 'default')
+
+
+@unittest.skipIf(WebsocketCommunicator is None, '未安装channels')
+class RoomStateConsumerTest(DBTestCase):
+
+    def connect(self, path):
+        return WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+
+    def test_events(self):
+        master_machine = MasterMachine()
+        master_machine.set_param(master_machine_mode.COOL, 16, 30, 24, fan_speed.NORMAL, (0.5, 0.75, 1.5))
+        stream = master_machine.subscribe_status('309c')
+
+        async def run():
+            communicator = self.connect('/main_machine/room_state_events?room_id=309c')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # 先发送房间的当前状态，此后发送状态变化
+            message = json.loads(await communicator.receive_from())
+            self.assertEqual((message['event'], message['data']['room_id']), ('status', '309c'))
+            master_machine.get_room('309c').check_in()
+            master_machine.publish_status()
+            message = json.loads(await communicator.receive_from())
+            self.assertEqual(message['data']['status'], room_status.CLOSED)
+            await communicator.disconnect()
+
+        with mock.patch.object(Controller, 'dispatch', return_value=stream) as dispatch, \
+                mock.patch.object(stream, 'close', wraps=stream.close) as close:
+            async_to_sync(run)()
+        self.assertEqual(dispatch.call_args[1]['room_id'], '309c')
+        close.assert_called()
+        master_machine.get_room('309c').status = room_status.AVAILABLE
+
+    def test_error(self):
+        async def run():
+            communicator = self.connect('/buildings/north/main_machine/room_state_events')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(json.loads(await communicator.receive_from()), {'message': '楼宇不存在'})
+            self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+
+        async_to_sync(run)()
+
+
+# 多进程测试中的工作进程: 逐行读取dispatch的参数并输出结果，参数为空时输出本进程主控机的房间号
+CLUSTER_WORKER = """
+import json, sys
+import django
+django.setup()
+from air_conditioner.controller import Controller
+from air_conditioner.entity import MasterMachine
+controller = Controller.instance()
+for line in sys.stdin:
+    kwargs = json.loads(line)
+    try:
+        if kwargs:
+            result = controller.dispatch(**kwargs)
+            reply = {'message': 'OK', 'result': ''.join(result.stream()) if hasattr(result, 'stream') else result}
+        else:
+            reply = {'message': 'OK', 'result': sorted(room.room_id for room in MasterMachine.instance().rooms)}
+    except RuntimeError as error:
+        reply = {'message': str(error)}
+    print(json.dumps(reply), flush=True)
+"""
+
+
+@unittest.skipIf(cluster.fcntl is None, '当前平台不支持多进程部署')
+class ClusterForwardTest(TestCase):
+    """不竞选分片，直接在本进程中启动分片a的转发服务"""
+
+    def setUp(self):
+        # 转发服务的套接字在进程退出时才删除，不删除临时目录
+        self.directory = tempfile.mkdtemp()
+        self.shards = ShardMap({'a': {}})
+
+    def test_unpicklable_reply(self):
+        server = cluster.Cluster(self.directory, self.shards, lambda **kwargs: (i for i in ()), None)
+        server.shard = 'a'
+        server._Cluster__serve()
+        client = cluster.Cluster(self.directory, self.shards, None, None)
+        # 结果无法序列化时返回错误，处理连接的线程继续服务
+        for _ in range(2):
+            with self.assertRaisesMessage(RuntimeError, '处理结果无法发送'):
+                client.forward('a', {})
+
+    def test_no_resend(self):
+        requests = []
+        os.makedirs(os.path.join(self.directory, 'shards', 'a'))
+        listener = Listener(os.path.join(self.directory, 'shards', 'a', 'scheduler.sock'), 'AF_UNIX',
+                            authkey=settings.SECRET_KEY.encode())
+
+        def serve():
+            # 收到请求后不回复就断开，如同调度进程处理后退出
+            with listener.accept() as connection:
+                requests.append(connection.recv())
+        thread = Thread(target=serve)
+        thread.start()
+        client = cluster.Cluster(self.directory, self.shards, None, None)
+        with self.assertRaisesMessage(RuntimeError, '请求可能已处理'):
+            client.forward('a', {'service': 'ADMINISTRATOR', 'operation': 'check in', 'room_id': '309c'})
+        thread.join()
+        listener.close()
+        self.assertEqual(len(requests), 1)
+
+
+@unittest.skipIf(cluster.fcntl is None, '当前平台不支持多进程部署')
+class ClusterTest(TestCase):
+    """在临时目录中以独立的数据库、CLUSTER_DIR和STATE_DIR运行多个工作进程"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, 'cluster_settings.py'), 'w') as file:
+            file.write('from AirConController.settings import *\n'
+                       'DATABASES["default"]["NAME"] = {!r}\n'
+                       'CLUSTER_DIR = {!r}\n'
+                       'STATE_DIR = {!r}\n'
+                       'SCHEDULER_SHARDS = {{"a": {{"prefixes": ("309", "310")}}, "b": {{"prefixes": ("31",)}}}}\n'
+                       'LOGGING = {{"version": 1, "disable_existing_loggers": False}}\n'
+                       .format(os.path.join(self.directory.name, 'db.sqlite3'),
+                               os.path.join(self.directory.name, 'cluster'),
+                               os.path.join(self.directory.name, 'state')))
+        self.env = dict(os.environ, DJANGO_SETTINGS_MODULE='cluster_settings',
+                        PYTHONPATH=os.pathsep.join([self.directory.name, os.getcwd()]))
+        subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'], env=self.env, check=True)
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.wait()
+            worker.stdin.close()
+            worker.stdout.close()
+        self.directory.cleanup()
+
+    def start_worker(self):
+        worker = subprocess.Popen([sys.executable, '-c', CLUSTER_WORKER], env=self.env, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.workers.append(worker)
+        return worker
+
+    @staticmethod
+    def call(worker, **kwargs):
+        worker.stdin.write(json.dumps(kwargs) + '\n')
+        worker.stdin.flush()
+        return json.loads(worker.stdout.readline())
+
+    def test_election_and_takeover(self):
+        # 先启动的进程依次当选分片a、b的调度进程，第三个进程不负责分片，持有全部房间
+        first = self.start_worker()
+        self.assertEqual(self.call(first)['result'], ['309c', '310c', 'f3'])
+        second = self.start_worker()
+        self.assertEqual(self.call(second)['result'], ['311c', '312c'])
+        third = self.start_worker()
+        self.assertEqual(len(self.call(third)['result']), 5)
+        # 开机、设置参数和启动发给所有分片，房间请求转发给房间所在分片
+        self.call(third, service='ADMINISTRATOR', operation='power on')
+        self.call(third, service='ADMINISTRATOR', operation='set param', mode=master_machine_mode.COOL,
+                  temp_low_limit=16, temp_high_limit=30, default_target_temp=24, default_speed=fan_speed.NORMAL,
+                  fee_rate=[0.5, 0.75, 1.5])
+        self.call(third, service='ADMINISTRATOR', operation='start')
+        for room_id, worker in (('309c', third), ('311c', first)):
+            self.assertEqual(self.call(worker, service='ADMINISTRATOR', operation='check in', room_id=room_id),
+                             {'message': 'OK', 'result': None})
+            reply = self.call(worker, service='POWER', operation='power on', room_id=room_id, current_temp=28)
+            self.assertEqual(reply['result']['status'], room_status.SERVING)
+        # 分片a的调度进程退出后，第三个进程接管分片a并由状态日志恢复
+        first.kill()
+        first.wait()
+        deadline = time.monotonic() + 10
+        while self.call(third)['result'] != ['309c', '310c', 'f3']:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.1)
+        self.assertEqual(self.call(second, service='POWER', operation='power on', room_id='309c', current_temp=28),
+                         {'message': '房间已开机或入住'})
+        self.call(second, service='ADMINISTRATOR', operation='check in', room_id='310c')
+        reply = self.call(second, service='POWER', operation='power on', room_id='310c', current_temp=28)
+        self.assertEqual(reply['result']['status'], room_status.SERVING)
+        # 打印详单时只向分片获取入住时间段，详单文件在请求进程中生成
+        self.call(second, service='POWER', operation='power off', room_id='309c')
+        self.call(second, service='ADMINISTRATOR', operation='check out', room_id='309c')
+        reply = self.call(second, service='DETAIL', operation='print detail', room_id='309c')
+        self.assertEqual(reply['result'].split('\r\n')[0], 'ROOM ID, 309c')
+
+
+@override_settings(BUILDINGS={'default': {}, 'north': {'rooms': ['n101', 'n102'], 'capacity': 1}})
+class BuildingTest(DBTestCase):
+
+    def test_buildings(self):
+        with self.assertRaises(RuntimeError):
+            Controller.instance().dispatch(service='ADMINISTRATOR', operation='power on', building_id='south')
+        controller = self.start_building('north', ('n101', 'n102'), 20, mode=master_machine_mode.HOT,
+                                         temp_low_limit=18, temp_high_limit=28, default_target_temp=26,
+                                         default_speed=fan_speed.HIGH, fee_rate=(1, 2, 3))
+        # 楼宇的房间、参数和服务队列容量相互独立，定时任务由共用的调度线程执行
+        self.tick('north')
+        status = {room['room_id']: room for room in
+                  controller.dispatch(service='ADMINISTRATOR', operation='get status', building_id='north')}
+        self.assertEqual(sorted(status), ['n101', 'n102'])
+        self.assertEqual(sorted(room['status'] for room in status.values()),
+                         sorted([room_status.SERVING, room_status.WAITING]))
+        self.assertEqual({room['fee_rate'] for room in status.values()}, {3})
+        self.assertGreater(sum(room['fee'] for room in status.values()), 0)
+        self.assertIs(UpdateService.instance('north').actor, UpdateService.instance().actor)
+        self.assertNotIn('n101', MasterMachine.instance().rooms)
+        response = self.client.get('/buildings/north/main_machine/check_room_state')
+        self.assertEqual({room['room_id'] for room in response.json()['result']}, {'n101', 'n102'})
+
+
+@override_settings(BUILDINGS={'default': {}, 'east': {'rooms': ['e101', 'e102'], 'capacity': 1}})
+class JournalTest(DBTestCase):
+
+    def test_load(self):
+        directory = tempfile.mkdtemp()
+        state = {'started': False, 'master': {}, 'rooms': {'a': ('a', 1), 'b': ('b', 1)}, 'serving': [],
+                 'waiting': []}
+        log = journal.Journal(directory)
+        log.record('x', state)
+        log.record('x', dict(state, started=True, rooms={'a': ('a', 2)}))
+        with open(os.path.join(directory, 'journal'), 'ab') as file:
+            file.write(b'\x00\x00\x01')
+        # 写了一半的记录被丢弃，恢复到最后一条完整记录的状态
+        log = journal.Journal(directory)
+        self.assertEqual(log.states['x'], dict(state, started=True, rooms={'a': ('a', 2)}))
+        log.checkpoint()
+        log.record('x', state)
+        self.assertEqual(journal.Journal(directory).states['x'], state)
+
+    def test_restore(self):
+        self.start_building('east', ('e101', 'e102'), 28, default_target_temp=20)
+        self.tick('east')
+        actor = UpdateService.instance('east').actor
+        state = actor.call(journal.capture, 'east', True)
+        self.assertEqual([service[0] for service in state['serving']], ['e101'])
+        self.assertEqual([service[0] for service in state['waiting']], ['e102'])
+        fee = state['rooms']['e101'][5]
+        self.assertGreater(fee, 0)
+
+        def lose_state():
+            # 模拟重启: 内存中的队列和房间状态丢失
+            for room_id in ('e101', 'e102'):
+                AirConditionerServiceQueue.instance('east').remove(room_id)
+                WaitQueue.instance('east').remove(room_id)
+                room = MasterMachine.instance('east').get_room(room_id)
+                room.fee = 0
+                room.status = room_status.CLOSED
+
+        actor.call(lose_state)
+        self.assertTrue(actor.call(journal.restore, 'east', state))
+        self.assertEqual(list(AirConditionerServiceQueue.instance('east').queue), ['e101'])
+        self.assertEqual(list(WaitQueue.instance('east').queue), ['e102'])
+        room = MasterMachine.instance('east').get_room('e101')
+        self.assertAlmostEqual(room.fee, fee, delta=0.1)
+        self.assertEqual(room.status, room_status.SERVING)
+
+
+class ControllerTest(DBTestCase):
 
     def test_api(self):
         # 取得控制器对象
@@ -42,6 +988,9 @@ class ControllerTest(TestCase):
         # 获取费用
         room_status = controller.dispatch(service='GET_FEE', room_id='309c')
         print(room_status)
+        # 长轮询获取费用，客户端版本落后时立即返回
+        version, fee_status = controller.dispatch(service='GET_FEE', room_id='309c', version=0, timeout=5)
+        self.assertEqual(json.loads(fee_status.decode())['room_id'], '309c')
         # 房间关机
         controller.dispatch(service='POWER', operation='power off', room_id='309c')
         # 退房
@@ -49,16 +998,19 @@ class ControllerTest(TestCase):
         # 获取详单
         details = controller.dispatch(service='DETAIL', operation='query detail', room_id='309c')
         # 打印详单
-        filename = controller.dispatch(service='DETAIL', operation='print detail', room_id='309c')
+        detail_file = controller.dispatch(service='DETAIL', operation='print detail', room_id='309c')
+        self.assertEqual(''.join(detail_file.stream()).split('\r\n')[0], 'ROOM ID, 309c')
         # 获取账单
         invoice = controller.dispatch(service='INVOICE', operation='query invoice', room_id='309c')
         # 打印账单
-        filename = controller.dispatch(service='INVOICE', operation='print invoice', room_id='309c')
+        invoice_file = controller.dispatch(service='INVOICE', operation='print invoice', room_id='309c')
+        self.assertEqual(len(list(invoice_file.stream())), 4)
         # 获取报表
         report = controller.dispatch(service='REPORT', operation='query report', room_id='309c',
                                      date=datetime.datetime.now(), qtype='day')
-        filename = controller.dispatch(service='REPORT', operation='print report', room_id='309c',
-                                       date=datetime.datetime.now(), qtype='day')
+        report_file = controller.dispatch(service='REPORT', operation='print report', room_id='309c',
+                                          date=datetime.datetime.now(), qtype='day')
+        self.assertEqual(len(list(report_file.stream())), 10)
         # 主机关机
         controller.dispatch(service='ADMINISTRATOR', operation='stop')
 
@@ -87,6 +1039,80 @@ class ControllerTest(TestCase):
         time.sleep(10)
         controller.dispatch(service='ADMINISTRATOR', operation='stop')
 
+    def test_batch(self):
+        controller = Controller.instance()
+        controller.dispatch(service='ADMINISTRATOR', operation='power on')
+        controller.dispatch(service='ADMINISTRATOR', operation='set param', mode=master_machine_mode.COOL,
+                            temp_low_limit=16, temp_high_limit=30, default_target_temp=24,
+                            default_speed=fan_speed.NORMAL, fee_rate=(0.5, 0.75, 1.5))
+        controller.dispatch(service='ADMINISTRATOR', operation='start')
+        room_ids = ('309c', '310c', '311c', '312c')
+        commands = [{'service': 'ADMINISTRATOR', 'operation': 'check in', 'room_id': room_id} for room_id in room_ids]
+        commands += [{'service': 'POWER', 'operation': 'power on', 'room_id': room_id, 'current_temp': 28}
+                     for room_id in room_ids]
+        commands += [{'service': 'SLAVE', 'operation': 'change speed', 'room_id': '312c', 'target_speed': fan_speed.HIGH},
+                     {'service': 'SLAVE', 'operation': 'change speed', 'room_id': '309c', 'target_speed': fan_speed.LOW},
+                     {'service': 'POWER', 'operation': 'power on', 'room_id': 'none', 'current_temp': 28},
+                     {'service': 'ADMINISTRATOR', 'operation': 'get status'}]
+        request = RequestFactory().post('/slave/batch', json.dumps({'commands': commands}),
+                                        content_type='application/json')
+        with mock.patch.object(AirConditionerServiceQueue, 'push', autospec=True,
+                               side_effect=AirConditionerServiceQueue.push) as push:
+            content = json.loads(batch(request).content.decode())
+        self.assertEqual(content['message'], 'OK')
+        self.assertEqual([result['message'] for result in content['result']],
+                         ['OK'] * 10 + ['房间号不存在', '批量请求不支持该操作'])
+        # 开机和改变风速后暂存服务，整批处理完后每个房间只放入服务队列一次，按最终风速调度而没有换出
+        self.assertEqual(push.call_count, 4)
+        self.assertEqual(content['result'][4]['result']['status'], content['result'][7]['result']['status'])
+        statuses = {room_id: MasterMachine.instance().get_room(room_id).status for room_id in room_ids}
+        self.assertEqual(statuses, {'309c': room_status.WAITING, '310c': room_status.SERVING,
+                                    '311c': room_status.SERVING, '312c': room_status.SERVING})
+        self.assertEqual(controller.dispatch(service='ADMINISTRATOR', operation='get status snapshot').status[0]
+                         ['room_id'], '309c')
+
+        commands = [{'service': 'POWER', 'operation': 'power off', 'room_id': room_id} for room_id in room_ids]
+        commands += [{'service': 'ADMINISTRATOR', 'operation': 'check out', 'room_id': room_id}
+                     for room_id in room_ids]
+        request = RequestFactory().post('/slave/batch', json.dumps({'commands': commands}),
+                                        content_type='application/json')
+        self.assertEqual([result['message'] for result in json.loads(batch(request).content.decode())['result']],
+                         ['OK'] * 8)
+        request = RequestFactory().post('/slave/batch', 'commands', content_type='application/json')
+        self.assertEqual(json.loads(batch(request).content.decode())['message'], '请求体不合法')
+        controller.dispatch(service='ADMINISTRATOR', operation='stop')
+
+    def test_batch_invalid(self):
+        self.start_building('default', (), 28)
+        commands = [{'service': 'ADMINISTRATOR', 'operation': 'check in', 'room_id': room_id}
+                    for room_id in ('309c', '310c', '311c')]
+        commands += [{'service': 'POWER', 'operation': 'power on', 'room_id': '309c', 'current_temp': 29},
+                     {'service': 'POWER', 'operation': 'power on', 'room_id': '310c', 'current_temp': '28'},
+                     {'service': 'POWER', 'operation': 'power on', 'room_id': '311c', 'current_temp': 'hot'},
+                     {'service': 'SLAVE', 'operation': 'change speed', 'room_id': '309c', 'target_speed': [3]}]
+        for room_id in ('309c', '310c', '311c'):
+            self.addCleanup(Controller.instance().dispatch, service='ADMINISTRATOR', operation='check out',
+                            room_id=room_id)
+            if room_id != '311c':
+                self.addCleanup(Controller.instance().dispatch, service='POWER', operation='power off',
+                                room_id=room_id)
+        queue_push = AirConditionerServiceQueue.push
+
+        def push(service_queue, service):
+            if service.room.room_id == '309c':
+                raise TypeError('push failed')
+            return queue_push(service_queue, service)
+        # 参数在处理前转换，放入队列失败的服务不影响同一批的其余服务
+        request = RequestFactory().post('/slave/batch', json.dumps({'commands': commands}),
+                                        content_type='application/json')
+        with mock.patch.object(AirConditionerServiceQueue, 'push', autospec=True, side_effect=push):
+            content = json.loads(batch(request).content.decode())
+        self.assertEqual([result['message'] for result in content['result']],
+                         ['OK'] * 5 + ['参数current_temp不合法', '参数target_speed不合法'])
+        room = MasterMachine.instance().get_room('310c')
+        self.assertEqual((room.current_temp, room.status), (28.0, room_status.SERVING))
+        self.assertEqual(MasterMachine.instance().get_room('311c').status, room_status.CLOSED)
+
     def get_status(self):
         controller = Controller.instance()
         # 监视空调
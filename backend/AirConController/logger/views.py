@@ -3,11 +3,47 @@ import datetime
 from django.http import JsonResponse, StreamingHttpResponse
 
 from air_conditioner.controller import Controller
+from utils import DEFAULT_BUILDING
 
 
 # Create your views here.
 
-def query_report(request):
+def attachment(csv_file):
+    """将详单、账单、报表或导出文件的内容逐块写入响应，不落地为文件"""
+    response = StreamingHttpResponse(csv_file.stream())
+    response['Content-Type'] = 'application/octet-stream'
+    response['Content-Disposition'] = 'attachment;filename="' + csv_file.filename + '"'
+    return response
+
+
+def report_result(report):
+    return {
+        'room_id': report.room_id,
+        'on_off_times': report.times_of_on_off,
+        'service_time': report.duration,
+        'fee': report.fee,
+        'dispatch_times': report.times_of_dispatch,
+        'rdr_number': report.number_of_detail,
+        'change_temp_times': report.times_of_change_temp,
+        'change_speed_times': report.times_of_change_speed,
+    }
+
+
+def building_report_args(request):
+    """解析多个房间报表的请求参数, room_ids为逗号分隔的房间号"""
+    date_get_sp = request.GET.get('date').split("-")
+    room_ids_get = request.GET.get('room_ids')
+    top_get = request.GET.get('top')
+    return {
+        'qtype': request.GET.get('qtype'),
+        'date': datetime.datetime(int(date_get_sp[0]), int(date_get_sp[1]), int(date_get_sp[2])),
+        'room_ids': room_ids_get.split(',') if room_ids_get else None,
+        'top': int(top_get) if top_get else None,
+        'order_by': request.GET.get('order_by', 'fee'),
+    }
+
+
+def query_report(request, building_id=DEFAULT_BUILDING):
     qtype_get = request.GET.get('qtype')
     room_id_get = request.GET.get('room_id')
     date_get = request.GET.get('date')
@@ -17,25 +53,16 @@ def query_report(request):
         controller = Controller.instance()
         content = controller.dispatch(service='REPORT', operation='query report',
                                       room_id=room_id_get, date=date_get_da,
-                                      qtype=qtype_get)
+                                      qtype=qtype_get, building_id=building_id)
         content = {'message': "OK",
-                   'result': {
-                       'room_id': content.room_id,
-                       'on_off_times': content.times_of_on_off,
-                       'service_time': content.duration,
-                       'fee': content.fee,
-                       'dispatch_times': content.times_of_dispatch,
-                       'rdr_number': content.number_of_detail,
-                       'change_temp_times': content.times_of_change_temp,
-                       'change_speed_times': content.times_of_change_speed,
-                   }
+                   'result': report_result(content)
                    }
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def print_report(request):
+def print_report(request, building_id=DEFAULT_BUILDING):
     qtype_get = request.GET.get('qtype')
     room_id_get = request.GET.get('room_id')
     date_get = request.GET.get('date')
@@ -43,22 +70,46 @@ def print_report(request):
     date_get_da = datetime.datetime(int(date_get_sp[0]), int(date_get_sp[1]), int(date_get_sp[2]))
     try:
         controller = Controller.instance()
-        filename = controller.dispatch(service='REPORT', operation='print report', room_id=room_id_get, date=date_get_da,
-                            qtype=qtype_get)
-        file = open(filename, 'r')
-        response = StreamingHttpResponse(file)
-        response['Content-Type'] = 'application/octet-stream'
-        response['Content-Disposition'] = 'attachment;filename="' + filename + '"'
-        return response
+        csv_file = controller.dispatch(service='REPORT', operation='print report', room_id=room_id_get, date=date_get_da,
+                                       qtype=qtype_get, building_id=building_id)
+        return attachment(csv_file)
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def query_building_report(request, building_id=DEFAULT_BUILDING):
+    try:
+        controller = Controller.instance()
+        content = controller.dispatch(service='REPORT', operation='query building report',
+                                      **building_report_args(request), building_id=building_id)
+        content = {'message': 'OK',
+                   'result': {
+                       'rooms': [report_result(report) for report in content.reports],
+                       'total': report_result(content.total),
+                       'top': [report_result(report) for report in content.top] if content.top is not None else None,
+                   }
+                   }
+        return JsonResponse(content)
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def print_building_report(request, building_id=DEFAULT_BUILDING):
+    try:
+        controller = Controller.instance()
+        csv_file = controller.dispatch(service='REPORT', operation='print building report',
+                                       **building_report_args(request), building_id=building_id)
+        return attachment(csv_file)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def query_invoice(request):
+def query_invoice(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        content = controller.dispatch(service='INVOICE', operation='query invoice', room_id=room_id_get)
+        content = controller.dispatch(service='INVOICE', operation='query invoice', room_id=room_id_get,
+                                      building_id=building_id)
         content = {'message': 'OK',
                    'result': {
                        'room_id': content.room_id,
@@ -72,25 +123,23 @@ def query_invoice(request):
         return JsonResponse({'message': str(error)})
 
 
-def print_invoice(request):
+def print_invoice(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        filename = controller.dispatch(service='INVOICE', operation='print invoice', room_id=room_id_get)
-        file = open(filename, 'r')
-        response = StreamingHttpResponse(file)
-        response['Content-Type'] = 'application/octet-stream'
-        response['Content-Disposition'] = 'attachment;filename="' + filename + '"'
-        return response
+        csv_file = controller.dispatch(service='INVOICE', operation='print invoice', room_id=room_id_get,
+                                       building_id=building_id)
+        return attachment(csv_file)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def query_rdr(request):
+def query_rdr(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        content = controller.dispatch(service='DETAIL', operation='query detail', room_id=room_id_get)
+        content = controller.dispatch(service='DETAIL', operation='query detail', room_id=room_id_get,
+                                      building_id=building_id)
         content = {'message': 'OK',
                    'result': [
                        {
@@ -109,15 +158,30 @@ def query_rdr(request):
         return JsonResponse({'message': str(error)})
 
 
-def print_rdr(request):
+def export_rdr(request, building_id=DEFAULT_BUILDING):
+    start_get_sp = request.GET.get('start').split("-")
+    end_get_sp = request.GET.get('end').split("-")
+    start_get_da = datetime.datetime(int(start_get_sp[0]), int(start_get_sp[1]), int(start_get_sp[2]))
+    end_get_da = datetime.datetime(int(end_get_sp[0]), int(end_get_sp[1]), int(end_get_sp[2]))
+    room_ids_get = request.GET.get('room_ids')
+    room_ids_get = room_ids_get.split(',') if room_ids_get else None
+    try:
+        controller = Controller.instance()
+        export = controller.dispatch(service='DETAIL', operation='export detail', start_time=start_get_da,
+                                     finish_time=end_get_da + datetime.timedelta(days=1),
+                                     fmt=request.GET.get('format', 'csv'), room_ids=room_ids_get,
+                                     building_id=building_id)
+        return attachment(export)
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def print_rdr(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        filename = controller.dispatch(service='DETAIL', operation='print detail', room_id=room_id_get)
-        file = open(filename, 'r')
-        response = StreamingHttpResponse(file)
-        response['Content-Type'] = 'application/octet-stream'
-        response['Content-Disposition'] = 'attachment;filename="' + filename + '"'
-        return response
+        csv_file = controller.dispatch(service='DETAIL', operation='print detail', room_id=room_id_get,
+                                       building_id=building_id)
+        return attachment(csv_file)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
@@ -0,0 +1,64 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from air_conditioner.controller import Controller
+from utils import DEFAULT_BUILDING
+
+
+class RoomStateConsumer(AsyncWebsocketConsumer):
+    """
+    通过WebSocket推送从机状态变化
+
+    连接参数room_id缺省时订阅所有房间，since为客户端已有的快照版本号，路径中不带楼宇号时订阅默认楼宇。
+    每个事件发送一条文本消息: {"version": 版本号, "event": "status"或"removed", "data": 房间状态或房间号}
+
+    所有发送都在事件循环中进行，阻塞的事件等待在线程池中执行
+
+    Attributes:
+        stream: 从机状态推送流
+        forwarder: 等待事件并发送的任务
+    """
+
+    async def connect(self):
+        query = parse_qs(self.scope['query_string'].decode())
+        room_id = query.get('room_id', [None])[0]
+        since = query.get('since', [None])[0]
+        building_id = self.scope['url_route']['kwargs'].get('building_id', DEFAULT_BUILDING)
+        try:
+            self.stream = await sync_to_async(self.subscribe)(room_id, int(since) if since else None, building_id)
+        except RuntimeError as error:
+            await self.accept()
+            await self.send(text_data=json.dumps({'message': str(error)}))
+            await self.close()
+            return
+        await self.accept()
+        self.forwarder = asyncio.ensure_future(self.forward())
+
+    @staticmethod
+    def subscribe(room_id, since, building_id):
+        return Controller.instance().dispatch(service='ADMINISTRATOR', operation='subscribe status', room_id=room_id,
+                                              since=since, building_id=building_id)
+
+    async def forward(self):
+        """逐个在线程池中等待事件，不占用事件循环和线程敏感的执行线程"""
+        events = self.stream.events()
+        end = object()
+        wait = sync_to_async(next, thread_sensitive=False)
+        while True:
+            event = await wait(events, end)
+            if event is end:
+                return
+            if event is not None:
+                version, name, data = event
+                await self.send(text_data='{"version": ' + str(version) + ', "event": "' + name + '", "data": ' +
+                                data.decode() + '}')
+
+    async def disconnect(self, code):
+        if hasattr(self, 'stream'):
+            # 关闭推送流使线程池中的等待立即返回，再等待发送任务结束
+            self.stream.close()
+            await self.forwarder
@@ -0,0 +1,7 @@
+from django.urls import re_path
+from main_machine import consumers
+
+websocket_urlpatterns = [
+    re_path(r'^main_machine/room_state_events$', consumers.RoomStateConsumer),
+    re_path(r'^buildings/(?P<building_id>\w+)/main_machine/room_state_events$', consumers.RoomStateConsumer),
+]
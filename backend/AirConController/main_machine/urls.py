@@ -5,6 +5,10 @@ urlpatterns = [
     re_path(r'^power_on', views.power_on),
     re_path(r'^init_param$', views.init_param),
     re_path(r'^start_up', views.start_up),
+    re_path(r'^check_room_state_delta$', views.check_room_state_delta),
     re_path(r'^check_room_state', views.check_room_state),
+    re_path(r'^room_state_events$', views.room_state_events),
     re_path(r'^close', views.close),
+    re_path(r'^add_room$', views.add_room),
+    re_path(r'^remove_room$', views.remove_room),
 ]
@@ -1,20 +1,20 @@
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 
 from air_conditioner.controller import Controller
-from utils import logger
+from utils import logger, DEFAULT_BUILDING
 
 
-def power_on(request):
+def power_on(request, building_id=DEFAULT_BUILDING):
     try:
         controller = Controller.instance()
-        controller.dispatch(service='ADMINISTRATOR', operation='power on')
+        controller.dispatch(service='ADMINISTRATOR', operation='power on', building_id=building_id)
         content = {'message': 'OK', 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def init_param(request):
+def init_param(request, building_id=DEFAULT_BUILDING):
     highest_temper_get = float(request.GET.get('highest_temper'))
     lowest_temper_get = float(request.GET.get('lowest_temper'))
     low_speed_fee_get = float(request.GET.get('low_speed_fee'))
@@ -34,17 +34,18 @@ def init_param(request):
                             temp_low_limit=lowest_temper_get, temp_high_limit=highest_temper_get,
                             default_target_temp=default_temper_get,
                             default_speed=default_speed_get,
-                            fee_rate=(low_speed_fee_get, middle_speed_fee_get, high_speed_fee_get))
+                            fee_rate=(low_speed_fee_get, middle_speed_fee_get, high_speed_fee_get),
+                            building_id=building_id)
         content = {'message': "OK", 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def start_up(request):
+def start_up(request, building_id=DEFAULT_BUILDING):
     try:
         controller = Controller.instance()
-        controller.dispatch(service='ADMINISTRATOR', operation='start')
+        controller.dispatch(service='ADMINISTRATOR', operation='start', building_id=building_id)
         content = {'message': 'OK', 'result': None}
         return JsonResponse(content, safe=False)
     except RuntimeError as error:
@@ -52,19 +53,75 @@ def start_up(request):
         return JsonResponse({'message': str(error)})
 
 
-def check_room_state(request):
+def check_room_state(request, building_id=DEFAULT_BUILDING):
     try:
         controller = Controller.instance()
-        content = {'message': 'OK', 'result': controller.dispatch(service='ADMINISTRATOR', operation='get status')}
+        snapshot = controller.dispatch(service='ADMINISTRATOR', operation='get status snapshot',
+                                       building_id=building_id)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if snapshot.etag in (tag.strip() for tag in if_none_match.replace('W/', '').split(',')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(snapshot.body, content_type='application/json')
+        response['ETag'] = snapshot.etag
+        return response
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def check_room_state_delta(request, building_id=DEFAULT_BUILDING):
+    since_get = int(request.GET.get('since', 0))
+    try:
+        controller = Controller.instance()
+        snapshot = controller.dispatch(service='ADMINISTRATOR', operation='get status snapshot',
+                                       building_id=building_id)
+        return HttpResponse(snapshot.delta(since_get), content_type='application/json')
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def room_state_events(request, building_id=DEFAULT_BUILDING):
+    room_id_get = request.GET.get('room_id')
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('since'))
+    try:
+        controller = Controller.instance()
+        stream = controller.dispatch(service='ADMINISTRATOR', operation='subscribe status', room_id=room_id_get,
+                                     since=int(last_event_id) if last_event_id else None, building_id=building_id)
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def close(request, building_id=DEFAULT_BUILDING):
+    try:
+        controller = Controller.instance()
+        controller.dispatch(service='ADMINISTRATOR', operation='stop', building_id=building_id)
+        content = {'message': 'OK', 'result': None}
+        return JsonResponse(content)
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
+
+
+def add_room(request, building_id=DEFAULT_BUILDING):
+    room_id_get = request.GET.get('room_id')
+    try:
+        controller = Controller.instance()
+        controller.dispatch(service='ADMINISTRATOR', operation='add room', room_id=room_id_get, building_id=building_id)
+        content = {'message': 'OK', 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def close(request):
+def remove_room(request, building_id=DEFAULT_BUILDING):
+    room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        controller.dispatch(service='ADMINISTRATOR', operation='stop')
+        controller.dispatch(service='ADMINISTRATOR', operation='remove room', room_id=room_id_get,
+                            building_id=building_id)
         content = {'message': 'OK', 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
@@ -9,4 +9,5 @@ urlpatterns = [
     re_path(r'^change_speed$', views.change_speed),
     re_path(r'^request_fee$', views.request_fee),
     re_path(r'^check_out$', views.check_out),
+    re_path(r'^batch$', views.batch),
 ]
@@ -3,87 +3,120 @@ from django.shortcuts import render
 from air_conditioner.controller import Controller
 from air_conditioner.service import PowerService
 from _ast import operator
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from utils import LONG_POLL_TIMEOUT, DEFAULT_BUILDING
 
 
 # Create your views here.
 
-def check_in(request):
+def check_in(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        controller.dispatch(service='ADMINISTRATOR', operation='check in', room_id=room_id_get)
+        controller.dispatch(service='ADMINISTRATOR', operation='check in', room_id=room_id_get, building_id=building_id)
         content = {'message': "OK", 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def request_on(request):
+def request_on(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     current_temp_get = float(request.GET.get('current_temper'))
     try:
         controller = Controller.instance()
         content = controller.dispatch(service='POWER', operation='power on', room_id=room_id_get,
-                                      current_temp=current_temp_get)
+                                      current_temp=current_temp_get, building_id=building_id)
         content = {'message': "OK", 'result': content}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def request_off(request):
+def request_off(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        controller.dispatch(service='POWER', operation='power off', room_id=room_id_get)
+        controller.dispatch(service='POWER', operation='power off', room_id=room_id_get, building_id=building_id)
         content = {'message': "OK", 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def change_temper(request):
+def change_temper(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     target_temper_get = float(request.GET.get('target_temper'))
     try:
         controller = Controller.instance()
         controller.dispatch(service='SLAVE', operation='change temp', room_id=room_id_get,
-                            target_temp=target_temper_get)
+                            target_temp=target_temper_get, building_id=building_id)
         content = {'message': 'OK', 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def change_speed(request):
+def change_speed(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     speed_get = int(request.GET.get('speed'))
     try:
         controller = Controller.instance()
-        controller.dispatch(service='SLAVE', operation='change speed', room_id=room_id_get, target_speed=speed_get)
+        controller.dispatch(service='SLAVE', operation='change speed', room_id=room_id_get, target_speed=speed_get,
+                            building_id=building_id)
         content = {'message': 'OK', 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def request_fee(request):
+def request_fee(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
+    version_get = request.GET.get('version')
     try:
         controller = Controller.instance()
-        content = {'message': 'OK', 'result': controller.dispatch(service='GET_FEE', room_id=room_id_get)}
+        if version_get is not None:
+            timeout_get = float(request.GET.get('timeout', LONG_POLL_TIMEOUT))
+            version, status = controller.dispatch(service='GET_FEE', room_id=room_id_get, version=int(version_get),
+                                                  timeout=timeout_get, building_id=building_id)
+            return HttpResponse(b'{"message": "OK", "result": ' + status + b', "version": ' + str(version).encode() +
+                                b'}', content_type='application/json')
+        content = {'message': 'OK', 'result': controller.dispatch(service='GET_FEE', room_id=room_id_get,
+                                                                  building_id=building_id)}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
 
 
-def check_out(request):
+def check_out(request, building_id=DEFAULT_BUILDING):
     room_id_get = request.GET.get('room_id')
     try:
         controller = Controller.instance()
-        controller.dispatch(service='ADMINISTRATOR', operation='check out', room_id=room_id_get)
+        controller.dispatch(service='ADMINISTRATOR', operation='check out', room_id=room_id_get,
+                            building_id=building_id)
         content = {'message': "OK", 'result': None}
         return JsonResponse(content)
     except RuntimeError as error:
         return JsonResponse({'message': str(error)})
+
+
+@csrf_exempt
+@require_POST
+def batch(request, building_id=DEFAULT_BUILDING):
+    """请求体为{"commands": [Controller.dispatch()的参数, ...]}，result为与各条命令对应的结果"""
+    try:
+        commands = json.loads(request.body.decode('utf-8')).get('commands')
+    except (ValueError, AttributeError):
+        commands = None
+    if not isinstance(commands, list) or not all(isinstance(command, dict) for command in commands):
+        return JsonResponse({'message': '请求体不合法'})
+    try:
+        controller = Controller.instance()
+        results = controller.dispatch_batch(commands, building_id)
+        content = {'message': 'OK', 'result': [{'message': 'OK', 'result': result} if success else {'message': result}
+                                               for success, result in results]}
+        return JsonResponse(content)
+    except RuntimeError as error:
+        return JsonResponse({'message': str(error)})
@@ -1,16 +1,56 @@
 """
 工具类
 """
+import atexit
 import copy
+import heapq
 import logging
+import queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from threading import Timer, Thread, Lock
+from threading import Timer, Thread, Lock, Event, get_ident
+
+from django.db import transaction
+from django.db.models.query import QuerySet
 
 # 全局日志记录器
 logger = logging.getLogger('django')
 room_ids = ('309c', '310c', '311c', '312c', 'f3')
 UPDATE_FREQUENCY = 1
 TEMPERATURE_CHANGE_RATE_PER_SEC = (1 / 180, 1 / 120, 1 / 60)
+# 批量写入: 每批最大条数, 最长等待时间(秒), 待写入队列容量
+DB_WRITE_BATCH_SIZE = 500
+DB_WRITE_FLUSH_INTERVAL = 0.5
+DB_WRITE_QUEUE_SIZE = 10000
+# 只读查询线程池的并发数
+DB_READ_CONCURRENCY = 4
+# 报表缓存的最大条数
+REPORT_CACHE_SIZE = 1024
+# 批量导出详单时每次查询的条数
+EXPORT_CHUNK_SIZE = 2000
+# 状态推送: 每个订阅者缓存的最大事件数, 无事件时发送心跳的间隔(秒)
+EVENT_QUEUE_SIZE = 256
+EVENT_HEARTBEAT_INTERVAL = 15
+# 长轮询的最长等待时间(秒)
+LONG_POLL_TIMEOUT = 30
+# 多进程部署时非调度进程检查共享状态快照的间隔(秒)
+CLUSTER_POLL_INTERVAL = 0.1
+# 状态日志写入快照并清空的间隔(秒)
+STATE_SNAPSHOT_INTERVAL = 60
+# 批量请求中命令的最大条数
+BATCH_MAX_COMMANDS = 1000
+# 未指定楼宇时使用的楼宇号
+DEFAULT_BUILDING = 'default'
+
+
+def buildings() -> dict:
+    """
+    Returns:
+        楼宇号到楼宇配置的dict，由settings.BUILDINGS得到，未设置时只有默认楼宇
+    """
+    from django.conf import settings
+    return getattr(settings, 'BUILDINGS', None) or {DEFAULT_BUILDING: {}}
 
 
 class RepeatTimer(Timer):
@@ -27,6 +67,276 @@ class RepeatTimer(Timer):
                 self.function(*self.args, **self.kwargs)
 
 
+class MonotonicTimer(Thread):
+    """
+    无漂移定时器
+
+    以time.monotonic()为基准，在start + k * interval的固定时刻执行function(elapsed)，
+    elapsed为距上次执行的实际时长，执行耗时不会累积为漂移。
+    错过周期时记录超时并追赶：每个错过的周期补执行一次，补执行次数超过max_catch_up时，
+    剩余时长合并到最后一次执行中
+
+    Attributes:
+        overruns: 发生超时的次数
+        missed_ticks: 累计错过的周期数
+    """
+
+    def __init__(self, interval, function, max_catch_up=10):
+        Thread.__init__(self)
+        self.setName('MonotonicTimer')
+        self.interval = interval
+        self.function = function
+        self.max_catch_up = max_catch_up
+        self.finished = Event()
+        self.overruns = 0
+        self.missed_ticks = 0
+
+    def cancel(self):
+        self.finished.set()
+
+    def __call(self, elapsed):
+        """执行一次定时任务，任务抛出的异常只记录不中断定时器"""
+        try:
+            self.function(elapsed)
+        except Exception:
+            logger.exception('定时任务执行失败')
+
+    def run(self):
+        last = time.monotonic()
+        deadline = last + self.interval
+        while not self.finished.wait(max(deadline - time.monotonic(), 0)):
+            now = time.monotonic()
+            missed = int((now - deadline) // self.interval)
+            if missed > 0:
+                self.overruns += 1
+                self.missed_ticks += missed
+                logger.warning('定时任务超时, 错过' + str(missed) + '个周期, 累计超时' + str(self.overruns) + '次')
+            elapsed = now - last
+            steps = min(missed, self.max_catch_up)
+            for _ in range(steps):
+                if self.finished.is_set():
+                    return
+                self.__call(self.interval)
+                elapsed -= self.interval
+            if self.finished.is_set():
+                return
+            self.__call(elapsed)
+            last = now
+            deadline += (missed + 1) * self.interval
+
+
+class EventTimer(Thread):
+    """
+    事件定时器
+
+    在next_deadline()返回的时刻(time.monotonic())执行function，没有待处理事件时不唤醒。
+    事件时刻变化时，由调用方设置wakeup使定时器重新计算等待时长
+    """
+
+    def __init__(self, next_deadline, function, wakeup: Event):
+        Thread.__init__(self)
+        self.setName('EventTimer')
+        self.next_deadline = next_deadline
+        self.function = function
+        self.wakeup = wakeup
+        self.finished = Event()
+
+    def cancel(self):
+        self.finished.set()
+        self.wakeup.set()
+
+    def run(self):
+        while not self.finished.is_set():
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is None or timeout > 0:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+            elif not self.finished.is_set():
+                try:
+                    self.function()
+                except Exception:
+                    logger.exception('定时任务执行失败')
+
+
+class IndexedHeap:
+    """
+    带索引的最小堆
+
+    以key索引堆中元素，删除时仅做标记(惰性删除)，在取堆顶时丢弃已失效的条目，
+    push/pop/remove均为O(log n)
+
+    Attributes:
+        __heap: 堆数组，元素为[priority, seq, key, valid]
+        __index: key到堆内条目的映射
+        __seq: 自增序号，优先级相同时按插入顺序出堆
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__index = {}
+        self.__seq = 0
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def push(self, key, priority) -> None:
+        """加入元素，key已存在时更新其优先级"""
+        self.remove(key)
+        entry = [priority, self.__seq, key, True]
+        self.__seq += 1
+        self.__index[key] = entry
+        heapq.heappush(self.__heap, entry)
+
+    def remove(self, key) -> bool:
+        """删除指定元素，返回元素是否存在"""
+        entry = self.__index.pop(key, None)
+        if entry is None:
+            return False
+        entry[-1] = False
+        if len(self.__heap) > 2 * len(self.__index) + 32:
+            # 失效条目过多时重建堆，避免堆无限增长
+            self.__heap = [e for e in self.__heap if e[-1]]
+            heapq.heapify(self.__heap)
+        return True
+
+    def peek(self):
+        """返回优先级最小的元素的key，堆为空时返回None"""
+        while self.__heap and not self.__heap[0][-1]:
+            heapq.heappop(self.__heap)
+        return self.__heap[0][2] if self.__heap else None
+
+    def peek_priority(self):
+        """返回最小的优先级，堆为空时返回None"""
+        return self.__index[self.peek()][0] if len(self.__index) != 0 else None
+
+    def pop(self):
+        """取出优先级最小的元素的key，堆为空时返回None"""
+        key = self.peek()
+        if key is not None:
+            heapq.heappop(self.__heap)
+            del self.__index[key]
+        return key
+
+
+class Subscription:
+    """
+    事件订阅
+
+    事件缓存在有界队列中，发布方从不阻塞。订阅者消费过慢导致队列满时清空队列并置overflowed，
+    订阅者应据此重新获取完整状态
+
+    Attributes:
+        topic:      订阅的主题，为None时订阅所有主题
+        overflowed: 是否因队列满丢弃过事件
+        closed:     是否已取消订阅
+    """
+
+    def __init__(self, broker, topic=None):
+        self.__broker = broker
+        self.__queue = queue.Queue(EVENT_QUEUE_SIZE)
+        self.topic = topic
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.__queue.put_nowait(event)
+        except queue.Full:
+            with self.__queue.mutex:
+                self.__queue.queue.clear()
+            self.overflowed = True
+            self.__queue.put_nowait(event)
+
+    def get(self, timeout=None):
+        """取出一个事件，超时或取消订阅时返回None"""
+        try:
+            return self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """取消订阅，并唤醒阻塞在get()上的订阅者"""
+        if not self.closed:
+            self.closed = True
+            self.__broker.unsubscribe(self)
+            self.put(None)
+
+
+class EventBroker:
+    """
+    进程内的发布/订阅
+
+    publish()将事件放入订阅了该主题或所有主题的订阅的队列
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__subscriptions = ()
+
+    def subscribe(self, topic=None) -> Subscription:
+        subscription = Subscription(self, topic)
+        with self.__lock:
+            self.__subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.__lock:
+            self.__subscriptions = tuple(s for s in self.__subscriptions if s is not subscription)
+
+    def publish(self, topic, event):
+        for subscription in self.__subscriptions:
+            if subscription.topic is None or subscription.topic == topic:
+                subscription.put(event)
+
+    def __len__(self):
+        return len(self.__subscriptions)
+
+
+class Actor(Thread):
+    """
+    单写者执行器
+
+    提交的函数作为消息在同一个线程中按提交顺序执行，结果或异常通过Future返回，
+    被执行的函数之间无需加锁。在该线程内再次提交时直接执行，避免等待自己
+    """
+
+    def __init__(self, name):
+        Thread.__init__(self)
+        self.name = name
+        self.daemon = True
+        self.queue = queue.Queue()
+        self.start()
+
+    def run(self):
+        while True:
+            future, function, args, kwargs = self.queue.get()
+            self.execute(future, function, args, kwargs)
+
+    @staticmethod
+    def execute(future, function, args, kwargs):
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as error:
+                future.set_exception(error)
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        future = Future()
+        if get_ident() == self.ident:
+            self.execute(future, function, args, kwargs)
+        else:
+            self.queue.put((future, function, args, kwargs))
+        return future
+
+    def call(self, function, *args, **kwargs):
+        """提交并等待执行结果"""
+        return self.submit(function, *args, **kwargs).result()
+
+
 class DBFacadeThread(Thread):
 
     def __init__(self, function, **kwargs):
@@ -40,14 +350,194 @@ class DBFacadeThread(Thread):
         self.result = copy.copy(self.function(**self.kwargs))
 
 
+class DBWriterThread(Thread):
+    """
+    批量写入线程
+
+    从有界队列中取出待插入的模型对象，攒满DB_WRITE_BATCH_SIZE条或等待DB_WRITE_FLUSH_INTERVAL秒后，
+    在一个事务内按模型bulk_create，并在同一事务内调用DBFacade注册的写入监听器，提交后调用提交监听器。队列满时写入方阻塞，形成背压
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.name = 'DBWriter'
+        self.daemon = True
+        self.queue = queue.Queue(DB_WRITE_QUEUE_SIZE)
+
+    def run(self):
+        while True:
+            batch, markers, stop = [], [], False
+            item = self.queue.get()
+            deadline = time.monotonic() + DB_WRITE_FLUSH_INTERVAL
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, Event):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if stop or markers or len(batch) >= DB_WRITE_BATCH_SIZE:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            self.write(batch)
+            for marker in markers:
+                marker.set()
+            if stop:
+                return
+
+    @staticmethod
+    def write(batch):
+        """在一个事务内按模型批量插入"""
+        if len(batch) == 0:
+            return
+        groups = {}
+        for obj in batch:
+            groups.setdefault(type(obj), []).append(obj)
+        try:
+            with transaction.atomic():
+                for model, objs in groups.items():
+                    model.objects.bulk_create(objs)
+                DBWriterThread.notify(batch)
+        except Exception as error:
+            # 批量写入失败时逐条写入，避免一条错误数据导致整批丢失
+            logger.error('批量写入失败: ' + str(error))
+            for obj in batch:
+                try:
+                    with transaction.atomic():
+                        obj.save(force_insert=True)
+                        DBWriterThread.notify([obj])
+                except Exception as row_error:
+                    logger.error('写入' + type(obj).__name__ + '失败: ' + str(row_error))
+                else:
+                    DBWriterThread.notify_committed([obj])
+        else:
+            DBWriterThread.notify_committed(batch)
+
+    @staticmethod
+    def notify(batch):
+        """在写入事务内调用写入监听器"""
+        for listener in DBFacade._listeners:
+            listener(batch)
+
+    @staticmethod
+    def notify_committed(batch):
+        """在写入事务提交后调用提交监听器，此时其他连接已能读到这批写入"""
+        for listener in DBFacade._commit_listeners:
+            try:
+                listener(batch)
+            except Exception as error:
+                logger.error('提交监听器执行失败: ' + str(error))
+
+
 class DBFacade:
-    """数据库操作"""
+    """
+    数据库操作
+
+    读写分离:
+    query在独立的只读线程池中执行查询，并发数为DB_READ_CONCURRENCY，耗时的报表查询不占用写入路径;
+    create将插入交给DBWriterThread异步批量写入;
+    exec在全局锁下同步执行其余的更新。
+    add_listener注册的监听器在写入线程中、与插入同一事务内收到每批写入的对象，用于维护派生数据；
+    add_commit_listener注册的监听器在事务提交后收到，用于使依赖这些数据的缓存失效。
+    query和exec执行前会先等待已提交的插入写入完成，保证读到之前的写入
+    """
 
     _lock = Lock()
     _thread = None
+    _writer = None
+    _writer_lock = Lock()
+    _reader = None
+    _reader_lock = Lock()
+    _listeners = []
+    _commit_listeners = []
+
+    @staticmethod
+    def add_listener(listener):
+        """
+        注册写入监听器
+
+        Args:
+            listener: 接收一批已插入模型对象的list的函数，抛出异常时整批回滚
+        """
+        if listener not in DBFacade._listeners:
+            DBFacade._listeners.append(listener)
+
+    @staticmethod
+    def add_commit_listener(listener):
+        """
+        注册提交监听器
+
+        Args:
+            listener: 接收一批已提交的模型对象的list的函数，抛出异常时只记录日志
+        """
+        if listener not in DBFacade._commit_listeners:
+            DBFacade._commit_listeners.append(listener)
+
+    @staticmethod
+    def _get_writer():
+        if DBFacade._writer is None:
+            with DBFacade._writer_lock:
+                if DBFacade._writer is None:
+                    writer = DBWriterThread()
+                    writer.start()
+                    atexit.register(DBFacade.shutdown)
+                    DBFacade._writer = writer
+        return DBFacade._writer
+
+    @staticmethod
+    def create(model, **kwargs):
+        """异步插入一条记录"""
+        DBFacade._get_writer().queue.put(model(**kwargs))
+
+    @staticmethod
+    def flush():
+        """等待已提交的插入全部写入数据库"""
+        writer = DBFacade._writer
+        if writer is not None and writer.is_alive():
+            marker = Event()
+            writer.queue.put(marker)
+            marker.wait()
+
+    @staticmethod
+    def shutdown():
+        """写入剩余记录并结束写入线程"""
+        with DBFacade._writer_lock:
+            writer, DBFacade._writer = DBFacade._writer, None
+        if writer is not None and writer.is_alive():
+            writer.queue.put(None)
+            writer.join()
+
+    @staticmethod
+    def _get_reader():
+        if DBFacade._reader is None:
+            with DBFacade._reader_lock:
+                if DBFacade._reader is None:
+                    DBFacade._reader = ThreadPoolExecutor(DB_READ_CONCURRENCY, thread_name_prefix='DBReader')
+        return DBFacade._reader
+
+    @staticmethod
+    def _evaluate(function, kwargs):
+        result = function(**kwargs)
+        return list(result) if isinstance(result, QuerySet) else result
+
+    @staticmethod
+    def query(function, **kwargs):
+        """
+        在只读线程池中执行查询
+
+        不等待写入线程，需要读到已排队的插入的调用者先调用flush()
+
+        Returns:
+            查询结果，QuerySet在线程池内求值为list
+        """
+        return DBFacade._get_reader().submit(DBFacade._evaluate, function, kwargs).result()
 
     @staticmethod
     def exec(function, **kwargs):
+        DBFacade.flush()
         if DBFacade._thread is not None:
             with DBFacade._lock:
                 DBFacade._thread.join()
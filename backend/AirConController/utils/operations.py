@@ -1,7 +1,17 @@
-"""日志条目的operation值"""
-
-POWER_ON = 'power on'
-POWER_OFF = 'power off'
-DISPATCH = 'dispatch'
-CHANGE_TEMP = 'change temp'
-CHANGE_SPEED = 'change speed'
+"""日志条目的operation值"""
+
+UNKNOWN = 0  # 旧数据中无法识别的操作
+POWER_ON = 1
+POWER_OFF = 2
+DISPATCH = 3
+CHANGE_TEMP = 4
+CHANGE_SPEED = 5
+
+CHOICES = (
+    (UNKNOWN, 'unknown'),
+    (POWER_ON, 'power on'),
+    (POWER_OFF, 'power off'),
+    (DISPATCH, 'dispatch'),
+    (CHANGE_TEMP, 'change temp'),
+    (CHANGE_SPEED, 'change speed'),
+)